@@ -0,0 +1,185 @@
+"""
+ batched version of bottiming.genstats for the backfill scripts
+
+ timing.py, poptiming.py, scale-back-archive.py and fix-diffs-by-host.py
+ used to call genstats once per row which means a pure python loop over
+ up to MAXDIFFS numbers for every request in the archive
+ this module takes the windows for many ips at once, pads them into a
+ 2d array and works out n, sum, mean, var, skew and kurtosis for every
+ row in one numpy pass
+
+ the results match genstats including its quirks:
+    var is the sum of squared deviations (not divided by n-1)
+    the skew correction sn is 1/(n-1) as ((n*(n-1))**(1/2))/(n-1)
+    uses integer division for the exponent
+    rows with 1 or fewer items have no stats (genstats returns None)
+
+ numpy is only needed by the backfill scripts, the preprocessor
+ (botlogger/botlog/botupdstats) does not import this module
+"""
+import numpy
+
+# rows per numpy pass - 2048 x 1000 doubles is 16MB per temporary array
+CHUNK = 2048
+# the stats columns for each window, with the window's column prefix
+STATFIELDS = ('n', 'sum', 'mean', 'var', 'skew', 'kurtosis')
+WINDOWS = (('', 'diffs'), ('h', 'hourdiffs'), ('ht', 'hours'))
+
+def padwindows(windows):
+    """
+    turn a list of lists into a zero padded 2d array and a list of lengths
+    """
+    width = 0
+    for w in windows:
+        if len(w) > width:
+            width = len(w)
+    values = numpy.zeros((len(windows), width))
+    lengths = numpy.zeros(len(windows), dtype=numpy.int64)
+    for i, w in enumerate(windows):
+        values[i, :len(w)] = w
+        lengths[i] = len(w)
+    return values, lengths
+
+def batchstats(values, lengths=None):
+    """
+    stats for each row of a 2d array of windows
+    values can be an already padded array with the row lengths in lengths
+    or a ragged list of lists
+    returns a dict of 1d arrays with the genstats fields plus "valid"
+    which is False where genstats would have returned None
+    """
+    if lengths is None:
+        values, lengths = padwindows(values)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    lengths = numpy.asarray(lengths)
+    mask = numpy.arange(values.shape[1]) < lengths[:, numpy.newaxis]
+
+    n = lengths.astype(numpy.float64)
+    valid = n > 1
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        s = numpy.where(mask, values, 0.0).sum(axis=1)
+        m = s/n
+        d = numpy.where(mask, values - m[:, numpy.newaxis], 0.0)
+        d2 = d*d
+        se = d2.sum(axis=1)
+        ce = (d2*d).sum(axis=1)
+        qe = (d2*d2).sum(axis=1)
+        var = se/(n-1.0)
+
+        # see bottiming.genstats for the sources of these corrections
+        hasvar = valid & (var != 0)
+        sn = 1.0/(n-1.0)
+        skew = numpy.where(hasvar, sn*(ce/n)/(var*numpy.sqrt(var)), 0.0)
+        kn1 = (n*(n+1.0))/((n-1.0)*(n-2.0)*(n-3.0))
+        kn2 = ((n-1.0)**2.0)/((n-2.0)*(n-3.0))
+        kurt = numpy.where(hasvar & (n > 3), kn1*(qe/n)/(var**2.0) - 3.0*kn2, 0.0)
+
+    return {'n': n, 'sum': s, 'mean': m, 'var': se,
+            'skew': skew, 'kurtosis': kurt, 'valid': valid}
+
+def genstatsmany(windows):
+    """
+    genstats for a list of windows, returns a list of dicts (or None)
+    in the same order with the same fields as bottiming.genstats
+    """
+    results = []
+    for start in range(0, len(windows), CHUNK):
+        chunk = windows[start:start+CHUNK]
+        b = batchstats(chunk)
+        for i, w in enumerate(chunk):
+            if not b['valid'][i]:
+                results.append(None)
+                continue
+            results.append({
+                'diffs': w, 'n': float(b['n'][i]), 'sum': float(b['sum'][i]),
+                'mean': float(b['mean'][i]), 'var': float(b['var'][i]),
+                'skew': float(b['skew'][i]), 'kurtosis': float(b['kurtosis'][i])})
+    return results
+
+def updatestats(rows, ucur, uconn):
+    """
+    batched version of bottiming.updatestats for backfills
+    rows is a list of dicts with ip, diffs, hourdiffs and hours
+    saves the windows and their stats but does not ask vw for a prediction
+    commits once per call
+    """
+    s = genstatsmany([row['diffs'] for row in rows])
+    h = genstatsmany([row['hourdiffs'] for row in rows])
+    ht = genstatsmany([row['hours'] for row in rows])
+    full = []
+    windows = []
+    for i, row in enumerate(rows):
+        d = {'ip': row['ip'], 'diffs': row['diffs'],
+             'hourdiffs': row['hourdiffs'], 'hours': row['hours']}
+        # like updatestats only save the windows if we can't do stats
+        if s[i] == None or h[i] == None or ht[i] == None:
+            windows.append(d)
+            continue
+        for prefix, st in (('', s[i]), ('h', h[i]), ('ht', ht[i])):
+            for field in ('n', 'sum', 'mean', 'var', 'skew', 'kurtosis'):
+                d[prefix+field] = st[field]
+        full.append(d)
+    try:
+        ucur.executemany(
+            """
+            update botstats set
+                diffs=%(diffs)s, hourdiffs=%(hourdiffs)s, hours=%(hours)s
+            where ip=%(ip)s
+            """, windows)
+        ucur.executemany(
+            """
+            update botstats set
+                diffs=%(diffs)s, hourdiffs=%(hourdiffs)s, hours=%(hours)s,
+                n=%(n)s, sum=%(sum)s, mean=%(mean)s, var=%(var)s,
+                skew=%(skew)s, kurtosis=%(kurtosis)s,
+                hn=%(hn)s, hsum=%(hsum)s, hmean=%(hmean)s, hvar=%(hvar)s,
+                hskew=%(hskew)s, hkurtosis=%(hkurtosis)s,
+                htn=%(htn)s, htsum=%(htsum)s, htmean=%(htmean)s, htvar=%(htvar)s,
+                htskew=%(htskew)s, htkurtosis=%(htkurtosis)s
+            where ip=%(ip)s
+            """, full)
+        uconn.commit()
+    except Exception as e:
+        uconn.rollback()
+        print "batch update error for %d ips" % len(rows)
+        print str(e)
+
+def savestats(table, rows, ucur, uconn):
+    """
+    work out the stats for a batch of ips in one go and save them to table
+    (timing.py and poptiming.py)
+    rows is a list of dicts with ip, the diffs and hourdiffs windows and
+    optionally the hours histogram, everything else in them (pages, reqs,
+    errs) is saved as is. each ip is updated or inserted if it isn't there
+    yet with a savepoint per ip, commits once per call
+    raises an Exception if an ip doesn't have enough data for stats
+    """
+    stats = []
+    for prefix, window in WINDOWS:
+        if window in rows[0]:
+            stats.append((prefix, genstatsmany([row[window] for row in rows])))
+
+    for i, row in enumerate(rows):
+        data = dict(row)
+        for prefix, st in stats:
+            if st[i] == None:
+                raise Exception("missing data for ip "+row['ip'])
+            for field in STATFIELDS:
+                data[prefix+field] = st[i][field]
+
+        cols = sorted(data)
+        try:
+            ucur.execute("savepoint savestats")
+            ucur.execute("update %s set %s where ip=%%(ip)s" % (table,
+                            ",".join(["%s=%%(%s)s" % (col, col) for col in cols if col != 'ip'])),
+                            data)
+            if ucur.rowcount == 0:
+                ucur.execute("insert into %s (%s) values (%s)" % (table, ",".join(cols),
+                                ",".join(["%%(%s)s" % col for col in cols])),
+                                data)
+        except Exception as e:
+            print "error saving data for ip ",row['ip']
+            print str(e)
+            ucur.execute("rollback to savepoint savestats")
+    print "committing data for %d ips" % len(rows)
+    uconn.commit()
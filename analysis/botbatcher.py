@@ -0,0 +1,75 @@
+"""
+ hand messages from the listener to a processing function in batches
+
+ botlogger and botpreprocess used to poll a shared list every DELAY
+ seconds and deepcopy it before processing. a Batcher's thread sleeps on
+ a condition until the first message of a batch arrives, then waits until
+ either maxbatch messages are waiting or maxdelay seconds have passed
+ since that first message. the full list is swapped for an empty one
+ under the lock so nothing has to be copied and nothing runs while there
+ is no work
+"""
+import logging
+import sys
+import threading
+import time
+
+# process as soon as this many messages are waiting
+MAXBATCH = 1000
+# longest a message waits before its batch is processed
+MAXDELAY = 0.01
+
+class Batcher(object):
+    def __init__(self, process, maxbatch=MAXBATCH, maxdelay=MAXDELAY):
+        """ process is called with each batch (a list of messages) """
+        self.process = process
+        self.maxbatch = maxbatch
+        self.maxdelay = maxdelay
+        self.cond = threading.Condition()
+        self.messages = []
+        # when the first message of the current batch arrived
+        self.first = None
+        self.thread = None
+
+    def put(self, message):
+        self.cond.acquire()
+        self.messages.append(message)
+        if len(self.messages) == 1:
+            self.first = time.time()
+            self.cond.notify()
+        elif len(self.messages) >= self.maxbatch:
+            self.cond.notify()
+        self.cond.release()
+
+    def take(self):
+        """ wait for the next batch and take it """
+        self.cond.acquire()
+        try:
+            while len(self.messages) == 0:
+                self.cond.wait()
+            while len(self.messages) < self.maxbatch:
+                left = self.first + self.maxdelay - time.time()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            batch = self.messages
+            self.messages = []
+            return batch
+        finally:
+            self.cond.release()
+
+    def run(self):
+        logging.debug("starting batcher")
+        while True:
+            batch = self.take()
+            logging.debug("processing %d messages" % len(batch))
+            try:
+                self.process(batch)
+            except Exception as e:
+                exc_type, exc_obj, tb = sys.exc_info()
+                logging.error("batch of %d failed at %d: %s" % (len(batch), tb.tb_lineno, str(e)))
+
+    def start(self, name="batcher"):
+        self.thread = threading.Thread(name=name, target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
@@ -0,0 +1,177 @@
+"""
+ small in process cache for predictions and features
+
+ the classifier servers asked redis or memcached for the same few hot
+ ips thousands of times a minute. a Cache keeps up to size answers for
+ ttl seconds, dropping the least recently used when it is full. an ip
+ that wasn't found is remembered as well (value None) for missingttl
+ seconds so repeated lookups for unknown ips don't go to the store either
+
+ when bottiming.get_prediction saves a prediction to redis it also
+ publishes the ip on CHANNEL. subscribe starts a thread that listens on
+ that channel (or on redis keyspace notifications, if the server has
+ notify-keyspace-events set) and drops the ips it hears about so a new
+ prediction is used straight away rather than after ttl seconds
+
+ a value looked up before an invalidation may come back after it so
+ callers take a version before asking the store and hand it to put,
+ which drops the value if its key has been invalidated since
+"""
+import collections
+import logging
+import threading
+import time
+
+# most entries to keep
+SIZE = 100000
+# seconds to keep a value
+TTL = 60
+# seconds to keep the fact that there was no value
+MISSINGTTL = 10
+# redis channel that new predictions are published on
+CHANNEL = "botpredictions"
+
+class Cache(object):
+    def __init__(self, size=SIZE, ttl=TTL, missingttl=MISSINGTTL):
+        self.size = size
+        self.ttl = ttl
+        self.missingttl = missingttl
+        self.lock = threading.Lock()
+        # key => (expiry time, value), least recently used first
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # bumped by every invalidate or clear
+        self.generation = 0
+        # key => generation it was last invalidated at, oldest first
+        self.invalidated = collections.OrderedDict()
+        # generation of the last clear or of the newest invalidation
+        # that has been dropped from invalidated
+        self.forgotten = 0
+
+    def get(self, key):
+        """ returns (True, value) if key is cached, (False, None) if not """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry == None or entry[0] <= now:
+                self.misses += 1
+                return False, None
+            self.entries[key] = entry
+            self.hits += 1
+            return True, entry[1]
+        finally:
+            self.lock.release()
+
+    def getmany(self, keys):
+        """ returns a dict of the cached values and a list of the keys that weren't """
+        found = {}
+        missing = []
+        for key in keys:
+            cached, value = self.get(key)
+            if cached:
+                found[key] = value
+            else:
+                missing.append(key)
+        return found, missing
+
+    def version(self):
+        """ take this before looking up a value to pass to put """
+        return self.generation
+
+    def stale(self, key, version):
+        """ True if key may have been invalidated since version, call with the lock held """
+        return self.forgotten > version or self.invalidated.get(key, 0) > version
+
+    def put(self, key, value, version=None):
+        """
+        cache a value, None means there wasn't one
+        if version is given the value isn't cached if key has
+        been invalidated since then
+        """
+        if value == None:
+            expires = time.time() + self.missingttl
+        else:
+            expires = time.time() + self.ttl
+        self.lock.acquire()
+        try:
+            if version != None and self.stale(key, version):
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, key):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            self.entries.pop(key, None)
+            self.invalidated.pop(key, None)
+            self.invalidated[key] = self.generation
+            while len(self.invalidated) > self.size:
+                key, generation = self.invalidated.popitem(last=False)
+                self.forgotten = generation
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            self.forgotten = self.generation
+            self.entries.clear()
+            self.invalidated.clear()
+        finally:
+            self.lock.release()
+
+def keys(ip):
+    """ predictions are saved for host/ip and looked up by ip so drop both """
+    if "/" in ip:
+        return [ip, ip.split("/")[-1]]
+    return [ip]
+
+def listen(rs, cache, channel=CHANNEL, keyspace=False):
+    """
+    subscriber thread: drop cached ips when redis says they've changed
+    rs shouldn't have a socket_timeout as the channel can be quiet for a long time
+    """
+    while True:
+        try:
+            pubsub = rs.pubsub()
+            if keyspace:
+                pubsub.psubscribe("__keyspace@*__:*")
+            else:
+                pubsub.subscribe(channel)
+            # anything may have changed while we weren't listening
+            cache.clear()
+            for message in pubsub.listen():
+                if message['type'] == 'pmessage':
+                    ip = message['channel'].split(":", 1)[1]
+                elif message['type'] == 'message':
+                    ip = message['data']
+                else:
+                    continue
+                for key in keys(ip):
+                    cache.invalidate(key)
+        except Exception as e:
+            logging.error("invalidation listener failed: %s" % e)
+            cache.clear()
+            time.sleep(1)
+
+def subscribe(rs, cache, channel=CHANNEL, keyspace=False):
+    """
+    start a thread that keeps cache up to date with redis rs
+    give it its own connection without a socket_timeout, see listen
+    """
+    t = threading.Thread(name="invalidate", target=listen, args=(rs, cache, channel, keyspace))
+    t.daemon = True
+    t.start()
+    return t
+
+def publish(pipe, ip, channel=CHANNEL):
+    """ tell the subscribers the prediction for ip has changed """
+    pipe.publish(channel, ip)
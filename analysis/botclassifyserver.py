@@ -0,0 +1,203 @@
+"""
+ shared server for redis-botclassify.py and memcache-botclassify.py
+
+ mod_ml asks one of these for every request that has an MLClassifier so
+ its latency is the page's latency. both scripts made a respond thread
+ for each connection and then called its run method directly, so lookups
+ were done one at a time on the accept thread with a listen backlog of 10
+
+ ClassifyServer is a botserver.Server (one epoll loop, non blocking
+ connections, "\n\n" or length framing, keep-alive and botproto
+ persistent mode, the same whitelist and nonce checks). instead of
+ handing messages on, the ips asked for in one round of events are
+ looked up together with a single lookup call (redis MGET or memcache
+ get_multi on a connection that stays open) and every connection that
+ asked gets its answer. a slow connection never holds up anyone else
+ and the store sees one round trip for a whole batch of requests
+
+ given a botcache.Cache only the ips that aren't cached are looked up
+ and what comes back (including ips that weren't found) is cached
+
+ answers are YES (bot), NO (human), MISSING (no prediction) or BADIP
+ each followed by a newline so keep-alive clients can tell them apart
+ (mod_ml drops the newline)
+"""
+import hashlib
+import json
+import logging
+import re
+
+import botproto
+import botserver
+
+ippat = re.compile("^\s*\w[\w\.\-:]+\w[/\s]+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|[0-9a-fA-F]*:[0-9a-fA-F:\.]+)")
+
+def read_whitelist(hostfile):
+    """
+    read a hosts file of "ip [nonce=password]" lines into a dict of
+    ip => True or the sha1 of the password
+    """
+    whitelist = {}
+    line = None
+    try:
+        split = re.compile("\s*(\S+)\s*(.*)")
+        comment = re.compile("^\s*#")
+        isnonce = re.compile("(nonce)=(\"[^\"]*\"|'[^']*'|\S*)")
+        wl = open(hostfile)
+        for line in wl:
+            lm = split.match(line)
+            if lm == None: 
+                continue
+            bits = lm.groups()
+            if comment.match(bits[0]): 
+                continue
+
+            yes = True
+            if len(bits) > 1:
+                m = isnonce.match(bits[1])
+                if m != None:
+                    authtype, pw = m.groups()
+                    yes = hashlib.sha1(pw).hexdigest()
+
+            whitelist[bits[0]] = yes
+        wl.close()
+        logging.debug("whitelist %s" % (whitelist))
+
+    except Exception as e:
+        logging.debug("failed reading whitelist %s at line %s: %s" % (hostfile,line, e))
+    return whitelist
+
+def findip(message):
+    """ the ip to look up from a json message with an ip or a plain host/ip """
+    ipstr = message
+    try:
+        parsed = json.loads(message)
+        if 'ip' in parsed:
+            ipstr = parsed['ip'].strip()
+    except:
+        pass
+    i = ippat.search(ipstr)
+    if i == None:
+        return None
+    return i.group(1)
+
+def answer(p):
+    """ turn a stored prediction into the answer for mod_ml """
+    if p == None:
+        return "MISSING"
+    try:
+        # redis hands back strings, the old "p < 0" compared a string to 0
+        p = float(p)
+    except (TypeError, ValueError):
+        return "MISSING"
+    if p < 0:
+        return "NO"
+    return "YES"
+
+class ClassifyServer(botserver.Server):
+    def __init__(self, port, whitelist, lookup, cache=None):
+        """
+        lookup is called with a list of ips and returns a dict of
+        ip => stored prediction for the ones it found
+        cache is an optional botcache.Cache
+        """
+        botserver.Server.__init__(self, port, whitelist, None)
+        self.lookup = lookup
+        self.cache = cache
+        # (fd, conn, request id or None, ip) waiting for the next lookup
+        self.waiting = []
+        # fd => requests waiting for that connection
+        self.pending = {}
+        # fds the client has finished with that still have answers to send
+        self.closing = set()
+
+    def wait(self, conn, id, ip):
+        fd = conn.sock.fileno()
+        self.waiting.append((fd, conn, id, ip))
+        self.pending[fd] = self.pending.get(fd, 0) + 1
+
+    def handle(self, conn, messages):
+        for message in messages:
+            if not self.checknonce(conn.addr, message):
+                # the old servers closed without answering
+                self.close(conn.sock.fileno())
+                return
+            self.wait(conn, None, findip(message))
+
+    def handlelines(self, conn, lines):
+        for line in lines:
+            try:
+                req = json.loads(line)
+                message = req['data']
+            except (ValueError, KeyError, TypeError):
+                logging.error("bad request from %s: %s" % (conn.addr, line))
+                continue
+            if not self.checknonce(conn.addr, message):
+                self.close(conn.sock.fileno())
+                return
+            self.wait(conn, req.get('id'), findip(message))
+
+    def close(self, fd):
+        """ hold on to connections that are still waiting for answers """
+        if self.pending.get(fd, 0) > 0:
+            if fd not in self.closing:
+                self.closing.add(fd)
+                try:
+                    self.poller.unregister(fd)
+                except (IOError, ValueError, KeyError):
+                    pass
+            return
+        self.closing.discard(fd)
+        botserver.Server.close(self, fd)
+
+    def after(self):
+        """ look up everything asked for in this round and answer it """
+        if len(self.waiting) == 0:
+            return
+        waiting = self.waiting
+        self.waiting = []
+        ips = list(set([ip for fd, conn, id, ip in waiting if ip != None]))
+        found = {}
+        if self.cache != None:
+            found, ips = self.cache.getmany(ips)
+            # an invalidation during the lookup means what comes back may be old
+            version = self.cache.version()
+        if len(ips) > 0:
+            try:
+                looked = self.lookup(ips)
+                found.update(looked)
+                if self.cache != None:
+                    for ip in ips:
+                        self.cache.put(ip, looked.get(ip), version)
+            except Exception as e:
+                logging.error("lookup of %d ips failed: %s" % (len(ips), e))
+
+        answered = {}
+        for fd, conn, id, ip in waiting:
+            self.pending[fd] -= 1
+            if self.pending[fd] == 0:
+                del self.pending[fd]
+            if self.conns.get(fd) is not conn:
+                continue
+            if ip == None:
+                reply = "BADIP"
+            else:
+                reply = answer(found.get(ip))
+            logging.debug("%s %s" % (ip, reply))
+            if conn.persistent:
+                conn.outbuf += botproto.response(id, reply)
+            else:
+                conn.outbuf += reply+"\n"
+            answered[fd] = conn
+
+        for fd in answered:
+            if fd in self.closing:
+                # the client has shut down its side, answer and be done with it
+                try:
+                    self.conns[fd].sock.send(self.conns[fd].outbuf)
+                except Exception:
+                    pass
+                if fd not in self.pending:
+                    self.close(fd)
+            else:
+                self.write(fd)
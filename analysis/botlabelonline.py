@@ -8,7 +8,10 @@ import time
 import sys
 import os
 import socket
+import threading
 import traceback
+import botproto
+import botpool
 from mldb import dbname, dbuser, dbpw
 
 if len(sys.argv) < 2:
@@ -75,46 +78,96 @@ def setisbot(conn):
         isbot[label] = bot
     return isbot
 
-def updateclasses(conn):
+# known is shared by the connection threads, isbot is only read
+lock = threading.Lock()
+
+def classify(ua, known, isbot):
+    """
+    the isbot value for a ua, asks useragentstring if we haven't seen it
+    the lock is only held for known so a slow lookup doesn't hold up
+    other connections, each lookup uses its own pooled db connection
+    """
+    lock.acquire()
+    try:
+        found = ua in known
+        label = known.get(ua)
+    finally:
+        lock.release()
+    if not found:
+        with botpool.connection() as conn:
+            label = getlabel(ua, conn)
+        lock.acquire()
+        known[ua] = label
+        lock.release()
+    return "%s\n" % isbot[label]
+
+def serve(stream, known, isbot):
+    """
+    answer one connection: either a single ua (the original protocol)
+    or many request lines after a botproto.HELLO
+    """
+    try:
+        data = stream.recv(2048)
+        while len(data) < len(botproto.HELLO) and botproto.HELLO.startswith(data):
+            more = stream.recv(2048)
+            if not more:
+                break
+            data += more
+        if not data.startswith(botproto.HELLO):
+            stream.sendall(classify(data.strip(), known, isbot))
+            return
+
+        stream.sendall(botproto.HELLO)
+        buf = data[len(botproto.HELLO):]
+        while True:
+            lines, buf = botproto.splitlines(buf)
+            for line in lines:
+                try:
+                    req = json.loads(line)
+                except ValueError:
+                    continue
+                try:
+                    reply = classify(req['data'].strip(), known, isbot)
+                except Exception as e:
+                    reply = None
+                stream.sendall(botproto.response(req.get('id'), reply))
+            more = stream.recv(65536)
+            if not more:
+                break
+            buf += more
+    except Exception as e:
+        pass
+    finally:
+        stream.close()
+
+def updateclasses():
     """
     wait on a port and receive uas 
     try and find whether they are a bot or not
     return the class entry with their class -1 = human, 1 = bot
     remember what we have seen
+    each connection gets its own thread so persistent connections
+    from botlogger don't hold up anyone else
     """
     global port
-    known = setknown(conn)
-    isbot = setisbot(conn)
+    with botpool.connection() as conn:
+        known = setknown(conn)
+        isbot = setisbot(conn)
+        conn.commit()
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     print "binding to port",port
     s.bind(('',port))
     s.listen(8)
     while True:
         try:
             stream, server = s.accept()
-            childpid = os.fork()
-            if childpid != 0:
-                pid, status = os.wait()
-            else:
-                try:
-                    ua = stream.recv(2048).strip()
-                    if ua in known:
-                        label = known[ua]
-                    else:
-                        label = getlabel(ua, conn)
-                        known[ua] = label
-                    stream.sendall("%s\n" % isbot[label])
-                except:
-                    pass
-                finally:
-                    os._exit(0)
-
+            t = threading.Thread(target=serve, args=(stream, known, isbot))
+            t.daemon = True
+            t.start()
         except Exception as e:
             pass
-        finally:
-            stream.close()
 
 if __name__ == '__main__':
-    conn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpw)
-    updateclasses(conn)
+    updateclasses()
 
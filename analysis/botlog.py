@@ -5,13 +5,16 @@
  botlogger feeds this module messages via the process function below
  the process function simply puts messages from mod_ml into the botlog table
  then alerts the processing threads via the poke function
- the processing threads keep working as long as possible then
- wake up the cleanup thread which checks to see if there is left over
- stuff in botlog
+ the processing threads sleep until they are handed ips, do one pass
+ over the botlog rows for those ips and wake up the cleanup thread which
+ checks to see if there is left over stuff in botlog
+ with WAKEUP set to 'notify' the ips go through postgres LISTEN/NOTIFY
+ instead so rows added by other processes wake the workers too
  
- the basic idea is to have many threads each of which takes care of 
- the history for a single ip all at the same time
- they handle many ips in parallel
+ the basic idea is to split the ips over SHARDS worker threads
+ each ip is always handled by the same worker (see botshard) so
+ the history for an ip is only ever updated by one thread
+ the workers handle many ips in parallel each with its own db connection
  note that the db considers an "ip" to be "http_host/remote_addr"
  this is specific to the script used to replay existing logs for testing
  messages are read oldest to newest 
@@ -27,175 +30,251 @@ import logging
 logging.basicConfig(level=logging.DEBUG,
         format="%(levelname)s:(%(threadName)-10s) (%(funcName)-10s) %(message)s") 
 
-import psycopg2
-from mldb import dbname, dbuser, dbpw
+from psycopg2.extras import execute_values
 import json
+import select
 import sys
 import time
 import threading
+import multiprocessing
 import botupdstats as upd
-import copy
+import botstate
+import botqueue
+import botshard
+import botpool
 
 # for vowpal wabbit predictions/learning and ua classification - set in botlogger.py
 services = {'vw':None,'redis':None,'vw_learn':None,'ua':None}
 
-# used for resetting the db connection if its died
-lock = threading.Lock()
-# used for cleaning up myips
-iplock = threading.Lock()
-
-# tell a thread to wake up and do something because poke has found work for it
-condition = threading.Condition()
+# stops two callers starting the threads at once
+startlock = threading.Lock()
 
 # tell cleanup to wake up and do something because a thread is idle
 cleanupcond = threading.Condition()
 # "data" that gets manipulated as part of cleanupcond processing
 notbusy = True
 
-# total processing threads to start 
-# trying for about 10 ips per thread - see query in cleanup below
-THREADCOUNT = 512
-# next thread to assign an ip to
-nextt = -1
-# thred array
-t = []
-# who is looking after what IP
-myips = {}
-ipprocs = {}
-# db connection for internal processing
-conn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpw)
-# db connection for process func - fills botlog table
-proconn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpw)
+# number of worker threads, each owns a hash range of ips
+try:
+    SHARDS = multiprocessing.cpu_count()
+except NotImplementedError:
+    SHARDS = 4
+# the botshard.Shard for each worker
+shards = []
+cleant = None
+# how workers find out about new botlog rows
+# 'poke': process hands the ips it saved straight to this process's shards
+# 'notify': process sends them with pg_notify and a listener thread pokes
+#   the shards, use this when more than one botlogger writes to botlog
+#   or something other than process adds rows
+WAKEUP = 'poke'
+# seconds the listener waits before checking its connection is still there
+LISTENWAIT = 60
+listent = None
+# set by botprocs when botlog runs in one of PARTS processes
+# only ips in part PART of the hash range are handled here
+PART = 0
+PARTS = 1
+# keep botstats and botlatest in memory and save them in the background
+# if False every batch for an ip reads and writes them directly
+STATESTORE = True
+store = None
+# keep log entries in per ip queues in memory instead of the botlog table
+# JOURNAL is an optional file that the queued entries are also written to
+# so they can be recovered if the preprocessor is restarted
+MEMQUEUE = False
+JOURNAL = None
+queue = None
+# pool connections to leave for the threads that don't keep one for good
+# (process, the classifier helpers) on top of the shards and helper threads
+POOLSPARE = 8
+# rows the cleanup thread looks at each time it wakes up
+# and the logid it got to last time
+SCANSIZE = 5120
+scanlogid = 0
 
 def mkip(parsed):
     ip = "%s/%s" % (parsed['HTTP_HOST'], parsed['REMOTE_ADDR'])
     return ip
 
 def connect(prevconn=None):
-    """ connect to db, either with a handle that had been defined before or make a new one """
-    if prevconn != None:
-        if prevconn.closed != 0:
-            lock.acquire()
-            logging.debug("reconnecting prevconn")
-            prevconn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpw)
-            lock.release()
-        return prevconn
-    lock.acquire()
-    logging.debug("connecting")
-    conn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpw)
-    lock.release()
-    return conn
-
-def readmsgs():
     """
-    thread process that wakes up and processes log entries
-    handles the thread signalling part of the process
+    this thread's connection from the pool
+    pass the connection it had before to get a new one if that has died
     """
-    global services
-    global myips
-    global lock
-    global condition
-    global cleanupcond
-    global notbusy
-    global iplock
-    global ipprocs
+    return botpool.getconn(prevconn)
 
+def readmsgs(shard):
+    """
+    thread process that wakes up and processes log entries for one shard
+    it sleeps until poke (or the notify listener) hands it some ips
+    and only looks at those ips, anything that turns up for an ip
+    while it is being worked on pokes it again
+    """
     logging.debug("starting processor")
 
-    name = threading.current_thread().getName()
-    MAXBACKOFF = 64
     conn = connect()
 
     while True:
-        condition.acquire()
-        backoff = 0.5
-        mywork = 0
-        while mywork == 0:
-            mywork = 0
-            logging.debug("trying to find my work")
-            if name in myips:
+        localips = shard.take()
+        try:
+            for ip, whohas in localips.iteritems():
                 try:
                     conn = connect(conn)
-                    cur = conn.cursor()
-                    for ip, ipdata in myips[name].iteritems():
-                        logging.debug("looking for ip %s" % ip)
-                        cur.execute(
-                            """
-                            select count(*) from botlog 
-                            where remote_addr=%(remote_addr)s and http_host=%(http_host)s
-                            """, ipdata)
-                        count = cur.fetchone()
-                        mywork += count[0]
-                        if mywork > 0: break
-
+                    if queue != None:
+                        processqueued(whohas, conn)
+                    else:
+                        upd.processlog(whohas, 0, conn, services, store)
                 except Exception as e:
-                    logging.error(e)
-                    conn.rollback()
-                finally:
-                    cur.close()
-            if backoff <= MAXBACKOFF:
-                backoff *= 2
-            logging.debug("waiting backoff %d" % backoff)
-            condition.wait(backoff)
-            if mywork == 0:
-                cleanupcond.acquire()
-                notbusy = True
-                cleanupcond.notify()
-                cleanupcond.release()
-
-        if name in myips:
-            localips = copy.deepcopy(myips[name])
-        else:
-            localips = []
-        condition.release()
+                    logging.error("processing %s failed: %s" % (ip, e))
+        finally:
+            shard.done()
+            idle()
 
-        logcount = 1
-        while logcount != 0:
-            logcount = 0
-            try:
-                conn = connect(conn)
-                for ip, whohas in localips.iteritems():
-                    count = upd.processlog(whohas, 0, conn, services)
-                    if count != None:
-                        logcount += count
-            except Exception as e:
-                logging.error(e)
-            
-        iplock.acquire()
-        if name in myips:
-            logging.debug("carefully deleting my ips from global store")
-            if name in myips:
-                for ip, whohas in localips.iteritems():
-                    if ip in myips[name]:
-                        del(ipprocs[ip])
-                        del(myips[name][ip])
-                if len(myips[name]) == 0:
-                    del(myips[name])
-        iplock.release()
+    logging.debug("exiting")
 
-        cleanupcond.acquire()
-        notbusy = True
-        cleanupcond.notify()
-        cleanupcond.release()
+def channel(part, num):
+    """ LISTEN/NOTIFY channel for shard num of process part """
+    return "botlog%d" % (part*SHARDS + num)
 
-    logging.debug("exiting")
+def listen():
+    """
+    notify listener thread: waits for the ips process (here or in any
+    other botlogger) has put in botlog and pokes the shards that own them
+    see WAKEUP
+    """
+    logging.debug("starting listener")
+    conn = None
+    while True:
+        try:
+            if conn == None or conn.closed != 0:
+                # this thread keeps its pool connection for good
+                conn = connect(conn)
+                conn.autocommit = True
+                cur = conn.cursor()
+                for shard in shards:
+                    cur.execute("listen %s" % channel(PART, shard.num))
+                cur.close()
+                # anything sent while we weren't listening is left to cleanup
+                idle()
+            if select.select([conn], [], [], LISTENWAIT) == ([], [], []):
+                continue
+            conn.poll()
+            newips = {}
+            while conn.notifies:
+                ip = conn.notifies.pop(0).payload
+                host, addr = ip.split('/', 1)
+                newips[ip] = set_ipd(ip, host, addr)
+            if len(newips) > 0:
+                poke(newips)
+        except Exception as e:
+            logging.error("listener failed: %s" % e)
+            if conn != None and conn.closed == 0:
+                conn.close()
+            time.sleep(1)
+
+def notify(cur, conn, ips):
+    """ tell the listeners for the shards that own ips about them """
+    chans = []
+    payloads = []
+    for ip in ips:
+        part, num = botshard.partshard(ip, PARTS, SHARDS)
+        chans.append(channel(part, num))
+        payloads.append(ip)
+    cur.execute(
+        "select pg_notify(c, p) from unnest(%s::text[], %s::text[]) as t(c, p)",
+        (chans, payloads))
+    conn.commit()
+
+def idle():
+    """ let the cleanup thread know a worker has nothing to do """
+    global notbusy
+    cleanupcond.acquire()
+    notbusy = True
+    cleanupcond.notify()
+    cleanupcond.release()
 
+def processqueued(ipd, conn):
+    """
+    do stats for whatever is in the memory queue for an ip
+    """
+    rows = queue.take(ipd['ip'])
+    if len(rows) == 0:
+        return 0
+    try:
+        return upd.processrows(ipd, rows, conn, services, store)
+    except Exception as e:
+        conn.rollback()
+        logging.error("processqueued failed for %s: %s" % (ipd['ip'], e))
+    finally:
+        queue.done(rows)
+
+def parsedrow(parsed):
+    """
+    turn a parsed mod_ml message into a log entry like bottiming.botlog2dict
+    the db used to do the type conversions for us
+    """
+    return {
+        'hour': int(parsed['hour']),
+        'REMOTE_ADDR': parsed['REMOTE_ADDR'],
+        'status_line': parsed['status_line'],
+        'useragent': parsed['useragent'],
+        'epoch': int(parsed['epoch']),
+        'HTTP_HOST': parsed['HTTP_HOST'],
+        'content_type': parsed['content_type'],
+    }
 
 def startthreads():
     """
-    start log processors
+    start log processors and the cleanup thread
     """
-    global t
-    global conditions
-    global THREADCOUNT
+    global shards
+    global cleant
+    global listent
+    global store
+    global queue
+    startlock.acquire()
     try:
-        for i in range(THREADCOUNT):
-            t.append(threading.Thread(
-                name="proc%d" % (i),
-                target=readmsgs))
-            t[i].start()
+        if len(shards) > 0:
+            return
+        # the shards, cleanup, flusher and listener threads each keep
+        # a pool connection for as long as they run
+        held = SHARDS + 1
+        if STATESTORE:
+            held += 1
+        if WAKEUP == 'notify' and not MEMQUEUE:
+            held += 1
+        botpool.reserve(held, POOLSPARE)
+        if STATESTORE and store == None:
+            store = botstate.StateStore()
+            store.start()
+        if MEMQUEUE and queue == None:
+            queue = botqueue.IPQueue(journal=JOURNAL)
+        for i in range(SHARDS):
+            shard = botshard.Shard(i)
+            shard.thread = threading.Thread(
+                name=shard.name,
+                target=readmsgs, args=(shard,))
+            shard.thread.daemon = True
+            shards.append(shard)
+        for shard in shards:
+            shard.thread.start()
+        if queue != None:
+            replayed = queue.replay()
+            if len(replayed) > 0:
+                poke(dict((ip, set_ipd(ip, row['HTTP_HOST'], row['REMOTE_ADDR']))
+                            for ip, row in replayed.iteritems()))
+        if WAKEUP == 'notify' and queue == None:
+            listent = threading.Thread(name="listener", target=listen)
+            listent.daemon = True
+            listent.start()
+        cleant = threading.Thread(name="cleanup", target=cleanup)
+        cleant.daemon = True
+        cleant.start()
     except Exception as e:
         logging.error("startthreads error: %s" % (str(e)))
+    finally:
+        startlock.release()
 
 def set_ipd(ip,host,addr,thread=""):
     return {
@@ -209,39 +288,30 @@ def poke(newips):
     """
     scan through a list of ips we've seen 
     that we think need updating
-    signal to the other threads to check them out
+    hand each one to the shard that owns it and wake only that shard
     """
-    global nextt
-    global THREADCOUNT
-    global t
-    global myips
-    global ipprocs
-    global condition
     global notbusy
 
     try:
-        condition.acquire()
         logging.debug("adding some new ips")
+        byshard = {}
         for ip, ipdata in newips.iteritems():
-            if ip not in ipprocs:
-                ipdata['thread'] = t[nextt].name
-                nextt += 1
-                if nextt >= THREADCOUNT:
-                    nextt = 0
-                if ipdata['thread'] not in myips:
-                    myips[ipdata['thread']] = {}
-                ipprocs[ip] = ipdata['thread']
-                myips[ipdata['thread']][ip] = ipdata
-                logging.debug("thread %s now associated with ip %s" % (ipdata['thread'], ip))
+            part, num = botshard.partshard(ip, PARTS, len(shards))
+            if part != PART:
+                continue
+            shard = shards[num]
+            ipdata['thread'] = shard.name
+            if shard.num not in byshard:
+                byshard[shard.num] = {}
+            byshard[shard.num][ip] = ipdata
 
         notbusy = False
-        condition.notify_all()
-        condition.release()
+        for num, ips in byshard.iteritems():
+            shards[num].add(ips)
 
     except Exception as e:
         exc_type, exc_obj, tb = sys.exc_info()
-        logging.error("failed at %d: query %s exception %s" 
-                % (tb.tb_lineno, cur.query, str(e)))
+        logging.error("poke failed at %d: exception %s" % (tb.tb_lineno, str(e)))
 
 def process(messages):
     """ 
@@ -249,48 +319,174 @@ def process(messages):
     farms out work to threads
     also initiates threads if they haven't been started yet
     """
-    global t
-    global proconn
+    proconn = None
+    cur = None
     try:
 
-        if len(t) == 0:
+        if len(shards) == 0:
             startthreads()
 
+        if queue != None:
+            return processmem(messages)
+
         logging.debug("botlog connecting to database")
-        proconn = connect(proconn)
+        proconn = connect()
         cur = proconn.cursor()
         logging.debug("botlog connected to database")
 
-        newips = {}
+        rows = []
         for message in messages:
             try:
                 parsed = json.loads(message)
             except:
                 continue
+            missing = [col for col in BOTLOGCOLS if col not in parsed]
+            if len(missing) > 0:
+                logging.error("message %s missing %s" % (message.strip(), missing))
+                continue
             if parsed['hour'] == '': parsed['hour'] = 0
             logging.debug(parsed)
-            try:
-                cur.execute(
-                """insert into botlog 
-                   (hour,REMOTE_ADDR, status_line, useragent, epoch, HTTP_HOST, content_type) 
-                   values 
-                   (%(hour)s, %(REMOTE_ADDR)s, %(status_line)s, %(useragent)s, %(epoch)s, 
-                    %(HTTP_HOST)s, %(content_type)s)""", 
-                   parsed)
-                proconn.commit()
-            except:
-                proconn.rollback()
+            rows.append(parsed)
+
+        newips = {}
+        for parsed in insertbotlog(cur, proconn, rows):
             ip = mkip(parsed)
             newips[ip] = set_ipd(ip, parsed['HTTP_HOST'], parsed['REMOTE_ADDR'])
 
         logging.debug("got some ips %s" % newips)
-        poke(newips)
+        if WAKEUP == 'notify':
+            notify(cur, proconn, newips)
+        else:
+            poke(newips)
 
     except Exception as e:
-        proconn.rollback()
+        if proconn != None:
+            proconn.rollback()
         exc_type, exc_obj, tb = sys.exc_info()
-        logging.error("failed at %d: message %s query %s exception %s" 
-                % (tb.tb_lineno, message.strip(), cur.query, str(e)))
+        logging.error("failed at %d: query %s exception %s" 
+                % (tb.tb_lineno, cur.query if cur != None else None, str(e)))
+    finally:
+        if cur != None:
+            cur.close()
+        if proconn != None:
+            botpool.putconn(proconn)
+
+# fields from a mod_ml message that go into botlog
+BOTLOGCOLS = ('hour', 'REMOTE_ADDR', 'status_line', 'useragent', 'epoch', 'HTTP_HOST', 'content_type')
+BOTLOGINSERT = """insert into botlog 
+   (hour,REMOTE_ADDR, status_line, useragent, epoch, HTTP_HOST, content_type) 
+   values """
+BOTLOGROW = """(%(hour)s, %(REMOTE_ADDR)s, %(status_line)s, %(useragent)s, %(epoch)s, 
+    %(HTTP_HOST)s, %(content_type)s)"""
+
+def insertbotlog(cur, conn, rows):
+    """
+    save a batch of parsed messages to botlog with one statement and one commit
+    if that fails each row is tried on its own inside a savepoint
+    so a bad row only loses itself
+    returns the rows that were saved
+    """
+    if len(rows) == 0:
+        return rows
+    try:
+        execute_values(cur, BOTLOGINSERT+"%s", rows, template=BOTLOGROW, page_size=len(rows))
+        conn.commit()
+        return rows
+    except Exception as e:
+        conn.rollback()
+        logging.error("batch insert of %d rows failed, trying one at a time: %s" % (len(rows), e))
+
+    saved = []
+    for row in rows:
+        try:
+            cur.execute("savepoint botlogrow")
+            cur.execute(BOTLOGINSERT+BOTLOGROW, row)
+            cur.execute("release savepoint botlogrow")
+            saved.append(row)
+        except Exception as e:
+            cur.execute("rollback to savepoint botlogrow")
+            logging.error("could not save %s: %s" % (row, e))
+    conn.commit()
+    return saved
+
+def processmem(messages):
+    """
+    memory queue version of process: no db access at all
+    put blocks if the workers are too far behind
+    """
+    newips = {}
+    for message in messages:
+        try:
+            parsed = json.loads(message)
+            if parsed['hour'] == '': parsed['hour'] = 0
+            row = parsedrow(parsed)
+        except Exception as e:
+            logging.error("bad message %s: %s" % (message.strip(), e))
+            continue
+        ip = mkip(parsed)
+        queue.put(ip, row)
+        newips[ip] = set_ipd(ip, parsed['HTTP_HOST'], parsed['REMOTE_ADDR'])
+
+    logging.debug("got some ips %s" % newips)
+    poke(newips)
+
+def owned(ip):
+    """ True if some shard already has the ip waiting or in hand """
+    for shard in shards:
+        if shard.owns(ip):
+            return True
+    return False
+
+def scanbotlog(conn):
+    """
+    look for ips in botlog that may have been missed and poke them
+    each call reads the next SCANSIZE rows after scanlogid using the
+    logid primary key so the cost doesn't depend on how big botlog is
+    ips a shard already has are skipped
+    """
+    global scanlogid
+    newips = {}
+    cur = None
+    try:
+        logging.debug("cleanup checking botlog (connecting)")
+        conn = connect(conn)
+        logging.debug("cleanup checking botlog (select from %d)" % scanlogid)
+        cur = conn.cursor()
+        cur.execute(
+            """
+            select logid, HTTP_HOST, REMOTE_ADDR from botlog
+            where logid > %s order by logid limit %s
+            """, (scanlogid, SCANSIZE))
+        logging.debug("cleanup checking botlog (scan)")
+        last = None
+        for row in cur:
+            last = row[0]
+            parsed = {'HTTP_HOST':row[1],'REMOTE_ADDR':row[2]}
+            ip = mkip(parsed)
+            if ip not in newips and not owned(ip):
+                newips[ip] = set_ipd(ip, parsed['HTTP_HOST'], parsed['REMOTE_ADDR'])
+        conn.rollback()
+
+        if cur.rowcount < SCANSIZE and not upd.bt.PARTITIONED:
+            # got to the end, processed rows are deleted so start again
+            # from the top next time for anything left behind
+            scanlogid = 0
+        elif last != None:
+            # a partitioned botlog keeps processed rows so only move forward
+            scanlogid = last
+
+        if len(newips) > 0:
+            logging.debug("cleanup checking botlog (poke)")
+            poke(newips)
+
+    except Exception as e:
+        exc_type, exc_obj, tb = sys.exc_info()
+        logging.error("cleanup failed at %d: query %s exception %s" 
+                        % (tb.tb_lineno, cur.query if cur != None else None, str(e)))
+    finally:
+        if cur != None:
+            cur.close()
+    return conn
 
 def cleanup():
     """
@@ -304,32 +500,11 @@ def cleanup():
     conn = connect()
 
     while True:
-        if len(t) == 0:
-            startthreads()
-
-        newips = {}
-        try:
-            logging.debug("cleanup checking botlog (connecting)")
-            conn = connect(conn)
-            logging.debug("cleanup checking botlog (select)")
-            cur = conn.cursor()
-            # 5000 seems to be the limit for doing the query quickly on cs8
-            cur.execute("select distinct HTTP_HOST,REMOTE_ADDR from botlog limit 5120")
-            logging.debug("cleanup checking botlog (scan)")
-            for row in cur:
-                parsed = {'HTTP_HOST':row[0],'REMOTE_ADDR':row[1]}
-                ip = mkip(parsed)
-                if ip not in newips:
-                    newips[ip] = set_ipd(ip, parsed['HTTP_HOST'], parsed['REMOTE_ADDR'])
-
-            if len(newips) > 0:
-                logging.debug("cleanup checking botlog (poke)")
-                poke(newips)
-
-        except Exception as e:
-            exc_type, exc_obj, tb = sys.exc_info()
-            logging.error("cleanup failed at %d: query %s exception %s" 
-                            % (tb.tb_lineno, cur.query, str(e)))
+        if queue != None:
+            # nothing to find in botlog, just move the journal watermark on
+            queue.checkpoint(store)
+        else:
+            conn = scanbotlog(conn)
 
         logging.debug("cleanup waiting")
         cleanupcond.acquire()
@@ -338,6 +513,3 @@ def cleanup():
         notbusy = False
         cleanupcond.release()
 
-cleant = threading.Thread(name="cleanup", target=cleanup)
-cleant.start()
-
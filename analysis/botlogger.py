@@ -3,12 +3,8 @@ import sys
 import os
 import os.path
 import re
-import socket
 import hashlib
-import time
-import copy
 import logging
-import threading
 
 # logging.basicConfig(level=logging.DEBUG,
 logging.basicConfig(level=logging.ERROR, 
@@ -22,6 +18,20 @@ logging.basicConfig(level=logging.ERROR,
 """
 
 import botlog as logger
+import botprocs
+import botbatcher
+import botserver
+
+# run botlog in this many processes to use more than one core
+# 0 runs it in this process
+PROCS = int(os.environ.get('BOTLOG_PROCS', 0))
+# set BOTLOG_PARTITIONED if botlog was made with psql/botlog-partitioned.psql
+if os.environ.get('BOTLOG_PARTITIONED'):
+    logger.upd.bt.PARTITIONED = True
+# set BOTLOG_WAKEUP=notify to wake botlog's workers with LISTEN/NOTIFY
+logger.WAKEUP = os.environ.get('BOTLOG_WAKEUP', logger.WAKEUP)
+# what the batchers hand messages to: botlog or a botprocs.ProcPool
+processor = logger
 
 def read_whitelist(hostfile):
     """
@@ -78,29 +88,12 @@ def read_whitelist(hostfile):
         print  "failed reading whitelist ",hostfile," at line ",line
 
 # log messages
-DELAY = 0.01
+# a batch is processed when MAXBATCH messages are waiting or
+# the oldest one has waited MAXDELAY seconds
+MAXDELAY = 0.01
+MAXBATCH = 1000
 MAXTHREADS = 1
-t = []
-
-messages = [[] for x in range(MAXTHREADS)]
-start = [time.time() for x in range(MAXTHREADS)]
-
-def dolog(i):
-    global messages
-    global start
-    global DELAY
-
-    logging.debug("starting dolog %d", i)
-    while True:
-        if len(messages[i]) > 0 or time.time() - start[i] > DELAY:
-            if len(messages[i]) == 0: continue;
-            start[i] = time.time()
-            logging.debug("starting to process messages")
-            # note the builtin data types are thread safe
-            childmessages = copy.deepcopy(messages[i])
-            messages[i] = []
-            logger.process(childmessages)
-        time.sleep(DELAY)
+batchers = []
 
 # start the program ...
 whitelist = {} 
@@ -155,97 +148,38 @@ if argc >= 5:
         except:
             print "error reading ua classifier daemon ",uahost
 
-noncepat = re.compile("nonce=(\w*):(\w*)")
+def deliver(message):
+    """ hand a message from the server to one of the batchers """
+    global count
+    logging.debug("%d saving to %d" % (count, count % MAXTHREADS))
+    batchers[(count % MAXTHREADS)].put(message)
+    count += 1
+    if count > 1000000: count = 0
 
 # the script will loop forever until interrupted ...
 try:
     if port < 1024: raise Exception("bad port number!")
 
     print  "mod_ml listening on ", port
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_address = ('',port)
-    sock.bind(server_address)
-    sock.listen(8)
+    server = botserver.Server(port, whitelist, deliver)
+    server.listen()
+
+    # start the botlog workers now that services are set
+    if PROCS > 0:
+        processor = botprocs.ProcPool(PROCS, logger.services)
+        processor.start()
+        print "using",PROCS,"botlog processes"
+    else:
+        logger.startthreads()
 
     for i in range(MAXTHREADS):
-        t.append(threading.Thread(
-                name="process%d" % i,
-                target=dolog, args=(i,)))
-        t[i].start()
+        batchers.append(botbatcher.Batcher(processor.process, MAXBATCH, MAXDELAY))
+        batchers[i].start("process%d" % i)
 
     count = 0
-    while True: # this loop accepts a connection
-        print  "waiting for connection"
-
-        stream, client_address = sock.accept()
-
-        try:
-            if len(whitelist) == 0:
-                pass
-            elif client_address[0] in whitelist and whitelist[client_address[0]]:
-                pass
-            else:
-                print  "rejected connection from ",client_address[0] #," whitelist ",whitelist
-                continue
-        except Exception as e:
-            print  str(e)
-            print  "error checking whitelist for ",client_address[0] #," whitelist ",whitelist
-            continue
-
-        # now get the message
-        try: 
-            message = ""
-            try:
-                data = stream.recv(4096)
-                print  "got ",data
-                if data:
-                   message = message + data
-                stream.sendall("OK");
-            except:
-               pass 
-
-            print "checking ",client_address[0] # ," against whitelist ",whitelist
-            if client_address[0] in whitelist:
-                if whitelist[client_address[0]] == True:
-                    print "no pw needed"
-                    pass
-                else:
-                    print "looking for password"
-                    sha1pw = whitelist[client_address[0]]
-                    print "found encoded pw ",sha1pw
-                    m = noncepat.search(message)
-                    if m != None:
-                        nonce, salt = m.groups()
-                        print  "got nonce ",nonce," and salt ",salt," from ",client_address
-                        testnonce = hashlib.sha1(sha1pw+salt).hexdigest()
-                        print "nonce ",nonce," salt ",salt," testnonce ",testnonce
-                        if testnonce != nonce:
-                            print  "nonce failed for ",client_address
-                            continue
-                        else:
-                            print  "nonce ok for ",client_address
-                    else:
-                        print  "no nonce found in message, rejecting"
-                        continue
-
-        except Exception as e:
-             print "failed reading socket: "
-             print str(e)
-             break
-        finally:
-             stream.close()
-
-        print count," saving to ",(count % MAXTHREADS)
-        messages[(count % MAXTHREADS)].append(message)
-        count += 1
-        if count > 1000000: count = 0
-
-    for i in range(MAXTHREADS):
-        t[i].join()
+    server.serve_forever()
 
 except Exception as e:
     print str(e)
     print "failed initializing"
     sys.exit(1)
-
-
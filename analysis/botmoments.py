@@ -0,0 +1,150 @@
+"""
+ running moments for the distributions kept in botstats
+
+ bottiming.genstats recalculates n, sum, mean, var, skew and kurtosis
+ by walking the whole diffs/hourdiffs/hours list every time an ip gets
+ a new entry. the Moments class keeps the count and the sums of the 1st
+ to 4th powers of the values so that adding a value to, or dropping the
+ oldest value from, the sliding window is a handful of additions
+
+ the windows only hold ints so the power sums are kept as python ints
+ and are exact however many values come and go. the central moment sums
+ (M2, M3, M4) are worked out from them with integer arithmetic when the
+ stats are asked for and only turned into floats at the end. updating
+ float central moments in place (the pairwise formulas) lost everything
+ to cancellation once a large value left a window of small ones
+
+ momentstats turns the moment sums into the same dict genstats returns
+ so both paths share the sample size corrections
+"""
+
+def momentstats(n, s, se, ce, qe):
+    """
+    apply the sample size corrections to the moment sums
+    se, ce and qe are the sums of the squared, cubed and 4th power deviations
+    note that var is the sum of squares, not se/(n-1), as it always has been
+    """
+    n = n+0.0
+    s = s+0.0
+    m = s/n
+    var = se/(n-1.0)
+    # source for sn, kn1, kn2 sample size corrections
+    # http://www.ats.ucla.edu/stat/mult_pkg/faq/general/kurtosis.htm
+    # and http://www.itl.nist.gov/div898/handbook/eda/section3/eda35b.htm
+    if var != 0 and n > 1:
+        sn = ((n*(n-1.0))**(1/2))/(n-1.0)
+        skew = sn*(ce/n)/(var*(var**(1.0/2.0)))
+        if n > 3:
+            kn1 = (n*(n+1.0))/((n-1.0)*(n-2.0)*(n-3.0))
+            kn2 = ((n-1.0)**2.0)/((n-2.0)*(n-3.0))
+            kurt = kn1*(qe/n)/(var**2.0) - 3.0*kn2
+        else:
+            kurt = 0.0
+    else:
+        kurt = 0.0
+        skew = 0.0
+    return {'n': n, 'sum': s, 'mean': m, 'var': se, 'kurtosis': kurt, 'skew': skew}
+
+class Moments(object):
+    """
+    count and power sums for a window of ints
+    add and remove are O(1), reset is O(n) and is only needed
+    when the window is loaded from the db
+    """
+    def __init__(self, values=None):
+        self.reset(values)
+
+    def reset(self, values=None):
+        """ recalculate everything from scratch for a list of values """
+        self.n = 0
+        self.s1 = self.s2 = self.s3 = self.s4 = 0
+        # values that weren't ints, see stale
+        self.inexact = 0
+        self.removed = 0
+        if values == None:
+            return
+        for v in values:
+            self.add(v)
+
+    def add(self, x):
+        """ add one value to the window """
+        if not isinstance(x, (int, long)):
+            self.inexact += 1
+        x2 = x*x
+        self.n += 1
+        self.s1 += x
+        self.s2 += x2
+        self.s3 += x2*x
+        self.s4 += x2*x2
+
+    def remove(self, x):
+        """ take a value that was previously added out of the window """
+        if self.n <= 1:
+            self.reset()
+            return
+        x2 = x*x
+        self.n -= 1
+        self.s1 -= x
+        self.s2 -= x2
+        self.s3 -= x2*x
+        self.s4 -= x2*x2
+        self.removed += 1
+
+    def replace(self, old, new):
+        """ change one value in place - used for the hours histogram """
+        self.remove(old)
+        self.add(new)
+
+    def stale(self):
+        """
+        true if a float has been through the window and enough values have
+        been removed since the last reset that rounding may have crept in
+        the sums of ints never go stale
+        """
+        return self.inexact > 0 and self.removed >= self.n
+
+    def stats(self):
+        """ same fields as bottiming.genstats minus the list itself """
+        if self.n > 1:
+            n = self.n
+            s1 = self.s1
+            # n**k times the central moment sums, exact for ints
+            m2 = n*self.s2 - s1*s1
+            m3 = n*n*self.s3 - 3*n*s1*self.s2 + 2*s1**3
+            m4 = n**3*self.s4 - 4*n*n*s1*self.s3 + 6*n*s1*s1*self.s2 - 3*s1**4
+            return momentstats(n, s1, m2/float(n), m3/float(n*n), m4/float(n**3))
+        return None
+
+if __name__ == '__main__':
+    # check the running moments against bottiming.genstats for windows
+    # where large values leave and small ones stay behind
+    import random
+    import sys
+    from bottiming import genstats
+
+    def check(values, cap):
+        window = []
+        mom = Moments()
+        worst = 0.0
+        for v in values:
+            window.append(v)
+            mom.add(v)
+            if len(window) > cap:
+                mom.remove(window.pop(0))
+            got = mom.stats()
+            want = genstats(window)
+            if got == None or want == None:
+                continue
+            for field in ('mean', 'var', 'skew', 'kurtosis'):
+                err = abs(got[field] - want[field])/max(1.0, abs(want[field]))
+                worst = max(worst, err)
+        return worst
+
+    big = [random.randint(0, 100000) for i in range(1001)]
+    huge = [random.randint(0, 100000000) for i in range(1001)]
+    worst = 0.0
+    for start in (big, huge):
+        values = start + [7]*1001 + [7, 8]*600
+        worst = max(worst, check(values, 1000))
+    print "worst relative error %g" % worst
+    sys.exit(0 if worst < 1e-9 else 1)
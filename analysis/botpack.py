@@ -0,0 +1,167 @@
+"""
+ compact redis layout for predictions
+
+ predictions used to be saved as a string key per ip (and another per
+ host/ip) holding a number as text. redis spends far more memory on the
+ key objects than on the information: an ip is 4 (or 16) bytes and a
+ prediction fits in one signed byte
+
+ in packed mode ips are packed with inet_pton and the predictions are
+ kept in redis hashes of about PERBUCKET fields each: the field is the
+ packed ip and the value is the prediction clamped to a signed byte.
+ the hash an ip goes in is picked by crc32 of the packed ip so the
+ hashes fill up evenly however sparse the addresses are. small hashes
+ stay in redis's compact listpack encoding (hash-max-listpack-entries
+ is 128 by default) where a field costs a few bytes instead of a whole
+ key object
+
+ every load goes into a new generation of hashes (the generation and
+ the number of hashes are part of the hash names). once it is complete
+ META is pointed at it and the old generation is dropped DROPDELAY
+ seconds later, after every reader has picked up the new META, so
+ readers never see a half loaded or deleted set and ips that are no
+ longer in the predictions go away
+
+ fill-redis.py -p writes this layout and redis-botclassify.py reads it
+ when BOTCLASSIFY_PACKED is set. with the same setting
+ bottiming.get_prediction saves new predictions with put. a prediction
+ made just as a load switches generations can land in the old one and is
+ lost with it, the ip gets a new one the next time it is processed
+"""
+import logging
+import socket
+import struct
+import time
+import zlib
+
+PREFIX = "p"
+# key holding the current "generation:number of bucket hashes"
+META = PREFIX + ":buckets"
+# counter for new generations
+GENERATION = PREFIX + ":generation"
+# ips per bucket hash on average
+PERBUCKET = 100
+# seconds before readers check META again
+METACHECK = 10.0
+# seconds to keep the old generation after a load
+DROPDELAY = 3*METACHECK
+
+# (generation, number of buckets, when META was last read) for hget and put
+meta = [0, 0, 0]
+
+def packip(ip):
+    """ 4 bytes for an ipv4 address, 16 for ipv6, None if it isn't an address """
+    try:
+        if ":" in ip:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        return socket.inet_pton(socket.AF_INET, ip)
+    except (socket.error, ValueError, TypeError):
+        return None
+
+def bucket(packed, generation, nbuckets):
+    """ the hash key a packed ip is kept in """
+    return "%s%d.%d:%d" % (PREFIX, generation, nbuckets,
+                            (zlib.crc32(packed) & 0xffffffff) % nbuckets)
+
+def packvalue(pred):
+    """ a prediction as one signed byte """
+    pred = int(pred)
+    if pred > 127:
+        pred = 127
+    elif pred < -128:
+        pred = -128
+    return struct.pack("b", pred)
+
+def unpackvalue(value):
+    if value == None or len(value) != 1:
+        return None
+    return struct.unpack("b", value)[0]
+
+def readmeta(rs):
+    """ (generation, number of buckets) from META, (0, 0) if nothing is loaded """
+    value = rs.get(META)
+    if value == None:
+        return 0, 0
+    generation, nbuckets = value.split(":")
+    return int(generation), int(nbuckets)
+
+def getmeta(rs):
+    """ readmeta at most every METACHECK seconds """
+    now = time.time()
+    if now - meta[2] >= METACHECK:
+        meta[0], meta[1] = readmeta(rs)
+        meta[2] = now
+    return meta[0], meta[1]
+
+def drop(rs, generation, nbuckets, chunk=5000):
+    """ delete the hashes of a generation """
+    pipe = rs.pipeline(transaction=False)
+    for start in xrange(0, nbuckets, chunk):
+        pipe.delete(*["%s%d.%d:%d" % (PREFIX, generation, nbuckets, n)
+                        for n in xrange(start, min(nbuckets, start+chunk))])
+    pipe.execute()
+
+def hset(rs, totals, chunk=5000, dropdelay=DROPDELAY):
+    """
+    save a dict of ip => prediction in the packed layout as a new generation
+    each ip is an HSET, chunk of them per pipeline
+    waits dropdelay seconds before dropping the old generation
+    returns the number of ips that weren't addresses
+    """
+    nbuckets = max(1, len(totals) // PERBUCKET)
+    generation = rs.incr(GENERATION)
+    pipe = rs.pipeline(transaction=False)
+    bad = 0
+    count = 0
+    for ip, pred in totals.iteritems():
+        packed = packip(ip)
+        if packed == None:
+            bad += 1
+            continue
+        pipe.hset(bucket(packed, generation, nbuckets), packed, packvalue(pred))
+        count += 1
+        if count % chunk == 0:
+            pipe.execute()
+    pipe.execute()
+    oldgeneration, oldbuckets = readmeta(rs)
+    rs.set(META, "%d:%d" % (generation, nbuckets))
+    logging.info("saved %d ips in %d buckets as generation %d" % (count, nbuckets, generation))
+    if oldbuckets > 0:
+        logging.info("dropping generation %d in %ds" % (oldgeneration, dropdelay))
+        time.sleep(dropdelay)
+        drop(rs, oldgeneration, oldbuckets, chunk)
+    return bad
+
+def put(rs, pipe, ip, pred):
+    """
+    queue an HSET for one prediction on pipe (a pipeline of rs)
+    returns False if ip isn't an address or nothing has been loaded yet
+    """
+    generation, nbuckets = getmeta(rs)
+    packed = packip(ip)
+    if nbuckets == 0 or packed == None:
+        return False
+    pipe.hset(bucket(packed, generation, nbuckets), packed, packvalue(pred))
+    return True
+
+def hget(rs, ips):
+    """ the predictions for a list of ips in one round trip, a dict of the ones found """
+    found = {}
+    generation, nbuckets = getmeta(rs)
+    if nbuckets == 0:
+        return found
+    pipe = rs.pipeline(transaction=False)
+    asked = []
+    for ip in ips:
+        packed = packip(ip)
+        if packed == None:
+            continue
+        pipe.hget(bucket(packed, generation, nbuckets), packed)
+        asked.append(ip)
+    if len(asked) == 0:
+        return found
+    for ip, value in zip(asked, pipe.execute()):
+        pred = unpackvalue(value)
+        if pred != None:
+            found[ip] = pred
+    return found
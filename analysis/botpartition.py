@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+ look after the partitions of a partitioned botlog
+ see psql/botlog-partitioned.psql and bottiming.PARTITIONED
+
+ botlog is split into ranges of PARTSIZE logids called botlog_{start}
+ this makes sure there are AHEAD empty partitions past the current value
+ of the logid sequence and drops any partition that new rows can no
+ longer go into once every row in it has been processed, that is once
+ botlatest.logid for each of its ips is at least as big as the row's logid
+
+ run it once after loading the schema and then every few minutes, e.g.
+ */5 * * * * cd /path/to/analysis && ./botpartition.py
+"""
+import logging
+import re
+import sys
+
+import botpool
+
+# logids per partition
+PARTSIZE = 1000000
+# partitions to keep ready past the current logid
+AHEAD = 2
+
+partpat = re.compile("^botlog_(\d+)$")
+
+def partitions(cur):
+    """ start logids of the existing botlog partitions, oldest first """
+    cur.execute(
+        """
+        select c.relname from pg_inherits i
+        join pg_class c on c.oid = i.inhrelid
+        join pg_class p on p.oid = i.inhparent
+        where p.relname = 'botlog'
+        """)
+    starts = []
+    for row in cur:
+        m = partpat.match(row[0])
+        if m != None:
+            starts.append(int(m.group(1)))
+    return sorted(starts)
+
+def currentlogid(cur):
+    cur.execute("select last_value from botlog_logid_seq")
+    return cur.fetchone()[0]
+
+def create(cur, start):
+    logging.info("creating botlog_%d" % start)
+    cur.execute(
+        "create table if not exists botlog_%d partition of botlog "
+        "for values from (%d) to (%d)" % (start, start, start+PARTSIZE))
+
+def processed(cur, start):
+    """ True if every row in the partition is at or before its ip's botlatest.logid """
+    cur.execute(
+        """
+        select 1 from botlog_%d b
+        left join botlatest l
+            on l.http_host = b.http_host and l.remote_addr = b.remote_addr
+        where l.logid is null or b.logid > l.logid
+        limit 1
+        """ % start)
+    return cur.rowcount == 0
+
+def rotate(conn):
+    """ make the partitions we need and drop the ones we are done with """
+    cur = conn.cursor()
+    try:
+        current = currentlogid(cur)
+        starts = partitions(cur)
+        first = (current // PARTSIZE) * PARTSIZE
+        for start in range(first, first + (AHEAD+1)*PARTSIZE, PARTSIZE):
+            if start not in starts:
+                create(cur, start)
+        conn.commit()
+
+        dropped = 0
+        for start in starts:
+            # rows can still be added to partitions at or after the current one
+            if start + PARTSIZE > current:
+                break
+            if not processed(cur, start):
+                logging.debug("botlog_%d still has rows to process" % start)
+                break
+            logging.info("dropping botlog_%d" % start)
+            cur.execute("drop table botlog_%d" % start)
+            conn.commit()
+            dropped += 1
+        return dropped
+    except Exception as e:
+        conn.rollback()
+        logging.error("rotate failed: %s" % e)
+        raise
+    finally:
+        cur.close()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    conn = botpool.getconn()
+    try:
+        rotate(conn)
+    except Exception as e:
+        sys.exit(1)
+    finally:
+        botpool.putconn(conn)
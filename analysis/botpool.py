@@ -0,0 +1,229 @@
+"""
+ shared pool of postgres connections
+
+ botlog, bottiming, log and the classifier servers each used to make
+ their own connections, often one per batch. a Pool keeps up to
+ dbmaxconn connections (see mldb) open and hands them out per thread:
+ a thread that asks again while it already has one gets the same
+ connection back, so nested calls don't use up the pool. connections
+ that come back in a failed transaction are rolled back and ones that
+ have been idle for a while are checked with a cheap query before they
+ are reused
+
+ use it like this:
+
+    conn = botpool.getconn()
+    try:
+        ...
+    finally:
+        botpool.putconn(conn)
+
+ or "with botpool.connection() as conn:"
+ long running threads can simply keep the connection from getconn and
+ call getconn(conn) again to get a working one if it has died
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from mldb import dbname, dbuser, dbpw, dbminconn, dbmaxconn
+
+# check idle connections that haven't been used for this many seconds
+CHECKAGE = 30
+# seconds to wait for a free connection before giving up
+WAIT = 30
+
+class PoolError(Exception):
+    pass
+
+class Pool(object):
+    def __init__(self, minconn=dbminconn, maxconn=dbmaxconn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.cond = threading.Condition()
+        # (conn, time it was returned)
+        self.idle = []
+        # number of connections open, idle or checked out
+        self.count = 0
+        self.local = threading.local()
+        self.pid = os.getpid()
+        for i in range(minconn):
+            self.idle.append((self.connect(), time.time()))
+            self.count += 1
+
+    def connect(self):
+        logging.debug("pool connecting")
+        return psycopg2.connect(dbname=dbname, user=dbuser, password=dbpw)
+
+    def reserve(self, held, spare):
+        """
+        make room for held connections that threads keep for good plus
+        spare for everyone else, otherwise the long running threads use up
+        maxconn and the rest wait WAIT seconds and get a PoolError
+        """
+        self.cond.acquire()
+        try:
+            if self.maxconn < held + spare:
+                logging.info("pool maxconn %d is too small for %d long running threads, using %d" 
+                                % (self.maxconn, held, held + spare))
+                self.maxconn = held + spare
+                self.cond.notify_all()
+            return self.maxconn
+        finally:
+            self.cond.release()
+
+    def healthy(self, conn, since):
+        """ is an idle connection still usable """
+        if conn.closed != 0:
+            return False
+        if time.time() - since < CHECKAGE:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("select 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logging.debug("pool dropping dead connection: %s" % e)
+            return False
+
+    def getconn(self, prevconn=None):
+        """
+        this thread's connection, checked out of the pool if it doesn't have one
+        pass the connection you had before to swap it for a working one if it
+        has been closed
+        """
+        held = getattr(self.local, 'conn', None)
+        if held != None and held.closed != 0:
+            self.discard(held)
+            held = None
+        if held != None:
+            if held is not prevconn:
+                self.local.depth += 1
+            return held
+
+        conn = self.checkout()
+        self.local.conn = conn
+        self.local.depth = 1
+        return conn
+
+    def checkout(self):
+        deadline = time.time() + WAIT
+        self.cond.acquire()
+        try:
+            while True:
+                while len(self.idle) > 0:
+                    conn, since = self.idle.pop()
+                    if self.healthy(conn, since):
+                        return conn
+                    self.count -= 1
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                if self.count < self.maxconn:
+                    self.count += 1
+                    break
+                left = deadline - time.time()
+                if left <= 0:
+                    raise PoolError("no free connections after %d seconds" % WAIT)
+                self.cond.wait(left)
+        finally:
+            self.cond.release()
+
+        # connect without holding the lock
+        try:
+            return self.connect()
+        except Exception:
+            self.cond.acquire()
+            self.count -= 1
+            self.cond.notify()
+            self.cond.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        """ give back a connection from getconn """
+        if getattr(self.local, 'conn', None) is not conn:
+            logging.error("putconn called for a connection this thread doesn't have")
+            return
+        self.local.depth -= 1
+        if self.local.depth > 0 and not close:
+            return
+        self.local.conn = None
+        self.local.depth = 0
+        if close or conn.closed != 0:
+            self.discard(conn)
+            return
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            self.discard(conn)
+            return
+        self.cond.acquire()
+        self.idle.append((conn, time.time()))
+        self.cond.notify()
+        self.cond.release()
+
+    def discard(self, conn):
+        """ close a connection and let someone else make a new one """
+        if getattr(self.local, 'conn', None) is conn:
+            self.local.conn = None
+            self.local.depth = 0
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.cond.acquire()
+        self.count -= 1
+        self.cond.notify()
+        self.cond.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+pool = None
+poollock = threading.Lock()
+# pools from a parent process, see getpool
+inherited = []
+
+def getpool():
+    """
+    the process wide pool, made the first time it is needed
+    a forked child gets a new pool: it can't use its parent's connections
+    and mustn't close them either so the old pool is just kept around
+    """
+    global pool
+    if pool == None or pool.pid != os.getpid():
+        poollock.acquire()
+        try:
+            if pool != None and pool.pid != os.getpid():
+                inherited.append(pool)
+                pool = None
+            if pool == None:
+                pool = Pool()
+        finally:
+            poollock.release()
+    return pool
+
+def getconn(prevconn=None):
+    return getpool().getconn(prevconn)
+
+def putconn(conn, close=False):
+    getpool().putconn(conn, close)
+
+def connection():
+    return getpool().connection()
+
+def reserve(held, spare):
+    return getpool().reserve(held, spare)
@@ -0,0 +1,91 @@
+"""
+ server side prepared statements for the queries run for every ip batch
+
+ the botlog select and delete and the botstats/botlatest reads and
+ updates are the same few statements over and over. postgres parses
+ and plans each one every time it is sent as plain text. a Statement is
+ written with the usual %(name)s parameters, turned into a
+ PREPARE ... AS with $1, $2 ... the first time it is used on a connection
+ and after that sent as EXECUTE with just the values
+
+ which statements have been prepared is kept per connection in a
+ WeakKeyDictionary so a connection that is dropped from botpool simply
+ falls out and a new one prepares them again
+
+ set PREPARED to False to send the plain statements, e.g. when going
+ through a pooler like pgbouncer in transaction mode where the session
+ (and its prepared statements) can change from one query to the next
+"""
+import re
+import threading
+import weakref
+
+PREPARED = True
+# sqlstate for "prepared statement does not exist"
+INVALID_NAME = '26000'
+
+parampat = re.compile("%\((\w+)\)s")
+
+# connection => names of the statements prepared on it
+prepared = weakref.WeakKeyDictionary()
+lock = threading.Lock()
+
+class Statement(object):
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.keys = []
+        self.prepare = "prepare %s as %s" % (name, parampat.sub(self.number, sql))
+        self.execute = "execute %s" % name
+        if len(self.keys) > 0:
+            self.execute += " (%s)" % ",".join(["%s"] * len(self.keys))
+
+    def number(self, m):
+        """ replace a %(name)s with its $n, the same name always gets the same n """
+        key = m.group(1)
+        if key not in self.keys:
+            self.keys.append(key)
+        return "$%d" % (self.keys.index(key) + 1)
+
+    def args(self, params):
+        return [params[key] for key in self.keys]
+
+def isprepared(conn, name):
+    lock.acquire()
+    try:
+        return name in prepared.get(conn, ())
+    finally:
+        lock.release()
+
+def setprepared(conn, name):
+    lock.acquire()
+    try:
+        if conn not in prepared:
+            prepared[conn] = set()
+        prepared[conn].add(name)
+    finally:
+        lock.release()
+
+def forget(conn, name):
+    lock.acquire()
+    try:
+        prepared.get(conn, set()).discard(name)
+    finally:
+        lock.release()
+
+def execute(cur, stmt, params):
+    """ run a Statement with a dict of parameters on a cursor """
+    if not PREPARED:
+        cur.execute(stmt.sql, params)
+        return
+    conn = cur.connection
+    if not isprepared(conn, stmt.name):
+        cur.execute(stmt.prepare)
+        setprepared(conn, stmt.name)
+    try:
+        cur.execute(stmt.execute, stmt.args(params))
+    except Exception as e:
+        # the session lost it somehow (e.g. DISCARD ALL), prepare it again next time
+        if getattr(e, 'pgcode', None) == INVALID_NAME:
+            forget(conn, stmt.name)
+        raise
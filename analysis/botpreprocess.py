@@ -6,7 +6,6 @@ import re
 import socket
 import hashlib
 import time
-import copy
 import logging
 import threading
 
@@ -23,6 +22,7 @@ logging.basicConfig(level=logging.DEBUG,
 
 import log          # handles initial of putting a row into a buffer table
 import bottiming    # handles collecting timing stats from logged data
+import botbatcher
 
 def read_whitelist(hostfile):
     """
@@ -79,27 +79,11 @@ def read_whitelist(hostfile):
         print  "failed reading whitelist ",hostfile," at line ",line
 
 # log messages
+# log.process is slow enough that it pays to wait for bigger batches
+MAXDELAY = 1.0
+MAXBATCH = 1000
 MAXTHREADS = 1
-t = []
-
-messages = [[] for x in range(MAXTHREADS)]
-start = [time.time() for x in range(MAXTHREADS)]
-
-def dolog(i):
-    global messages
-    global start
-
-    logging.debug("starting dolog %d", i)
-    while True:
-        if len(messages[i]) > 0 or time.time() - start[i] > 5.0:
-            if len(messages[i]) == 0: continue;
-            start[i] = time.time()
-            logging.debug("starting to process messages")
-            # note the builtin data types are thread safe
-            childmessages = copy.deepcopy(messages[i])
-            messages[i] = []
-            log.process(childmessages)
-        time.sleep(1)
+batchers = []
 
 def doupdate():
     logging.debug("starting")
@@ -146,10 +130,8 @@ try:
     sock.listen(1)
 
     for i in range(MAXTHREADS):
-        t.append(threading.Thread(
-                name="process%d" % i,
-                target=dolog, args=(i,)))
-        t[i].start()
+        batchers.append(botbatcher.Batcher(log.process, MAXBATCH, MAXDELAY))
+        batchers[i].start("process%d" % i)
     ut = threading.Thread(name="updater",target=doupdate)
     ut.start()
 
@@ -219,13 +201,11 @@ try:
         finally:
              stream.close()
 
-        messages[(count % MAXTHREADS)].append(message)
+        batchers[(count % MAXTHREADS)].put(message)
         count += 1
         if count > 1000000: count = 0
 
     ut.join()
-    for i in range(MAXTHREADS):
-        t[i].join()
 
 except Exception as e:
     print str(e)
@@ -0,0 +1,107 @@
+"""
+ run botlog in several processes
+
+ botlog's workers are threads so all the stats work for a preprocessor
+ shares one python interpreter and the GIL keeps it to about one core.
+ a ProcPool forks PROCS processes that each run their own copy of botlog
+ (workers, state store, memory queue and db connections) and sends each
+ message to the process that owns its ip
+
+ ips are split over the processes by the same crc32 hash range as the
+ botlog shards (see botshard.partshard) so an ip is only ever handled by
+ one process and each process can keep its own state for its ips
+
+ botlogger uses this instead of calling botlog.process directly when
+ PROCS is more than 0
+"""
+import json
+import logging
+import multiprocessing
+import sys
+
+import botshard
+
+try:
+    PROCS = multiprocessing.cpu_count()
+except NotImplementedError:
+    PROCS = 4
+# batches of messages that can be waiting for each process
+# process blocks when a child is this far behind
+MAXBATCHES = 1000
+
+def mkip(message):
+    """ the ip key for a raw mod_ml message or None if it can't be parsed """
+    try:
+        parsed = json.loads(message)
+        return "%s/%s" % (parsed['HTTP_HOST'], parsed['REMOTE_ADDR'])
+    except:
+        return None
+
+def child(part, parts, shards, queue, services):
+    """
+    main loop of a worker process: hand batches to this process's botlog
+    botlog is set up here, after the fork, so each process gets its
+    own threads and connections
+    """
+    import botlog
+    botlog.PART = part
+    botlog.PARTS = parts
+    botlog.SHARDS = shards
+    botlog.services.update(services)
+    if botlog.JOURNAL != None:
+        botlog.JOURNAL = "%s.%d" % (botlog.JOURNAL, part)
+    botlog.startthreads()
+    logging.debug("botlog process %d of %d started" % (part, parts))
+    while True:
+        messages = queue.get()
+        if messages == None:
+            break
+        try:
+            botlog.process(messages)
+        except Exception as e:
+            exc_type, exc_obj, tb = sys.exc_info()
+            logging.error("botlog process %d failed at %d: %s" % (part, tb.tb_lineno, str(e)))
+
+class ProcPool(object):
+    """ botlog.process spread over several processes """
+    def __init__(self, procs=PROCS, services=None, shards=None):
+        import botlog
+        self.procs = procs
+        self.services = dict(services or botlog.services)
+        # split the cores between the processes
+        if shards == None:
+            shards = max(1, botlog.SHARDS // procs)
+        self.shards = shards
+        self.queues = []
+        self.children = []
+
+    def start(self):
+        for i in range(self.procs):
+            queue = multiprocessing.Queue(MAXBATCHES)
+            p = multiprocessing.Process(
+                name="botlog%d" % i, target=child,
+                args=(i, self.procs, self.shards, queue, self.services))
+            p.daemon = True
+            p.start()
+            self.queues.append(queue)
+            self.children.append(p)
+
+    def process(self, messages):
+        """ same as botlog.process but sends each message to its ip's process """
+        batches = [[] for i in range(self.procs)]
+        for message in messages:
+            ip = mkip(message)
+            if ip == None:
+                logging.error("bad message %s" % message.strip())
+                continue
+            batches[botshard.shardfor(ip, self.procs)].append(message)
+        for i, batch in enumerate(batches):
+            if len(batch) > 0:
+                self.queues[i].put(batch)
+
+    def stop(self):
+        """ let the children finish what they have queued and exit """
+        for queue in self.queues:
+            queue.put(None)
+        for p in self.children:
+            p.join()
@@ -0,0 +1,295 @@
+"""
+ persistent connections for the preprocessor and its helper services
+
+ the original protocol is one tcp connection per message: connect, send,
+ shutdown the write side, read the answer and close. under load the
+ handshakes and the sockets left in TIME_WAIT cost more than the work
+
+ persistent mode starts with the client sending HELLO. a server that
+ knows the protocol answers with HELLO and after that each request is one
+ line of json {"id": n, "data": "..."} and each answer is one line
+ {"id": n, "reply": "..."}. answers can come back in any order and many
+ requests can be waiting on the same connection at once
+
+ before connecting Client sends HELLO on a probe connection and shuts
+ down its write side straight away. an old one shot server (an older
+ botlogger or botlabelonline) then answers at once with something else
+ and a new one still answers HELLO, so neither keeps us waiting. the
+ probe and the connect are done without the client's lock, callers use
+ the one shot protocol in the meantime. if the server doesn't do
+ persistent connections the probe is tried again after RETRY seconds,
+ doubling up to MAXRETRY, so an old server only sees the odd HELLO
+
+ vowpal wabbit daemons already answer one line per example line on an
+ open connection so LineClient simply keeps the socket open
+"""
+import json
+import logging
+import socket
+import threading
+import time
+
+HELLO = "MLPROTO 1\n"
+# seconds to wait for a connection or an answer
+TIMEOUT = 5.0
+# bytes to read at a time
+READSIZE = 65536
+# seconds to wait for the answer to HELLO
+HELLOTIMEOUT = 1.0
+# seconds before trying HELLO again on a server that didn't answer it
+# doubled each time it fails up to MAXRETRY
+RETRY = 60.0
+MAXRETRY = 3600.0
+
+def oneshot(addr, data, reply=True, timeout=TIMEOUT):
+    """
+    the original protocol: new connection, send, shutdown, read, close
+    returns the answer or None if reply is False
+    """
+    s = socket.create_connection(addr, timeout)
+    try:
+        s.sendall(data)
+        s.shutdown(socket.SHUT_WR)
+        if not reply:
+            return None
+        return s.recv(1024)
+    finally:
+        s.close()
+
+def request(id, data):
+    """ one persistent mode request line """
+    return json.dumps({'id': id, 'data': data})+"\n"
+
+def response(id, reply):
+    """ one persistent mode answer line """
+    return json.dumps({'id': id, 'reply': reply})+"\n"
+
+def splitlines(buf):
+    """ split complete lines off buf, returns the lines and the rest """
+    if "\n" not in buf:
+        return [], buf
+    lines = buf.split("\n")
+    return lines[:-1], lines[-1]
+
+class Client(object):
+    """
+    one persistent connection to a service that can be shared by threads
+    call returns the answer to data, or None if there wasn't one
+    """
+    def __init__(self, addr, timeout=TIMEOUT):
+        self.addr = addr
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # only one thread writes to the socket at a time
+        self.sendlock = threading.Lock()
+        self.sock = None
+        # use the one shot protocol until this time, see connect
+        self.oneshotuntil = 0
+        self.retry = RETRY
+        # True while a thread is connecting
+        self.connecting = False
+        self.nextid = 0
+        # request id => [event, answer]
+        self.waiting = {}
+        self.reader = None
+
+    def hello(self, s):
+        """ send HELLO on s and True if the answer is HELLO """
+        try:
+            s.sendall(HELLO)
+            answer = ""
+            while not answer.endswith("\n") and len(answer) < len(HELLO):
+                data = s.recv(len(HELLO))
+                if not data:
+                    break
+                answer += data
+        except socket.error:
+            answer = ""
+        return answer == HELLO
+
+    def connect(self):
+        """
+        open a persistent connection, returns None if the server
+        doesn't do them, call without the lock
+        """
+        probe = socket.create_connection(self.addr, HELLOTIMEOUT)
+        try:
+            probe.sendall(HELLO)
+            probe.shutdown(socket.SHUT_WR)
+            answer = ""
+            while len(answer) < len(HELLO):
+                data = probe.recv(len(HELLO))
+                if not data:
+                    break
+                answer += data
+        except socket.error:
+            answer = ""
+        finally:
+            probe.close()
+        s = None
+        if answer == HELLO:
+            s = socket.create_connection(self.addr, HELLOTIMEOUT)
+            if not self.hello(s):
+                s.close()
+                s = None
+        if s == None:
+            logging.debug("%s doesn't do persistent connections, will try again in %ds" 
+                            % (self.addr, self.retry))
+            self.oneshotuntil = time.time() + self.retry
+            self.retry = min(self.retry*2, MAXRETRY)
+            return None
+        self.retry = RETRY
+        s.settimeout(None)
+        return s
+
+    def read(self, s):
+        """ reader thread: hand answers to whoever is waiting for them """
+        buf = ""
+        while True:
+            try:
+                data = s.recv(READSIZE)
+            except socket.error:
+                data = ""
+            if not data:
+                break
+            lines, buf = splitlines(buf+data)
+            for line in lines:
+                try:
+                    answer = json.loads(line)
+                except ValueError:
+                    continue
+                self.lock.acquire()
+                w = self.waiting.pop(answer.get('id'), None)
+                self.lock.release()
+                if w != None:
+                    w[1] = answer.get('reply')
+                    w[0].set()
+        self.lock.acquire()
+        if self.sock == s:
+            self.sock = None
+        # wake anyone still waiting on this connection
+        for w in self.waiting.itervalues():
+            w[0].set()
+        self.waiting = {}
+        self.lock.release()
+        s.close()
+
+    def call(self, data, reply=True):
+        """ send data and wait for the answer """
+        self.lock.acquire()
+        s = self.sock
+        connect = s == None and not self.connecting and time.time() >= self.oneshotuntil
+        if connect:
+            self.connecting = True
+        self.lock.release()
+
+        if connect:
+            failed = False
+            try:
+                s = self.connect()
+            except socket.error as e:
+                logging.error("connecting to %s failed: %s" % (self.addr, e))
+                failed = True
+            self.lock.acquire()
+            self.connecting = False
+            if s != None:
+                self.sock = s
+                self.reader = threading.Thread(name="reader%s" % (self.addr,), 
+                                                target=self.read, args=(s,))
+                self.reader.daemon = True
+                self.reader.start()
+            self.lock.release()
+            if failed:
+                return None
+
+        if s == None:
+            return oneshot(self.addr, data, reply, self.timeout)
+
+        w = [threading.Event(), None]
+        self.lock.acquire()
+        self.nextid += 1
+        id = self.nextid
+        if reply:
+            self.waiting[id] = w
+        self.lock.release()
+        try:
+            self.sendlock.acquire()
+            try:
+                s.sendall(request(id, data))
+            finally:
+                self.sendlock.release()
+        except socket.error as e:
+            logging.error("sending to %s failed: %s" % (self.addr, e))
+            self.lock.acquire()
+            self.waiting.pop(id, None)
+            if self.sock == s:
+                self.shutdown()
+            self.lock.release()
+            return None
+        if not reply:
+            return None
+
+        w[0].wait(self.timeout)
+        if not w[0].is_set():
+            self.lock.acquire()
+            self.waiting.pop(id, None)
+            self.lock.release()
+        return w[1]
+
+    def shutdown(self):
+        """ make the reader thread drop the connection, call with the lock held """
+        if self.sock != None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock = None
+
+    def close(self):
+        self.lock.acquire()
+        self.shutdown()
+        self.lock.release()
+
+class LineClient(object):
+    """
+    persistent connection to a line at a time service like a vw daemon
+    not thread safe, give each thread its own
+    """
+    def __init__(self, addr, timeout=TIMEOUT):
+        self.addr = addr
+        self.timeout = timeout
+        self.sock = None
+        self.buf = ""
+
+    def call(self, line, reply=True):
+        """ send one line and optionally read one back, reconnects once on failure """
+        if not line.endswith("\n"):
+            line += "\n"
+        for attempt in (0, 1):
+            try:
+                if self.sock == None:
+                    self.sock = socket.create_connection(self.addr, self.timeout)
+                    self.buf = ""
+                self.sock.sendall(line)
+                if not reply:
+                    return None
+                return self.readline()
+            except socket.error as e:
+                self.close()
+                if attempt == 1:
+                    raise
+
+    def readline(self):
+        while "\n" not in self.buf:
+            data = self.sock.recv(READSIZE)
+            if not data:
+                raise socket.error("connection to %s closed" % (self.addr,))
+            self.buf += data
+        line, self.buf = self.buf.split("\n", 1)
+        return line
+
+    def close(self):
+        if self.sock != None:
+            self.sock.close()
+        self.sock = None
+        self.buf = ""
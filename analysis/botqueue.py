@@ -0,0 +1,240 @@
+"""
+ in memory replacement for the botlog table
+
+ normally botlog.process inserts every message into botlog and the
+ worker threads count, select and then delete the rows for their ips
+ which uses postgres as a message queue. an IPQueue keeps the parsed
+ log entries in a list per ip instead. the workers take the whole list
+ for an ip at once
+
+ the total number of queued entries is limited to maxsize: put blocks
+ until the workers have caught up which pushes back on botlogger
+
+ if a journal file is given every entry is appended to it before it is
+ queued. on startup the journal is read back in so that nothing is lost
+ if the preprocessor dies. logids carry on from the journal so they only
+ ever go up. checkpoint appends a {"flushed": logid} line once every entry
+ up to that logid has been processed and (with a StateStore) the flush
+ that covers it has committed, and fsyncs the journal. replay skips the
+ entries at or below the last of these so nothing is counted twice
+
+ the journal is emptied when everything in it is done and rewritten with
+ only the entries after the watermark once it gets past JOURNALSIZE bytes
+ so it doesn't grow without bound under steady load
+"""
+import json
+import logging
+import os
+import threading
+
+# default limit on queued entries
+MAXQUEUED = 100000
+# rewrite the journal when it gets this big
+JOURNALSIZE = 64*1024*1024
+
+class IPQueue(object):
+    def __init__(self, maxsize=MAXQUEUED, journal=None):
+        self.maxsize = maxsize
+        self.queues = {}
+        self.total = 0
+        # entries that have been taken but not finished with
+        self.inflight = 0
+        self.lock = threading.Lock()
+        self.notfull = threading.Condition(self.lock)
+        # first logid of each list that has been taken => number of rows
+        self.taken = {}
+        # fake logids so entries can still be ordered and identified
+        self.logid = 0
+        # every entry up to this logid is in the db
+        self.flushed = 0
+        # (store mark, processed logid) waiting for the store to flush
+        self.marks = []
+        self.journalname = journal
+        self.journal = None
+        if journal != None:
+            self.journal = open(journal, "a")
+
+    def put(self, ip, row, journal=True, wait=True):
+        """
+        queue a log entry (a dict like bottiming.botlog2dict makes) for an ip
+        blocks while the queues are full unless wait is False
+        """
+        self.notfull.acquire()
+        try:
+            while wait and self.total >= self.maxsize:
+                logging.debug("queue full, waiting")
+                self.notfull.wait(1.0)
+            self.logid += 1
+            row['logid'] = self.logid
+            if journal and self.journal != None:
+                self.journal.write(json.dumps(row)+"\n")
+                self.journal.flush()
+            self.append(ip, row)
+        finally:
+            self.notfull.release()
+
+    def append(self, ip, row):
+        """ queue a row that already has its logid, call with the lock held """
+        if ip not in self.queues:
+            self.queues[ip] = []
+        self.queues[ip].append(row)
+        self.total += 1
+
+    def count(self, ip):
+        """ how many entries are waiting for an ip """
+        q = self.queues.get(ip)
+        if q == None:
+            return 0
+        return len(q)
+
+    def take(self, ip):
+        """ remove and return everything queued for an ip, oldest first """
+        self.notfull.acquire()
+        try:
+            rows = self.queues.pop(ip, [])
+            self.total -= len(rows)
+            self.inflight += len(rows)
+            if len(rows) > 0:
+                self.taken[rows[0]['logid']] = len(rows)
+            self.notfull.notify_all()
+            return rows
+        finally:
+            self.notfull.release()
+
+    def done(self, rows):
+        """ call when the rows from take have been processed """
+        self.notfull.acquire()
+        self.inflight -= len(rows)
+        if len(rows) > 0:
+            self.taken.pop(rows[0]['logid'], None)
+        self.notfull.release()
+
+    def empty(self):
+        return self.total == 0
+
+    def processed(self):
+        """
+        the logid that every entry up to has been processed
+        call with the lock held
+        """
+        first = self.logid + 1
+        for rows in self.queues.itervalues():
+            if rows[0]['logid'] < first:
+                first = rows[0]['logid']
+        for logid in self.taken:
+            if logid < first:
+                first = logid
+        return first - 1
+
+    def replay(self):
+        """
+        read the journal back into the queues
+        entries at or below the last flushed watermark are skipped
+        this ignores maxsize as nothing is taking entries off yet
+        returns the ips that now have entries waiting
+        """
+        ips = {}
+        if self.journalname == None or not os.path.isfile(self.journalname):
+            return ips
+        rows = []
+        with open(self.journalname, "r") as journal:
+            for line in journal:
+                try:
+                    row = json.loads(line)
+                except:
+                    continue
+                if 'flushed' in row:
+                    self.flushed = max(self.flushed, row['flushed'])
+                    continue
+                rows.append(row)
+        self.notfull.acquire()
+        try:
+            self.logid = max(self.logid, self.flushed)
+            for row in rows:
+                logid = row.get('logid', 0)
+                if logid <= self.flushed:
+                    continue
+                if logid <= self.logid:
+                    # from a journal written before logids were kept
+                    self.logid += 1
+                    row['logid'] = self.logid
+                else:
+                    self.logid = logid
+                ip = "%s/%s" % (row['HTTP_HOST'], row['REMOTE_ADDR'])
+                self.append(ip, row)
+                ips[ip] = row
+        finally:
+            self.notfull.release()
+        logging.debug("replayed %d entries after %d from %s" 
+                        % (self.total, self.flushed, self.journalname))
+        return ips
+
+    def checkpoint(self, store=None):
+        """
+        move the flushed watermark up to the entries that are in the db
+        store is the botstate.StateStore the rows are saved through if any,
+        without one processed rows are already committed
+        empties the journal if nothing is left to do or rewrites it if
+        it has got too big
+        """
+        if self.journal == None:
+            return False
+        self.notfull.acquire()
+        try:
+            processed = self.processed()
+            if store == None:
+                flushed = processed
+            else:
+                # rows processed so far are in the store, they are in the
+                # db once the flush after this mark commits
+                if len(self.marks) == 0 or processed > self.marks[-1][1]:
+                    self.marks.append((store.mark(), processed))
+                flushed = self.flushed
+                while len(self.marks) > 0 and store.flushed(self.marks[0][0]):
+                    flushed = max(flushed, self.marks.pop(0)[1])
+            if flushed > self.flushed:
+                self.flushed = flushed
+                self.journal.write(json.dumps({'flushed': flushed})+"\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+            if self.flushed >= self.logid and self.total == 0 and self.inflight == 0:
+                self.journal.truncate(0)
+                self.journal.seek(0)
+                os.fsync(self.journal.fileno())
+                return True
+            if self.journal.tell() > JOURNALSIZE:
+                self.rotate()
+            return False
+        finally:
+            self.notfull.release()
+
+    def rotate(self):
+        """
+        rewrite the journal with the watermark and the entries after it
+        call with the lock held
+        """
+        tmpname = "%s.tmp" % self.journalname
+        self.journal.close()
+        kept = 0
+        with open(self.journalname, "r") as journal:
+            with open(tmpname, "w") as tmp:
+                tmp.write(json.dumps({'flushed': self.flushed})+"\n")
+                for line in journal:
+                    # entries are written in logid order, once one is past
+                    # the watermark the rest are too
+                    if kept == 0:
+                        try:
+                            row = json.loads(line)
+                        except:
+                            continue
+                        if row.get('logid', 0) <= self.flushed:
+                            continue
+                    tmp.write(line)
+                    kept += 1
+                tmp.flush()
+                os.fsync(tmp.fileno())
+        os.rename(tmpname, self.journalname)
+        self.journal = open(self.journalname, "a")
+        logging.debug("rewrote %s with %d entries after %d" 
+                        % (self.journalname, kept, self.flushed))
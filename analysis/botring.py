@@ -0,0 +1,103 @@
+"""
+ fixed size windows of ints for diffs and hourdiffs
+
+ the windows used to be python lists that were trimmed with del(l[0])
+ once they got to MAXDIFFS which shifts every element along each time
+ a Ring keeps the numbers in a preallocated array('i') and overwrites
+ the oldest one instead so pushing a new value is O(1) and each value
+ takes 4 bytes instead of a pointer to a boxed int
+
+ the hours histogram is always 24 slots so it is simply kept as an
+ array('i') - both types are registered with psycopg2 so they can be
+ passed to a query as an integer[]. the adapter writes the literal
+ straight from the array slots (a Ring isn't copied into order first)
+ which is about the same work as psycopg2's list adapter: there is no
+ zero copy way to get an integer[] into postgres through psycopg2, a
+ bytea or binary COPY would mean changing every statement that saves a
+ window. the adapter is for every array.array so arrays of anything that
+ doesn't fit an integer[] are handed to psycopg2 as lists like before
+"""
+from array import array
+from itertools import islice
+from psycopg2.extensions import register_adapter, adapt, AsIs
+
+# array typecodes that always fit in a postgres integer
+INTCODES = "bBhHi"
+
+class Ring(object):
+    """
+    window of at most cap ints, oldest first
+    supports len, iteration and indexing so genstats and
+    botmoments.Moments can use it like a list
+    """
+    __slots__ = ('buf', 'cap', 'head', 'size')
+
+    def __init__(self, cap, values=None):
+        self.cap = cap
+        self.buf = array('i', [0]) * cap
+        self.head = 0
+        self.size = 0
+        if values != None:
+            for v in values[-cap:]:
+                self.push(v)
+
+    def push(self, x):
+        """ add x, returns the value that fell off the end or None """
+        if self.size < self.cap:
+            self.buf[(self.head + self.size) % self.cap] = x
+            self.size += 1
+            return None
+        evicted = self.buf[self.head]
+        self.buf[self.head] = x
+        self.head = (self.head + 1) % self.cap
+        return evicted
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if i < 0 or i >= self.size:
+            raise IndexError("ring index out of range")
+        return self.buf[(self.head + i) % self.cap]
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            yield self.buf[(self.head + i) % self.cap]
+
+    def linear(self):
+        """ the window in order as an array('i') """
+        end = self.head + self.size
+        if end <= self.cap:
+            return self.buf[self.head:end]
+        return self.buf[self.head:] + self.buf[:end - self.cap]
+
+    def segments(self):
+        """ the window in order as one or two iterators over the array, no copy """
+        end = self.head + self.size
+        if end <= self.cap:
+            return [islice(self.buf, self.head, end)]
+        return [islice(self.buf, self.head, self.cap), islice(self.buf, 0, end - self.cap)]
+
+    def tolist(self):
+        return self.linear().tolist()
+
+    def __repr__(self):
+        return "Ring(%d, %s)" % (self.cap, self.tolist())
+
+def literal(segments):
+    """ postgres integer[] literal from iterables of ints """
+    return AsIs("'{%s}'::integer[]" % ",".join([",".join(map(str, seg)) for seg in segments]))
+
+def intarray(values):
+    """ integer[] literal from an array('i') """
+    if values.typecode not in INTCODES:
+        return adapt(values.tolist())
+    return literal([values])
+
+def adapt_ring(ring):
+    return literal(ring.segments())
+
+register_adapter(Ring, adapt_ring)
+register_adapter(array, intarray)
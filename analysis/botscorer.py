@@ -0,0 +1,281 @@
+"""
+ score vw feature lines in process with the weights from a vw model
+
+ every prediction used to be a round trip to a "vw -t -i model --daemon"
+ process (and vwbotclassify even ran vwbotclassify.sh, i.e. started vw
+ and loaded the model, for each request). the models are plain linear
+ models over the 15 numeric features vw_string makes so a prediction is
+ just the sum of weight*value for each feature plus the constant
+
+ vw/readablemodel.sh writes the model out with --readable_model (or use
+ --invert_hash) and points vw/model.txt at it. a Scorer reads that file
+ into a dict of hash index => weight, works out the index for each
+ feature name the way vw does (murmurhash3 of the name, masked to the
+ model's bits) and caches the weight for each name. if the model.txt
+ link is moved to a new file it is read again on the next prediction
+ after at most CHECK seconds, the old weights are used until the new
+ ones are ready
+
+ predictmany does a whole batch with one numpy dot product. numpy and
+ mmh3 are used if they are installed but neither is needed
+
+ only simple linear models are handled: no quadratic or cubic features,
+ ngrams or named namespaces
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
+
+# vw's hash for the constant (bias) feature
+CONSTANT = 11650396
+# vw's default number of bits when the model doesn't say
+BITS = 18
+# seconds between checks for a new model file
+CHECK = 1.0
+# the features made by bottiming.vw_string in the order it makes them
+FEATURES = ('mean', 'var', 'skew', 'kurtosis',
+            'hmean', 'hvar', 'hskew', 'hkurtosis',
+            'htmean', 'htvar', 'htskew', 'htkurtosis',
+            'poverr', 'uacount', 'errprop')
+
+# hash:weight from --readable_model, name:hash:weight from --invert_hash
+weightpat = re.compile("^(?:(.*):)?(\d+):(\S+)")
+headerpat = re.compile("^(bits|Min label|Max label):\s*(\S+)")
+
+M32 = 0xffffffff
+
+def murmurhash3(data, seed=0):
+    """ murmurhash3 x86 32 bit, the hash vw uses for feature names """
+    if mmh3 != None:
+        return mmh3.hash(data, seed) & M32
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    length = len(data)
+    h = seed & M32
+    end = length - (length & 3)
+    for i in range(0, end, 4):
+        k = (ord(data[i]) | (ord(data[i+1]) << 8) |
+             (ord(data[i+2]) << 16) | (ord(data[i+3]) << 24))
+        k = (k * c1) & M32
+        k = ((k << 15) | (k >> 17)) & M32
+        k = (k * c2) & M32
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & M32
+        h = (h * 5 + 0xe6546b64) & M32
+    k = 0
+    tail = length & 3
+    if tail >= 3:
+        k ^= ord(data[end+2]) << 16
+    if tail >= 2:
+        k ^= ord(data[end+1]) << 8
+    if tail >= 1:
+        k ^= ord(data[end])
+        k = (k * c1) & M32
+        k = ((k << 15) | (k >> 17)) & M32
+        k = (k * c2) & M32
+        h ^= k
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & M32
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & M32
+    h ^= h >> 16
+    return h
+
+def hashfeature(name, seed=0):
+    """ vw's hashstring: names that are all digits hash to their value """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    name = name.strip()
+    if name.isdigit():
+        return (int(name) + seed) & M32
+    if len(name) == 0:
+        return seed
+    return murmurhash3(name, seed)
+
+def parse(line):
+    """
+    the (name, value) pairs from a vw example line
+    anything before the | (label, tag) is ignored
+    """
+    if "|" in line:
+        line = line.split("|", 1)[1]
+    features = []
+    for token in line.split():
+        if ":" in token:
+            name, value = token.rsplit(":", 1)
+            try:
+                value = float(value)
+            except ValueError:
+                # vw reads what it can't parse as 0
+                value = 0.0
+        else:
+            name, value = token, 1.0
+        features.append((name, value))
+    return features
+
+class Model(object):
+    """ the weights of one linear vw model """
+    def __init__(self, weights, bits=BITS, minlabel=None, maxlabel=None, path=None):
+        self.weights = weights
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.minlabel = minlabel
+        self.maxlabel = maxlabel
+        self.path = path
+        self.constant = weights.get(CONSTANT & self.mask, 0.0)
+        # feature name => weight
+        self.names = {}
+        for name in FEATURES:
+            self.weight(name)
+
+    def weight(self, name):
+        w = self.names.get(name)
+        if w == None:
+            w = self.weights.get(hashfeature(name) & self.mask, 0.0)
+            self.names[name] = w
+        return w
+
+    def clip(self, pred):
+        """ vw keeps its predictions between the smallest and largest label it saw """
+        if self.maxlabel != None and pred > self.maxlabel:
+            return self.maxlabel
+        if self.minlabel != None and pred < self.minlabel:
+            return self.minlabel
+        return pred
+
+    def predict(self, features):
+        """ features is a list of (name, value) pairs or a dict """
+        if isinstance(features, dict):
+            features = features.iteritems()
+        pred = self.constant
+        for name, value in features:
+            pred += self.weight(name) * value
+        return self.clip(pred)
+
+    def predictmany(self, rows):
+        """ predictions for a list of feature lists (or dicts) in one go """
+        if numpy == None or len(rows) < 2:
+            return [self.predict(features) for features in rows]
+        columns = dict((name, i) for i, name in enumerate(FEATURES))
+        coords = []
+        for r, features in enumerate(rows):
+            if isinstance(features, dict):
+                features = features.iteritems()
+            for name, value in features:
+                c = columns.get(name)
+                if c == None:
+                    c = columns[name] = len(columns)
+                coords.append((r, c, value))
+        values = numpy.zeros((len(rows), len(columns)))
+        if len(coords) > 0:
+            r, c, v = zip(*coords)
+            # repeated features add up like they do in vw
+            numpy.add.at(values, (numpy.array(r), numpy.array(c)), v)
+        weights = numpy.zeros(len(columns))
+        for name, c in columns.iteritems():
+            weights[c] = self.weight(name)
+        preds = values.dot(weights) + self.constant
+        if self.minlabel != None or self.maxlabel != None:
+            preds = numpy.clip(preds, self.minlabel, self.maxlabel)
+        return preds.tolist()
+
+def readmodel(path):
+    """ read a --readable_model or --invert_hash file into a Model """
+    weights = {}
+    bits = BITS
+    minlabel = None
+    maxlabel = None
+    f = open(path)
+    try:
+        for line in f:
+            m = headerpat.match(line)
+            if m != None:
+                key, value = m.groups()
+                if key == 'bits':
+                    bits = int(value)
+                elif key == 'Min label':
+                    minlabel = float(value)
+                else:
+                    maxlabel = float(value)
+                continue
+            m = weightpat.match(line)
+            if m == None:
+                continue
+            name, index, weight = m.groups()
+            try:
+                weights[int(index)] = float(weight)
+            except ValueError:
+                logging.debug("skipping %s in %s" % (line.strip(), path))
+    finally:
+        f.close()
+    if len(weights) == 0:
+        raise ValueError("no weights in %s" % path)
+    logging.debug("read %d weights from %s" % (len(weights), path))
+    return Model(weights, bits, minlabel, maxlabel, path)
+
+class Scorer(object):
+    """
+    predictions from the model at path (normally a symlink)
+    which is read again when the link or the file changes
+    """
+    def __init__(self, path, check=CHECK):
+        self.path = path
+        self.check = check
+        self.lock = threading.Lock()
+        self.model = None
+        self.stamp = None
+        self.checked = 0
+        self.reload()
+
+    def getstamp(self):
+        st = os.stat(self.path)
+        return (os.path.realpath(self.path), st.st_ino, st.st_mtime, st.st_size)
+
+    def reload(self):
+        """ read the model again if it has changed, returns True if it did """
+        self.lock.acquire()
+        try:
+            stamp = self.getstamp()
+            if stamp == self.stamp:
+                return False
+            model = readmodel(self.path)
+            self.model = model
+            self.stamp = stamp
+            logging.info("using model %s" % stamp[0])
+            return True
+        finally:
+            self.lock.release()
+
+    def current(self):
+        """ the model to use, checking for a new one every check seconds """
+        now = time.time()
+        if now - self.checked >= self.check:
+            self.checked = now
+            try:
+                self.reload()
+            except Exception as e:
+                logging.error("could not reload %s: %s" % (self.path, e))
+        return self.model
+
+    def predict(self, features):
+        """ features can be a vw line, a list of (name, value) pairs or a dict """
+        if isinstance(features, basestring):
+            features = parse(features)
+        return self.current().predict(features)
+
+    def predictmany(self, rows):
+        rows = [parse(row) if isinstance(row, basestring) else row for row in rows]
+        return self.current().predictmany(rows)
@@ -0,0 +1,304 @@
+"""
+ event driven listener for mod_ml preprocessor messages
+
+ botlogger used to accept one connection at a time, do a single
+ recv(4096), send "OK" and close. a slow client held up everyone else
+ and a message bigger than 4096 bytes was cut off. this server keeps
+ every connection non blocking in one epoll (or poll) loop with its own
+ read and write buffers so thousands of mod_ml connections can be open
+ at once
+
+ mod_ml ends each message with "\n\n" and may put the length and a
+ space in front of it (MLSendLength on). messages are framed on either
+ and each complete message is answered with "OK". a connection can
+ send more than one message. if a connection closes part way through a
+ message what arrived is still used, which is what the old recv did
+
+ a client can also start with botproto.HELLO to use persistent mode
+ where each message is a json line with a request id (see botproto)
+
+ whitelist and nonce checks are the same as they were in botlogger
+ complete messages are passed to the deliver function given to Server
+"""
+import errno
+import hashlib
+import json
+import logging
+import re
+import select
+import socket
+
+import botproto
+
+# listen backlog
+BACKLOG = 1024
+# biggest message we will buffer before giving up on a connection
+MAXMSG = 1048576
+# bytes to read at a time
+READSIZE = 65536
+# longest poll wait in seconds
+TICK = 1.0
+
+REPLY = "OK"
+lengthpat = re.compile("^(\d+) ")
+noncepat = re.compile("nonce=(\w*):(\w*)")
+
+class Conn(object):
+    """ buffers for one client connection """
+    __slots__ = ('sock', 'addr', 'inbuf', 'outbuf', 'persistent')
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = ""
+        self.outbuf = ""
+        # None until we know which protocol the client is using
+        self.persistent = None
+
+def frame(buf):
+    """
+    split complete messages off the front of buf
+    returns a list of messages and whatever is left over
+    """
+    messages = []
+    while len(buf) > 0:
+        m = lengthpat.match(buf)
+        if m != None:
+            start = m.end()
+            end = start + int(m.group(1))
+            if len(buf) < end:
+                break
+            messages.append(buf[start:end])
+            # the terminator is still sent after a length prefixed message
+            while buf[end:end+1] == "\n":
+                end += 1
+            buf = buf[end:]
+            continue
+        end = buf.find("\n\n")
+        if end < 0:
+            break
+        messages.append(buf[:end])
+        buf = buf[end+2:]
+    return messages, buf
+
+class Poller(object):
+    """ select.epoll where there is one, select.poll otherwise """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.p = select.epoll()
+            self.scale = 1.0
+            self.IN, self.OUT = select.EPOLLIN, select.EPOLLOUT
+            self.ERR = select.EPOLLERR | select.EPOLLHUP
+        else:
+            self.p = select.poll()
+            self.scale = 1000.0
+            self.IN, self.OUT = select.POLLIN, select.POLLOUT
+            self.ERR = select.POLLERR | select.POLLHUP
+
+    def register(self, fd, events):
+        self.p.register(fd, events)
+
+    def modify(self, fd, events):
+        self.p.modify(fd, events)
+
+    def unregister(self, fd):
+        self.p.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            return self.p.poll(timeout*self.scale)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+class Server(object):
+    def __init__(self, port, whitelist, deliver):
+        """
+        port to listen on, whitelist as read by botlogger.read_whitelist
+        deliver is called with each message that passes the checks
+        """
+        self.port = port
+        self.whitelist = whitelist or {}
+        self.deliver = deliver
+        self.conns = {}
+        self.poller = Poller()
+        self.sock = None
+
+    def listen(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', self.port))
+        self.sock.listen(BACKLOG)
+        self.sock.setblocking(0)
+        self.poller.register(self.sock.fileno(), self.poller.IN)
+
+    def allowed(self, addr):
+        """ is the client ip in the whitelist (an empty whitelist allows anyone) """
+        if len(self.whitelist) == 0:
+            return True
+        return addr in self.whitelist and self.whitelist[addr]
+
+    def checknonce(self, addr, message):
+        """ hosts with a password have to send a nonce made from it """
+        sha1pw = self.whitelist.get(addr, True)
+        if sha1pw == True:
+            return True
+        m = noncepat.search(message)
+        if m == None:
+            logging.info("no nonce found in message from %s, rejecting" % addr)
+            return False
+        nonce, salt = m.groups()
+        if hashlib.sha1(sha1pw+salt).hexdigest() != nonce:
+            logging.info("nonce failed for %s" % addr)
+            return False
+        return True
+
+    def accept(self):
+        """ take every connection that is waiting """
+        while True:
+            try:
+                sock, client_address = self.sock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ECONNABORTED):
+                    logging.error("accept failed: %s" % str(e))
+                    return
+                raise
+            addr = client_address[0]
+            if not self.allowed(addr):
+                logging.info("rejected connection from %s" % addr)
+                sock.close()
+                continue
+            sock.setblocking(0)
+            conn = Conn(sock, addr)
+            self.conns[sock.fileno()] = conn
+            self.poller.register(sock.fileno(), self.poller.IN)
+
+    def close(self, fd):
+        conn = self.conns.pop(fd, None)
+        if conn == None:
+            return
+        try:
+            self.poller.unregister(fd)
+        except (IOError, ValueError, KeyError):
+            pass
+        conn.sock.close()
+
+    def handle(self, conn, messages):
+        """ check and deliver messages from a connection and queue the replies """
+        for message in messages:
+            if self.checknonce(conn.addr, message):
+                self.deliver(message)
+            conn.outbuf += REPLY
+
+    def handlelines(self, conn, lines):
+        """ same as handle for persistent mode request lines """
+        for line in lines:
+            try:
+                req = json.loads(line)
+                message = req['data']
+            except (ValueError, KeyError, TypeError):
+                logging.error("bad request from %s: %s" % (conn.addr, line))
+                continue
+            if self.checknonce(conn.addr, message):
+                self.deliver(message)
+            conn.outbuf += botproto.response(req.get('id'), REPLY)
+
+    def protocol(self, conn):
+        """
+        decide whether a new connection is persistent or one shot
+        returns False if there isn't enough to tell yet
+        """
+        hello = botproto.HELLO
+        if len(conn.inbuf) < len(hello) and hello.startswith(conn.inbuf):
+            return False
+        conn.persistent = conn.inbuf.startswith(hello)
+        if conn.persistent:
+            conn.inbuf = conn.inbuf[len(hello):]
+            conn.outbuf += hello
+        return True
+
+    def read(self, fd):
+        conn = self.conns[fd]
+        eof = False
+        try:
+            data = conn.sock.recv(READSIZE)
+            if not data:
+                eof = True
+            else:
+                conn.inbuf += data
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            eof = True
+
+        if conn.persistent == None and not self.protocol(conn) and not eof:
+            return
+        if conn.persistent:
+            lines, conn.inbuf = botproto.splitlines(conn.inbuf)
+            self.handlelines(conn, lines)
+        else:
+            messages, conn.inbuf = frame(conn.inbuf)
+            if eof and len(conn.inbuf.strip()) > 0:
+                # the old server used whatever it got in one read
+                messages.append(conn.inbuf)
+                conn.inbuf = ""
+            self.handle(conn, messages)
+
+        if eof:
+            # the client may only have shut down its side, try to answer
+            if len(conn.outbuf) > 0:
+                try:
+                    conn.sock.send(conn.outbuf)
+                except socket.error:
+                    pass
+            self.close(fd)
+        elif len(conn.inbuf) > MAXMSG:
+            logging.error("message from %s too big, closing" % conn.addr)
+            self.close(fd)
+        elif len(conn.outbuf) > 0:
+            self.write(fd)
+
+    def write(self, fd):
+        conn = self.conns[fd]
+        try:
+            sent = conn.sock.send(conn.outbuf)
+            conn.outbuf = conn.outbuf[sent:]
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.close(fd)
+                return
+        if len(conn.outbuf) > 0:
+            self.poller.modify(fd, self.poller.IN | self.poller.OUT)
+        else:
+            self.poller.modify(fd, self.poller.IN)
+
+    def serve_forever(self):
+        if self.sock == None:
+            self.listen()
+        listenfd = self.sock.fileno()
+        logging.info("mod_ml listening on %d" % self.port)
+        while True:
+            for fd, event in self.poller.poll(TICK):
+                try:
+                    if fd == listenfd:
+                        self.accept()
+                        continue
+                    if fd not in self.conns:
+                        continue
+                    if event & self.poller.IN:
+                        self.read(fd)
+                    if fd in self.conns and event & self.poller.OUT:
+                        self.write(fd)
+                    if fd in self.conns and event & self.poller.ERR and not event & self.poller.IN:
+                        self.close(fd)
+                except Exception as e:
+                    logging.error("error on connection %d: %s" % (fd, str(e)))
+                    self.close(fd)
+            self.after()
+
+    def after(self):
+        """ called after each round of events, for subclasses that answer in batches """
+        pass
@@ -0,0 +1,82 @@
+"""
+ hash partitioning of ips over a fixed set of workers
+
+ botlog used to start hundreds of threads that all waited on one
+ condition and handed out ips round robin which meant keeping track of
+ who had what ip in shared dicts. instead every ip key
+ ("http_host/remote_addr") is hashed with crc32 and the 32 bit hash
+ range is split evenly over the workers so an ip always goes to the same
+ worker. that worker is the only one that ever processes the ip so no
+ bookkeeping is needed to stop two threads working on the same ip
+
+ crc32 is used rather than python's hash so that separate processes
+ agree on who owns what. botprocs splits the range over processes first
+ and each process splits its part over its own workers (see partshard)
+"""
+import threading
+import zlib
+
+def shardfor(ip, count):
+    """ which of count shards owns ip """
+    if isinstance(ip, unicode):
+        ip = ip.encode('utf-8')
+    return ((zlib.crc32(ip) & 0xffffffff) * count) >> 32
+
+def partshard(ip, parts, count):
+    """
+    split the hash range into parts (processes) of count shards each
+    returns (part, shard within the part) for ip
+    the part is always the same as shardfor(ip, parts)
+    """
+    i = shardfor(ip, parts*count)
+    return i // count, i % count
+
+class Shard(object):
+    """
+    one worker's share of the ips
+    pending holds ips that have been poked since the worker last looked
+    working holds the ips the worker is busy with right now
+    both are ip => ipd dicts as made by botlog.set_ipd
+    """
+    def __init__(self, num):
+        self.num = num
+        self.name = "shard%d" % num
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.working = {}
+        self.thread = None
+
+    def add(self, newips):
+        """ hand the shard some ips and wake its worker """
+        self.condition.acquire()
+        self.pending.update(newips)
+        self.condition.notify()
+        self.condition.release()
+
+    def take(self, timeout=None):
+        """
+        wait for ips then take everything pending
+        with a timeout returns an empty dict if nothing turned up in time
+        """
+        self.condition.acquire()
+        try:
+            if timeout == None:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+            elif len(self.pending) == 0:
+                self.condition.wait(timeout)
+            self.working = self.pending
+            self.pending = {}
+            return self.working
+        finally:
+            self.condition.release()
+
+    def done(self):
+        """ call when the ips from take have been dealt with """
+        self.condition.acquire()
+        self.working = {}
+        self.condition.release()
+
+    def owns(self, ip):
+        """ True if the ip is waiting for or being handled by this shard """
+        return ip in self.pending or ip in self.working
@@ -0,0 +1,156 @@
+"""
+ read only prediction snapshot file for the classifier servers
+
+ instead of asking redis or memcached for every lookup the predictions
+ can be compiled (fill-redis.py -s) into one file of fixed size records
+ sorted by ip. the classifier servers mmap it and binary search it so
+ a lookup is a couple of dozen memory reads with no network hop, and
+ every classifier process on the host shares the one copy in the page
+ cache
+
+ the file is a HEADER of MAGIC and the record count (little endian
+ 64 bit) followed by the records. each record is the ip as 16 bytes
+ (ipv4 as an ipv4 mapped ipv6 address, ::ffff:a.b.c.d) and the
+ prediction as one signed byte, see botpack
+
+ a new snapshot is written next to the old one and renamed over it so
+ readers never see a partial file. a Snapshot notices the new inode
+ within CHECK seconds and maps the new file
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+
+import botpack
+
+MAGIC = "BOTSNAP1"
+HEADER = len(MAGIC) + 8
+KEYSIZE = 16
+RECORD = KEYSIZE + 1
+# seconds between checks for a new file
+CHECK = 1.0
+# records written at a time
+WRITECHUNK = 65536
+
+MAPPED = "\0"*10 + "\xff\xff"
+
+def packkey(ip):
+    """ 16 byte key for an ip, None if it isn't an address """
+    packed = botpack.packip(ip)
+    if packed == None:
+        return None
+    if len(packed) == 4:
+        return MAPPED + packed
+    return packed
+
+def write(path, totals):
+    """
+    write a dict of ip => prediction to a snapshot at path
+    returns the number of ips that weren't addresses
+    """
+    records = {}
+    bad = 0
+    for ip, pred in totals.iteritems():
+        key = packkey(ip)
+        if key == None:
+            bad += 1
+            continue
+        records[key] = botpack.packvalue(pred)
+    keys = sorted(records.iterkeys())
+
+    tmp = "%s.tmp.%d" % (path, os.getpid())
+    f = open(tmp, "wb")
+    try:
+        f.write(MAGIC + struct.pack("<Q", len(keys)))
+        for start in range(0, len(keys), WRITECHUNK):
+            f.write("".join([key + records[key] for key in keys[start:start+WRITECHUNK]]))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp, path)
+    logging.info("wrote %d predictions to %s" % (len(keys), path))
+    return bad
+
+class Snapshot(object):
+    def __init__(self, path, check=CHECK):
+        self.path = path
+        self.check = check
+        self.map = None
+        self.count = 0
+        self.ino = None
+        self.checked = 0
+        self.load()
+
+    def load(self):
+        """ map the file at path if it isn't the one already mapped """
+        f = open(self.path, "rb")
+        try:
+            st = os.fstat(f.fileno())
+            if (st.st_ino, st.st_mtime) == self.ino:
+                return False
+            if st.st_size < HEADER:
+                raise ValueError("%s is too short to be a snapshot" % self.path)
+            m = mmap.mmap(f.fileno(), st.st_size, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        count = struct.unpack("<Q", m[len(MAGIC):HEADER])[0]
+        if m[:len(MAGIC)] != MAGIC or st.st_size != HEADER + count*RECORD:
+            m.close()
+            raise ValueError("%s is not a complete snapshot" % self.path)
+        old = self.map
+        self.map = m
+        self.count = count
+        self.ino = (st.st_ino, st.st_mtime)
+        if old != None:
+            old.close()
+        logging.info("mapped %d predictions from %s" % (count, self.path))
+        return True
+
+    def current(self):
+        now = time.time()
+        if now - self.checked >= self.check:
+            self.checked = now
+            try:
+                self.load()
+            except Exception as e:
+                logging.error("could not load %s: %s" % (self.path, e))
+
+    def find(self, key):
+        """ binary search for a 16 byte key, returns the prediction or None """
+        m = self.map
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            off = HEADER + mid*RECORD
+            k = m[off:off+KEYSIZE]
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return struct.unpack("b", m[off+KEYSIZE])[0]
+        return None
+
+    def get(self, ip):
+        self.current()
+        key = packkey(ip)
+        if key == None:
+            return None
+        return self.find(key)
+
+    def getmany(self, ips):
+        """ dict of ip => prediction for the ips in the snapshot """
+        self.current()
+        found = {}
+        for ip in ips:
+            key = packkey(ip)
+            if key == None:
+                continue
+            pred = self.find(key)
+            if pred != None:
+                found[ip] = pred
+        return found
@@ -0,0 +1,259 @@
+"""
+ in process copy of botstats and botlatest for the ips this preprocessor
+ looks after
+
+ without this every batch of log entries for an ip reads its botstats
+ and botlatest rows, writes them back with several updates and commits
+ each time. with a StateStore the first batch for an ip loads the rows
+ once and after that botupdstats.processstate only changes the copy
+ in memory and marks it dirty. a flusher thread saves the dirty ips
+ every FLUSHDELAY seconds, or when FLUSHSIZE ips are waiting, in one
+ transaction on its own connection using multi row upserts
+
+ the store is authoritative: once an ip is loaded its rows in the db
+ are only ever written from here. botlog makes sure that only one
+ thread handles a given ip at a time and each ip state has a lock
+ that is held while it is being changed or saved
+"""
+import logging
+import threading
+import time
+import sys
+
+import botpool
+import bottiming as bt
+from botmoments import Moments
+from botring import Ring
+from array import array
+
+# seconds between saves
+FLUSHDELAY = 1.0
+# save straight away if this many ips are waiting
+FLUSHSIZE = 5000
+# start dropping ips that haven't been seen for a while
+MAXSTATES = 200000
+# how long an ip has to be idle before it can be dropped
+IDLE = 600
+
+class IPState(object):
+    """ botstats and botlatest for one ip """
+    def __init__(self, ipd, stats, latest):
+        self.ip = ipd['ip']
+        self.http_host = ipd['http_host']
+        self.remote_addr = ipd['remote_addr']
+        self.lock = threading.Lock()
+        # the lists have always been allowed to grow to MAXDIFFS+1
+        stats['diffs'] = Ring(bt.MAXDIFFS+1, stats['diffs'])
+        stats['hourdiffs'] = Ring(bt.MAXDIFFS+1, stats['hourdiffs'])
+        stats['hours'] = array('i', stats['hours'])
+        self.stats = stats
+        self.latest = latest
+        self.moments = {
+            'diffs': Moments(stats['diffs']),
+            'hourdiffs': Moments(stats['hourdiffs']),
+            'hours': Moments(stats['hours']),
+        }
+        # last distribution stats and prediction, saved with the next flush
+        self.data = None
+        self.touched = time.time()
+
+    def rows(self):
+        """
+        copy out what needs saving
+        should be called with the lock held
+        """
+        stats = self.stats
+        row = {
+            'ip': self.ip,
+            'reqs': stats['reqs'], 'pages': stats['pages'], 'errs': stats['errs'],
+            'uas': list(stats['uas'] or []),
+            'diffs': stats['diffs'].linear(),
+            'hourdiffs': stats['hourdiffs'].linear(),
+            'hours': array('i', stats['hours']),
+        }
+        data = None
+        if self.data != None:
+            data = dict(self.data)
+        latest = None
+        if self.latest != None:
+            latest = bt.flatten(dict(self.latest))
+        return row, data, latest
+
+class StateStore(object):
+    """ ip => IPState with write behind saving to botstats and botlatest """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.dirty = {}
+        # number of flushes that haven't committed yet
+        self.flushing = 0
+        # flushes started and the last one that committed, flushes are
+        # done one at a time so once flush g commits every change made
+        # before g started is in the db (see mark and flushed)
+        self.generation = 0
+        self.committed = 0
+        self.flusher = None
+        # set when there are FLUSHSIZE dirty ips
+        self.full = threading.Event()
+
+    def get(self, ipd, conn):
+        """
+        find the state for an ip, load it from the db the first time
+        """
+        state = self.states.get(ipd['ip'])
+        if state != None:
+            return state
+
+        scur = conn.cursor()
+        try:
+            stats = bt.getstats(scur, ipd)
+            if stats == None:
+                logging.debug("no stats yet")
+                if not bt.initstats(scur, conn, ipd):
+                    raise Exception("error initializing stats for %s" % (ipd['ip']))
+                stats = bt.getstats(scur, ipd)
+            if stats == None:
+                raise Exception("Stats should not be empty here!")
+            latest = bt.getbotlatest(scur, ipd)
+            conn.commit()
+        finally:
+            scur.close()
+
+        self.lock.acquire()
+        try:
+            # another thread may have beaten us to it
+            if ipd['ip'] not in self.states:
+                self.states[ipd['ip']] = IPState(ipd, stats, latest)
+            return self.states[ipd['ip']]
+        finally:
+            self.lock.release()
+
+    def touch(self, state):
+        """ mark a state as needing to be saved """
+        state.touched = time.time()
+        self.lock.acquire()
+        self.dirty[state.ip] = state
+        if len(self.dirty) >= FLUSHSIZE:
+            self.full.set()
+        self.lock.release()
+
+    def mark(self):
+        """ a flush generation, see flushed """
+        self.lock.acquire()
+        try:
+            return self.generation + 1
+        finally:
+            self.lock.release()
+
+    def flushed(self, mark):
+        """ True if everything changed before mark was called is in the db """
+        return self.committed >= mark
+
+    def flush(self, conn):
+        """ save everything that changed since the last flush """
+        self.lock.acquire()
+        dirty = self.dirty
+        self.dirty = {}
+        self.generation += 1
+        generation = self.generation
+        if len(dirty) > 0:
+            self.flushing += 1
+        self.lock.release()
+        if len(dirty) == 0:
+            self.committed = generation
+            return 0
+        try:
+            count = self.write(conn, dirty)
+            if count > 0:
+                self.committed = generation
+            return count
+        finally:
+            self.lock.acquire()
+            self.flushing -= 1
+            self.lock.release()
+
+    def write(self, conn, dirty):
+        """ save the states in dirty in one transaction """
+
+        counts = []
+        stats = []
+        latest = []
+        for ip, state in dirty.iteritems():
+            state.lock.acquire()
+            try:
+                row, data, last = state.rows()
+                counts.append(row)
+                if data != None:
+                    stats.append(data)
+                if last != None:
+                    latest.append(last)
+            finally:
+                state.lock.release()
+
+        cur = conn.cursor()
+        try:
+            self.save(cur, counts, stats, latest)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error("flush of %d ips failed: %s" % (len(dirty), e))
+            # try again next time
+            self.lock.acquire()
+            for ip, state in dirty.iteritems():
+                if ip not in self.dirty:
+                    self.dirty[ip] = state
+            self.lock.release()
+            return 0
+        finally:
+            cur.close()
+
+        self.trim()
+        return len(dirty)
+
+    def save(self, cur, counts, stats, latest):
+        """ write the rows collected by flush """
+        bt.upsertstatcounts(counts, cur)
+        if len(stats) > 0:
+            bt.upsertstats(stats, cur)
+        if len(latest) > 0:
+            bt.upsertbotlatest(latest, cur)
+
+    def trim(self):
+        """ forget ips we haven't seen in a while if there are too many """
+        if len(self.states) < MAXSTATES:
+            return
+        old = time.time() - IDLE
+        self.lock.acquire()
+        try:
+            for ip in self.states.keys():
+                state = self.states[ip]
+                if state.touched < old and ip not in self.dirty:
+                    del(self.states[ip])
+        finally:
+            self.lock.release()
+
+    def run(self):
+        """
+        flusher thread: save dirty ips every FLUSHDELAY seconds
+        or as soon as there are FLUSHSIZE of them
+        """
+        logging.debug("starting flusher")
+        conn = None
+        while True:
+            self.full.wait(FLUSHDELAY)
+            self.full.clear()
+            try:
+                conn = botpool.getconn(conn)
+                count = self.flush(conn)
+                if count > 0:
+                    logging.debug("flushed %d ips" % count)
+            except Exception as e:
+                exc_type, exc_obj, tb = sys.exc_info()
+                logging.error("flusher failed at %d: %s" % (tb.tb_lineno, str(e)))
+
+    def start(self):
+        """ start the flusher thread if it isn't running """
+        if self.flusher == None:
+            self.flusher = threading.Thread(name="flusher", target=self.run)
+            self.flusher.daemon = True
+            self.flusher.start()
@@ -9,7 +9,7 @@ import sys
 import json
 import re
 import os
-import socket
+import threading
 import traceback
 import logging
 
@@ -17,15 +17,47 @@ import redis
 rs = None
 
 import psycopg2
+from psycopg2.extras import execute_values
 from mldb import dbname, dbuser, dbpw
+from botmoments import momentstats
+import botproto
+import botpool
+import botprep
+import botvw
+import botcache
+import botpack
 autocommit = True
 
+# keep connections to the ua classifier and vw daemons open between calls
+# set to False to go back to a new connection per call
+PERSISTENT = True
+# let classifier caches know a prediction has changed, see botcache
+PUBLISH = True
+# set BOTCLASSIFY_PACKED (as for redis-botclassify.py) to save predictions
+# in botpack's packed layout instead of as plain keys
+PACKED = bool(os.environ.get('BOTCLASSIFY_PACKED'))
+# vw daemons get a shared pipelined connection, see botvw
+# the ua classifier multiplexes requests so one connection is shared
+uaclients = {}
+clientlock = threading.Lock()
+
+def uaclient(addr):
+    """ the shared persistent connection to a ua classifier at addr """
+    clientlock.acquire()
+    try:
+        if addr not in uaclients:
+            uaclients[addr] = botproto.Client(addr)
+        return uaclients[addr]
+    finally:
+        clientlock.release()
+
 ################################################################################
 # functions used by botlog.py                                                  #
 ################################################################################
 # given a list of numbers generate some stats on the distribution
 def genstats(diffs):
     # this method is going to be slow but my kurtosis calculation formula isn't working
+    # see botmoments.Moments for the incremental version used by botupdstats
     if len(diffs) > 1:
         s = sum(diffs)+0.0
         n = len(diffs)+0.0
@@ -35,23 +67,9 @@ def genstats(diffs):
             se += (d - m)**2.0
             ce += (d - m)**3.0
             qe += (d - m)**4.0
-        var = se/(n-1.0)
-        # source for sn, kn1, kn2 sample size corrections 
-        # http://www.ats.ucla.edu/stat/mult_pkg/faq/general/kurtosis.htm
-        # and http://www.itl.nist.gov/div898/handbook/eda/section3/eda35b.htm
-        if var != 0 and n > 1: 
-            sn = ((n*(n-1.0))**(1/2))/(n-1.0)
-            skew = sn*(ce/n)/(var*(var**(1.0/2.0)))
-            if n > 3:
-                kn1 = (n*(n+1.0))/((n-1.0)*(n-2.0)*(n-3.0))
-                kn2 = ((n-1.0)**2.0)/((n-2.0)*(n-3.0))
-                kurt = kn1*(qe/n)/(var**2.0) - 3.0*kn2
-            else:
-                kurt = 0.0
-        else: 
-            kurt = 0.0
-            skew = 0.0
-        return {'diffs':diffs, 'n': n, 'sum': s, 'mean': m, 'var': se, 'kurtosis': kurt, 'skew': skew}
+        stats = momentstats(n, s, se, ce, qe)
+        stats['diffs'] = diffs
+        return stats
     return None
 
 # was the request an error?
@@ -100,13 +118,16 @@ def botlog2dict(row):
 
 def botlatest2dict(row):
     keys = ['hour', 'REMOTE_ADDR', 'status_line', 'useragent', 
-            'epoch', 'HTTP_HOST', 'content_type']
+            'epoch', 'HTTP_HOST', 'content_type', 'logid']
     return row2dict(keys,row)
 
 # these get/set functions are used by botlog.py
 
 # store this many items in our arrays
 MAXDIFFS = 1000
+# botlog is partitioned (psql/botlog-partitioned.psql): processed rows are
+# left for botpartition.py to drop and botlatest.logid says how far each ip has got
+PARTITIONED = False
 # ignore anything over 2 days old - too extreme?
 OLD = 2 * 86400 * 1000
 
@@ -138,12 +159,10 @@ def get_label(ua, services):
 
     label = None
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(uasvc)
-        s.sendall(ua)
-        s.shutdown(socket.SHUT_WR)
-        rawlabel = s.recv(1024)
-        s.close()
+        if PERSISTENT:
+            rawlabel = uaclient(uasvc).call(ua)
+        else:
+            rawlabel = botproto.oneshot(uasvc, ua)
         try:
             label = int(rawlabel.strip())
             logging.debug("got label %d for ua %s" % (label, ua))
@@ -172,11 +191,12 @@ def teach(label, features, services):
         return
 
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(vw)
-        s.sendall(features)
-        s.shutdown(socket.SHUT_WR)
-        s.close()
+        if PERSISTENT:
+            # the learner still answers with a prediction, botvw reads it
+            # but there is no need to wait for it
+            botvw.getclient(vw).submit(features)
+        else:
+            botproto.oneshot(vw, features, False)
         logging.debug("vw sent features %s" % (features))
     except:
         pass
@@ -199,13 +219,11 @@ def get_prediction(data,stats,services):
 
     pred = None
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # "vw" should be a (host,port) tuple
-        s.connect(vw)
-        s.sendall(features)
-        s.shutdown(socket.SHUT_WR)
-        rawpred = s.recv(1024)
-        s.close()
+        if PERSISTENT:
+            rawpred = botvw.getclient(vw).predict(features)
+        else:
+            rawpred = botproto.oneshot(vw, features)
         rawpred = rawpred.strip()
         pred = float(rawpred)
         logging.debug("got prediction %f for %s" % (pred, features))
@@ -216,10 +234,20 @@ def get_prediction(data,stats,services):
         if rs != None:
             if pred >= 0.0 or stats['class'] >= 0:
                 logging.debug("saving prediction bot (1) for %s" % data['ip'])
-                rs.set(data['ip'],1)
+                value = 1
             else:
                 logging.debug("saving prediction human (-1) for %s" % data['ip'])
-                rs.set(data['ip'],-1)
+                value = -1
+            # send the set and the publish together
+            pipe = rs.pipeline(transaction=False)
+            if PACKED:
+                # data['ip'] is host/ip, the packed layout is by ip
+                botpack.put(rs, pipe, data['ip'].split('/')[-1], value)
+            else:
+                pipe.set(data['ip'],value)
+            if PUBLISH:
+                botcache.publish(pipe, data['ip'])
+            pipe.execute()
 
     except Exception as e:
         a, b, tb = sys.exc_info()
@@ -228,54 +256,72 @@ def get_prediction(data,stats,services):
     return pred, stats['class']
 
 
-def updatestats(ip,diffs,hourdiffs,hours,ucur,uconn,stats=None,services=None):
+def statsdata(ip,diffs,hourdiffs,hours,moments=None):
     """
-    updates botstats fields
+    work out the distribution fields for botstats
+    returns None if there isn't enough data yet
+    moments is an optional dict of botmoments.Moments for diffs, hourdiffs
+    and hours that are already up to date, this avoids genstats
     """
-    try:
-        ucur.execute(
-            """
-            update botstats set
-            diffs = %(diffs)s, 
-            hourdiffs = %(hourdiffs)s,
-            hours = %(hours)s
-            where 
-            ip = %(ip)s
-            """,
-            {'diffs':diffs,'hourdiffs':hourdiffs,'hours':hours,'ip':ip})
-        if autocommit: uconn.commit()
-
-        # need at least 3 hits for this ip to get two diffs
-        if len(diffs) > 1 and len(hourdiffs) > 1:
+    # need at least 3 hits for this ip to get two diffs
+    if len(diffs) > 1 and len(hourdiffs) > 1:
+        if moments != None:
+            s = moments['diffs'].stats()
+            h = moments['hourdiffs'].stats()
+            ht = moments['hours'].stats()
+        else:
             s = genstats(diffs)
             h = genstats(hourdiffs)
             ht = genstats(hours)
 
-            if h == None or s == None or ht is None:
-                raise Exception("missing data for ip "+ip)
-
-            data = {'ip':ip,
-                    'n':s['n'], 'sum':s['sum'], 'mean':s['mean'], 
-                    'var':s['var'], 'skew':s['skew'], 'kurtosis':s['kurtosis'], 
-                    'hn':h['n'], 'hsum':h['sum'], 'hmean':h['mean'], 
-                    'hvar':h['var'], 'hskew':h['skew'], 'hkurtosis':h['kurtosis'], 
-                    'htn':ht['n'], 'htsum':ht['sum'], 'htmean':ht['mean'], 
-                    'htvar':ht['var'], 'htskew':ht['skew'], 'htkurtosis':ht['kurtosis']
-                    }
+        if h == None or s == None or ht is None:
+            raise Exception("missing data for ip "+ip)
+
+        return {'ip':ip,
+                'n':s['n'], 'sum':s['sum'], 'mean':s['mean'], 
+                'var':s['var'], 'skew':s['skew'], 'kurtosis':s['kurtosis'], 
+                'hn':h['n'], 'hsum':h['sum'], 'hmean':h['mean'], 
+                'hvar':h['var'], 'hskew':h['skew'], 'hkurtosis':h['kurtosis'], 
+                'htn':ht['n'], 'htsum':ht['sum'], 'htmean':ht['mean'], 
+                'htvar':ht['var'], 'htskew':ht['skew'], 'htkurtosis':ht['kurtosis']
+                }
+    return None
+
+# these run for every batch so they are prepared once per connection (see botprep)
+UPDATEWINDOWS = botprep.Statement("updatewindows", """
+    update botstats set
+    diffs = %(diffs)s,
+    hourdiffs = %(hourdiffs)s,
+    hours = %(hours)s
+    where
+    ip = %(ip)s
+    """)
+UPDATESTATS = botprep.Statement("updatestats", """
+    update botstats set
+        n=%(n)s, sum=%(sum)s, mean=%(mean)s, var=%(var)s,
+        skew=%(skew)s, kurtosis=%(kurtosis)s,
+        hn=%(hn)s, hsum=%(hsum)s, hmean=%(hmean)s, hvar=%(hvar)s,
+        hskew=%(hskew)s, hkurtosis=%(hkurtosis)s,
+        htn=%(htn)s, htsum=%(htsum)s, htmean=%(htmean)s, htvar=%(htvar)s,
+        htskew=%(htskew)s, htkurtosis=%(htkurtosis)s,
+        prediction=%(pred)s, class=%(class)s
+    where ip=%(ip)s
+    """)
+
+def updatestats(ip,diffs,hourdiffs,hours,ucur,uconn,stats=None,services=None,moments=None):
+    """
+    updates botstats fields
+    see statsdata for moments
+    """
+    try:
+        botprep.execute(ucur, UPDATEWINDOWS, {'diffs':diffs,'hourdiffs':hourdiffs,'hours':hours,'ip':ip})
+        if autocommit: uconn.commit()
+
+        data = statsdata(ip,diffs,hourdiffs,hours,moments)
+        if data != None:
             try:
                 data['pred'], data['class'] = get_prediction(data,stats,services)
-                ucur.execute(
-                    """
-                    update botstats set 
-                        n=%(n)s, sum=%(sum)s, mean=%(mean)s, var=%(var)s, 
-                        skew=%(skew)s, kurtosis=%(kurtosis)s, 
-                        hn=%(hn)s, hsum=%(hsum)s, hmean=%(hmean)s, hvar=%(hvar)s, 
-                        hskew=%(hskew)s, hkurtosis=%(hkurtosis)s, 
-                        htn=%(htn)s, htsum=%(htsum)s, htmean=%(htmean)s, htvar=%(htvar)s, 
-                        htskew=%(htskew)s, htkurtosis=%(htkurtosis)s,
-                        prediction=%(pred)s, class=%(class)s
-                    where ip=%(ip)s
-                    """, data)
+                botprep.execute(ucur, UPDATESTATS, data)
                 if autocommit: uconn.commit()
             except Exception as e:
                 uconn.rollback()
@@ -323,21 +369,22 @@ def initstats(scur,conn,ipd):
         print >>sys.stderr, "initstats: ",str(e)
         return False
 
+GETSTATS = botprep.Statement("getstats", """
+    select
+    ip,
+    n, sum, mean, var, skew, kurtosis, diffs,
+    pages,
+    reqs,
+    hourdiffs, hn, hsum, hmean, hvar, hskew, hkurtosis,
+    errs,
+    hours, htmean, htsum, htvar, htskew, htkurtosis, htn,
+    uas, class, prediction, sample
+    from botstats where ip=%(ip)s
+    """)
+
 def getstats(scur, ipd):
     try:
-        scur.execute(
-            """
-            select  
-            ip, 
-            n, sum, mean, var, skew, kurtosis, diffs, 
-            pages, 
-            reqs, 
-            hourdiffs, hn, hsum, hmean, hvar, hskew, hkurtosis, 
-            errs, 
-            hours, htmean, htsum, htvar, htskew, htkurtosis, htn, 
-            uas, class, prediction, sample
-            from botstats where ip=%(ip)s
-            """,ipd)
+        botprep.execute(scur, GETSTATS, ipd)
         if scur.rowcount:
             row = scur.fetchone()
             stats = botstats2dict(row)
@@ -357,41 +404,48 @@ def flatten(row):
 
     if 'REMOTE_ADDR' in row:
         row['remote_addr'] = row['REMOTE_ADDR']
+
+    # only rows from botlog have a logid
+    if 'logid' not in row:
+        row['logid'] = None
     return row
 
+GETBOTLATEST = botprep.Statement("getbotlatest", """
+    select
+    hour,REMOTE_ADDR, status_line, useragent, epoch, HTTP_HOST, content_type, logid
+    from botlatest
+    where
+    http_host=%(http_host)s
+    and remote_addr=%(remote_addr)s
+    """)
+
 def getbotlatest(scur,ipd):
     try:
-        scur.execute( 
-            """ 
-            select 
-            hour,REMOTE_ADDR, status_line, useragent, epoch, HTTP_HOST, content_type 
-            from botlatest 
-            where 
-            http_host=%(http_host)s 
-            and remote_addr=%(remote_addr)s 
-            """,ipd)
+        botprep.execute(scur, GETBOTLATEST, ipd)
         if scur.rowcount > 0:
             return botlatest2dict(scur.fetchone())
         return None
     except:
         pass
 
+UPDATEBOTLATEST = botprep.Statement("updatebotlatest", """
+    update botlatest set
+        hour = %(hour)s,
+        status_line = %(status_line)s,
+        content_type = %(content_type)s,
+        useragent = %(useragent)s,
+        epoch = %(epoch)s,
+        logid = %(logid)s
+    where
+        http_host = %(http_host)s and
+        remote_addr = %(remote_addr)s
+    """)
+
 def updatebotlatest(row, ucur, uconn):
     """ remember the last log entry we saw """
     try:
         row = flatten(row)
-        ucur.execute(
-            """
-            update botlatest set 
-                hour = %(hour)s, 
-                status_line = %(status_line)s, 
-                content_type = %(content_type)s,
-                useragent = %(useragent)s, 
-                epoch = %(epoch)s 
-            where
-                http_host = %(http_host)s and 
-                remote_addr = %(remote_addr)s 
-            """, row)
+        botprep.execute(ucur, UPDATEBOTLATEST, row)
         if autocommit: uconn.commit()
     except Exception as e:
         uconn.rollback()
@@ -409,11 +463,11 @@ def insertbotlatest(row, ucur, uconn):
             """
             insert into botlatest (
                 hour, status_line, content_type, useragent,
-                epoch, http_host, remote_addr
+                epoch, http_host, remote_addr, logid
             )
             values (
                 %(hour)s, %(status_line)s, %(content_type)s, %(useragent)s,
-                %(epoch)s, %(http_host)s, %(remote_addr)s
+                %(epoch)s, %(http_host)s, %(remote_addr)s, %(logid)s
             )
             """, row)
         if autocommit: uconn.commit()
@@ -422,6 +476,69 @@ def insertbotlatest(row, ucur, uconn):
         print >>sys.stderr, "insert botlatest error for ip ",row['remote_addr']
         print str(e)
 
+# bulk versions of the update functions above used by botstate's flusher
+# each one writes many ips with a single multi row insert ... on conflict
+# none of these commit, the caller commits once for the whole flush
+# botstats needs the unique ip constraint from psql/botstats.psql
+UPSERTPAGE = 1000
+
+def upsertstatcounts(rows, ucur):
+    """ rows of ip, reqs, pages, errs, uas, diffs, hourdiffs, hours """
+    execute_values(ucur,
+        """
+        insert into botstats (ip, reqs, pages, errs, uas, diffs, hourdiffs, hours)
+        values %s
+        on conflict (ip) do update set
+            reqs = excluded.reqs, pages = excluded.pages, errs = excluded.errs,
+            uas = excluded.uas, diffs = excluded.diffs,
+            hourdiffs = excluded.hourdiffs, hours = excluded.hours
+        """, rows,
+        template="(%(ip)s, %(reqs)s, %(pages)s, %(errs)s, %(uas)s, "
+                 "%(diffs)s, %(hourdiffs)s, %(hours)s)",
+        page_size=UPSERTPAGE)
+
+def upsertstats(rows, ucur):
+    """ rows from statsdata with pred and class added """
+    execute_values(ucur,
+        """
+        insert into botstats (
+            ip, n, sum, mean, var, skew, kurtosis,
+            hn, hsum, hmean, hvar, hskew, hkurtosis,
+            htn, htsum, htmean, htvar, htskew, htkurtosis,
+            prediction, class)
+        values %s
+        on conflict (ip) do update set
+            n = excluded.n, sum = excluded.sum, mean = excluded.mean,
+            var = excluded.var, skew = excluded.skew, kurtosis = excluded.kurtosis,
+            hn = excluded.hn, hsum = excluded.hsum, hmean = excluded.hmean,
+            hvar = excluded.hvar, hskew = excluded.hskew, hkurtosis = excluded.hkurtosis,
+            htn = excluded.htn, htsum = excluded.htsum, htmean = excluded.htmean,
+            htvar = excluded.htvar, htskew = excluded.htskew, htkurtosis = excluded.htkurtosis,
+            prediction = excluded.prediction, class = excluded.class
+        """, rows,
+        template="(%(ip)s, %(n)s, %(sum)s, %(mean)s, %(var)s, %(skew)s, %(kurtosis)s, "
+                 "%(hn)s, %(hsum)s, %(hmean)s, %(hvar)s, %(hskew)s, %(hkurtosis)s, "
+                 "%(htn)s, %(htsum)s, %(htmean)s, %(htvar)s, %(htskew)s, %(htkurtosis)s, "
+                 "%(pred)s, %(class)s)",
+        page_size=UPSERTPAGE)
+
+def upsertbotlatest(rows, ucur):
+    """ flattened log entries, see flatten """
+    execute_values(ucur,
+        """
+        insert into botlatest (
+            hour, status_line, content_type, useragent,
+            epoch, http_host, remote_addr, logid)
+        values %s
+        on conflict (http_host, remote_addr) do update set
+            hour = excluded.hour, status_line = excluded.status_line,
+            content_type = excluded.content_type, useragent = excluded.useragent,
+            epoch = excluded.epoch, logid = excluded.logid
+        """, rows,
+        template="(%(hour)s, %(status_line)s, %(content_type)s, %(useragent)s, "
+                 "%(epoch)s, %(http_host)s, %(remote_addr)s, %(logid)s)",
+        page_size=UPSERTPAGE)
+
 ###############################################################################
 # functions used by ippreprocess.py                                           #
 ###############################################################################
@@ -491,12 +608,12 @@ def checkua(ip, row, conn):
 # so instead log.py is used to save messages to a log table
 # this function checks for log entries
 def hasmsgs():
-    conn = psycopg2.connect(dbname=dbname,user=dbuser,password=dbpw)
-    cur = conn.cursor()
-    cur.execute("select count(*) from log where pid is null")
-    count = cur.fetchone()
-    cur.close()
-    conn.close()
+    with botpool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("select count(*) from log where pid is null")
+        count = cur.fetchone()
+        cur.close()
+        conn.commit()
     if count[0] > 0: 
         return True
     return False
@@ -507,7 +624,7 @@ def hasmsgs():
 # XXX: this probably won't work but its so slow its worth a try
 def readmsgs(pid,howmany=1000):
     print "starting readmessages with pid ",pid
-    conn = psycopg2.connect(dbname=dbname,user=dbuser,password=dbpw)
+    conn = botpool.getconn()
     cur = conn.cursor()
     cur.execute(
         """
@@ -540,7 +657,7 @@ def readmsgs(pid,howmany=1000):
 #        """, {'logid':logid,'pid':pid})
 #    conn.commit()
     cur.close()
-    conn.close()
+    botpool.putconn(conn)
 
 # not used by botlog.py but called from ippreprocess.py
 def process(messages):
@@ -556,12 +673,13 @@ def process(messages):
     global OLD
 
     # for getting data on a host/ip pair
-    conn = psycopg2.connect(dbname=dbname,user=dbuser,password=dbpw)
+    conn = botpool.getconn()
     cur = conn.cursor()
     tcur = conn.cursor()
 
     # for updates - inserts
-    uconn = psycopg2.connect(dbname=dbname,user=dbuser,password=dbpw)
+    # this thread's pooled connection is used for both
+    uconn = conn
     ucur = uconn.cursor()
 
 
@@ -715,8 +833,7 @@ def process(messages):
     finally:
         ucur.close()
         cur.close()
-        conn.close()
-        uconn.close()
+        botpool.putconn(conn)
         return logid
 
 if __name__ == '__main__':
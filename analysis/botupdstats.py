@@ -1,6 +1,10 @@
 import psycopg2
 import logging
 import bottiming as bt
+from botmoments import Moments
+from botring import Ring
+from array import array
+import botprep
 import sys
 import threading
 
@@ -41,33 +45,224 @@ import threading
 # latestlock = threading.Lock()
 # statslock = threading.Lock()
 
-def processlog(ipd,lastlogid,conn,services=None):
+# running moments for diffs, hourdiffs and hours by ip
+# botlog only lets one thread look after an ip at a time
+# so the entries don't need their own locks
+moments = {}
+# forget everything if we have this many ips
+MAXMOMENTS = 100000
+
+def windowkey(stats):
+    """
+    a cheap fingerprint of the windows in a botstats row
+    used to check that our running moments still match the db
+    """
+    d = stats['diffs']
+    hd = stats['hourdiffs']
+    if len(d) == 0 or len(hd) == 0:
+        return (len(d), len(hd), tuple(stats['hours']))
+    return (len(d), d[0], d[-1], len(hd), hd[0], hd[-1], tuple(stats['hours']))
+
+def getmoments(ip, stats):
+    """
+    find the running moments for an ip
+    rebuild them from the botstats row if they are missing or out of date
+    """
+    global moments
+    mom = moments.get(ip)
+    if mom == None or mom.get('key') != windowkey(stats) \
+            or mom['diffs'].stale() or mom['hourdiffs'].stale():
+        if len(moments) >= MAXMOMENTS:
+            moments.clear()
+        mom = {
+            'diffs': Moments(stats['diffs']),
+            'hourdiffs': Moments(stats['hourdiffs']),
+            'hours': Moments(stats['hours']),
+        }
+        moments[ip] = mom
+    return mom
+
+def applylogs(stats, latest, mom, rows):
+    """
+    update the counts, user agents and windows in stats from a list
+    of botlog entries (as dicts) for one ip
+    latest is the previous log entry for the ip or None
+    mom are the running moments for the stats windows
+    returns the number of new diffs and, if there was no latest entry
+    before, the html entry that was used as the first one (None otherwise)
+    """
+    first = None
+    logcount = 0
+
+    # keep a unique list of user agents
+    if 'uas' in stats and stats['uas'] != None:
+        uas = set(stats['uas'])
+    else:
+        uas = set([])
+
+    for log in rows:
+        logging.debug("next entry ... %s" % log)
+
+        if len(uas) >= 10:
+            tmpuas = list(uas)
+            del(tmpuas[0])
+            uas = set(tmpuas)
+        uas.add(log['useragent'])
+
+        stats['reqs'] += 1
+        if bt.iserr(log):
+            stats['errs'] += 1
+        if bt.ishtml(log):
+            stats['pages'] += 1
+        else:
+            continue
+
+        if latest == None:
+            latest = log
+            first = log
+
+        diff = log['epoch'] - latest['epoch']
+        if diff < 0: continue
+
+        latest = log
+
+        evicted = stats['diffs'].push(diff)
+        if evicted != None:
+            mom['diffs'].remove(evicted)
+        mom['diffs'].add(diff)
+
+        hourdiff = abs(log['hour'] - latest['hour'])
+        evicted = stats['hourdiffs'].push(hourdiff)
+        if evicted != None:
+            mom['hourdiffs'].remove(evicted)
+        mom['hourdiffs'].add(hourdiff)
+
+        hourcount = stats['hours'][log['hour']]
+        stats['hours'][log['hour']] += 1
+        mom['hours'].replace(hourcount, hourcount+1)
+        logcount += 1
+
+    stats['uas'] = list(uas);
+    for window in ('diffs', 'hourdiffs'):
+        if mom[window].stale():
+            mom[window].reset(stats[window])
+
+    return logcount, first
+
+def processstate(ipd,rows,conn,services,store):
+    """
+    like the second half of processlog but uses the in memory state
+    for the ip, the state store saves it to the db later
+    the state lock isn't held while asking for a prediction
+    """
+    state = store.get(ipd, conn)
+    data = None
+    state.lock.acquire()
+    try:
+        stats = state.stats
+        logcount, first = applylogs(stats, state.latest, state.moments, rows)
+
+        if len(stats['diffs']) > 0 and logcount > 0:
+            data = bt.statsdata(
+                ipd['ip'],
+                stats['diffs'],
+                stats['hourdiffs'],
+                stats['hours'],
+                state.moments)
+        if data != None:
+            # what get_prediction needs, so it can run without the lock
+            counts = {
+                'reqs': stats['reqs'], 'pages': stats['pages'], 'errs': stats['errs'],
+                'uas': list(stats['uas']), 'class': stats['class'],
+            }
+
+        # like updatebotlatest remember the last entry whatever it was
+        state.latest = rows[-1]
+        store.touch(state)
+    finally:
+        state.lock.release()
+
+    if data == None:
+        return logcount
+    try:
+        data['pred'], data['class'] = bt.get_prediction(data,counts,services)
+    except Exception as e:
+        logging.error("prediction failed for %s: %s" % (ipd['ip'], e))
+        data['pred'], data['class'] = None, counts['class']
+    state.lock.acquire()
+    try:
+        if state.stats['class'] == None:
+            state.stats['class'] = counts['class']
+        state.data = data
+        store.touch(state)
+    finally:
+        state.lock.release()
+    return logcount
+
+def processrows(ipd,rows,conn,services=None,store=None):
+    """
+    do stats for a list of log entries for an ip that we already have
+    in memory, see processlog for store
+    """
+    if store != None:
+        return processstate(ipd, rows, conn, services, store)
+    return processstats(ipd, rows, conn, services)
+
+SELECTBOTLOG = botprep.Statement("selectbotlog", """
+    select
+    hour,REMOTE_ADDR, status_line, useragent, epoch, HTTP_HOST, content_type,logid
+    from botlog
+    where http_host=%(http_host)s
+        and remote_addr=%(remote_addr)s
+        and logid > %(lastlogid)s
+        order by logid
+    """)
+DELETEBOTLOG = botprep.Statement("deletebotlog", """
+    delete from botlog
+    where
+    remote_addr=%(remote_addr)s
+    and http_host=%(http_host)s
+    and logid <= %(logid)s
+    """)
+
+def watermark(ipd, conn, store=None):
+    """
+    the logid of the last botlog row processed for an ip
+    only kept up to date if bottiming.PARTITIONED is set
+    """
+    if store != None:
+        latest = store.get(ipd, conn).latest
+    else:
+        cur = conn.cursor()
+        try:
+            latest = bt.getbotlatest(cur, ipd)
+        finally:
+            cur.close()
+    if latest == None or latest.get('logid') == None:
+        return 0
+    return latest['logid']
+
+def processlog(ipd,lastlogid,conn,services=None,store=None):
     """ 
     read log entries for a specific ip and do stats 
     this should be considered a critical section
     needs to be called from readmsgs
+    if store (a botstate.StateStore) is given botstats and botlatest
+    are not read or written here, the store does that in the background
     """
     global statslock
     try:
         cur = conn.cursor()
-        lcur = conn.cursor()
-        scur = conn.cursor()
 
         if lastlogid != None:
             ipd['lastlogid'] = lastlogid
         else:
             ipd['lastlogid'] = 0
+        # processed rows aren't deleted from a partitioned botlog
+        if bt.PARTITIONED and not lastlogid:
+            ipd['lastlogid'] = watermark(ipd, conn, store)
         try:
-            cur.execute(
-                """
-                select 
-                hour,REMOTE_ADDR, status_line, useragent, epoch, HTTP_HOST, content_type,logid
-                from botlog 
-                where http_host=%(http_host)s 
-                    and remote_addr=%(remote_addr)s 
-                    and logid > %(lastlogid)s
-                    order by logid
-                """,ipd)
+            botprep.execute(cur, SELECTBOTLOG, ipd)
             if cur.rowcount == 0:
                 if verbose:
                     logging.debug("found nothing to process for %s %s" % (str(ipd),cur.query))
@@ -75,112 +270,27 @@ def processlog(ipd,lastlogid,conn,services=None):
         except:
             return 0
 
-        # get our stats row or make one
-        isrc = True
-        # statslock.acquire()
-        stats = bt.getstats(scur,ipd)
-        if stats == None:
-            logging.debug("no stats yet")
-            isrc = bt.initstats(scur, conn, ipd)
-            stats = bt.getstats(scur, ipd)
-        else:
-            logging.debug("found stats")
-        # statslock.release()
-        if not isrc:
-            raise Exception("error initializing stats for %s" % (ipd['ip']))
-        if stats == None:
-            raise Exception("Stats should not be empty here!")
-
-        # go through the list of entries for us and update diffs
-        update = False
-        diff = -1
-        log = {}
-        logcount = 0
-
-        # keep a unique list of user agents
-        if 'uas' in stats and stats['uas'] != None:
-            uas = set(stats['uas'])
-        else:
-            uas = set([])
-
-        latest = bt.getbotlatest(lcur, ipd)
-
-        for loglist in cur:
-            log = bt.botlog2dict(loglist)
-            logging.debug("next entry ... %s" % log)
-
-            if len(uas) >= 10:
-                tmpuas = list(uas)
-                del(tmpuas[0])
-                uas = set(tmpuas)
-            uas.add(log['useragent'])
-
-            stats['reqs'] += 1
-            if bt.iserr(log):
-                stats['errs'] += 1
-            if bt.ishtml(log):
-                stats['pages'] += 1
-            else:
-                continue
-
-            if latest == None:
-                latest = log
-                bt.insertbotlatest(latest, lcur, conn)
-
-            diff = log['epoch'] - latest['epoch']
-            if diff < 0: continue
-
-            latest = log
-
-            if len(stats['diffs']) > bt.MAXDIFFS:
-                del(stats['diffs'][0])
-            stats['diffs'].append(diff)
-
-            hourdiff = abs(log['hour'] - latest['hour'])
-            if len(stats['hourdiffs']) > bt.MAXDIFFS: 
-                del(stats['hourdiffs'][0])
-            stats['hourdiffs'].append(hourdiff)
-
-            stats['hours'][log['hour']] += 1
-            logcount += 1
-
-        stats['uas'] = list(uas);
-        logging.debug("saving stats")
-        logging.debug(stats)
-        bt.updatestatcounts(
-            ipd['ip'],
-            stats['reqs'],
-            stats['pages'],
-            stats['errs'],
-            stats['uas'],
-            scur, conn)
-
-        if len(stats['diffs']) > 0 and logcount > 0:
-            bt.updatestats(
-                ipd['ip'],
-                stats['diffs'],
-                stats['hourdiffs'],
-                stats['hours'],
-                scur, conn,
-                stats,services)
+        rows = [bt.botlog2dict(loglist) for loglist in cur]
+        # the raw rows only have HTTP_HOST and REMOTE_ADDR
+        seen = {
+            'http_host': ipd['http_host'],
+            'remote_addr': ipd['remote_addr'],
+            'logid': rows[-1]['logid'],
+        }
+        logcount = processrows(ipd, rows, conn, services, store)
+        if bt.PARTITIONED:
+            # botlatest.logid is now seen['logid'], botpartition.py cleans up
+            conn.commit()
+            return logcount
 
         # delete what we have seen
         # note that more entries may have been added
         # while we were processing
-        logging.debug("last entry %s" % log)
-        bt.updatebotlatest(log, lcur, conn)
         logging.debug(
             "deleting log entries for %(http_host)s %(remote_addr)s before %(logid)d" 
-            % log)
+            % seen)
         try:
-            cur.execute(
-                """
-                delete from botlog 
-                where 
-                remote_addr=%(remote_addr)s 
-                and http_host=%(http_host)s
-                and logid <= %(logid)s
-                """,log);
+            botprep.execute(cur, DELETEBOTLOG, seen)
             conn.commit()
             logging.debug("deleted %d" % (cur.rowcount))
         except Exception as e:
@@ -195,3 +305,62 @@ def processlog(ipd,lastlogid,conn,services=None):
         exc_type, exc_obj, tb = sys.exc_info()
         logging.error("processlog failed at %d: %s" % (tb.tb_lineno, str(e)))
 
+def processstats(ipd,rows,conn,services):
+    """
+    update botstats and botlatest directly for a list of botlog entries
+    """
+    lcur = conn.cursor()
+    scur = conn.cursor()
+
+    # get our stats row or make one
+    isrc = True
+    # statslock.acquire()
+    stats = bt.getstats(scur,ipd)
+    if stats == None:
+        logging.debug("no stats yet")
+        isrc = bt.initstats(scur, conn, ipd)
+        stats = bt.getstats(scur, ipd)
+    else:
+        logging.debug("found stats")
+    # statslock.release()
+    if not isrc:
+        raise Exception("error initializing stats for %s" % (ipd['ip']))
+    if stats == None:
+        raise Exception("Stats should not be empty here!")
+
+    # the lists have always been allowed to grow to MAXDIFFS+1
+    stats['diffs'] = Ring(bt.MAXDIFFS+1, stats['diffs'])
+    stats['hourdiffs'] = Ring(bt.MAXDIFFS+1, stats['hourdiffs'])
+    stats['hours'] = array('i', stats['hours'])
+
+    latest = bt.getbotlatest(lcur, ipd)
+    mom = getmoments(ipd['ip'], stats)
+
+    # go through the list of entries for us and update diffs
+    logcount, first = applylogs(stats, latest, mom, rows)
+    if first != None:
+        bt.insertbotlatest(first, lcur, conn)
+
+    logging.debug("saving stats")
+    logging.debug(stats)
+    bt.updatestatcounts(
+        ipd['ip'],
+        stats['reqs'],
+        stats['pages'],
+        stats['errs'],
+        stats['uas'],
+        scur, conn)
+
+    if len(stats['diffs']) > 0 and logcount > 0:
+        bt.updatestats(
+            ipd['ip'],
+            stats['diffs'],
+            stats['hourdiffs'],
+            stats['hours'],
+            scur, conn,
+            stats,services,mom)
+    mom['key'] = windowkey(stats)
+
+    logging.debug("last entry %s" % rows[-1])
+    bt.updatebotlatest(rows[-1], lcur, conn)
+    return logcount
@@ -0,0 +1,200 @@
+"""
+ pipelined client for vowpal wabbit daemons
+
+ get_prediction used to make a connection per ip update (or later keep
+ one per thread) and wait for each answer before the next line could be
+ sent, so every botlog worker spent most of its time waiting on vw.
+ a vw daemon reads example lines off a connection one after another and
+ writes one answer line per example in the same order, so there is no
+ need to wait between lines
+
+ a Client is shared by all threads. submit hands a feature line to a
+ botbatcher.Batcher which collects whatever the workers send within
+ maxdelay seconds and writes it to the daemon in one go. the Result for
+ each line is queued in the order the lines were written and a reader
+ thread fills them in as the answers arrive. many batches can be in
+ flight on the one connection
+
+    r = botvw.getclient(addr).submit(features)
+    ... do something else ...
+    pred = float(r.get())
+
+ or just getclient(addr).predict(features) to wait straight away
+"""
+import collections
+import logging
+import os
+import socket
+import threading
+
+import botbatcher
+import botproto
+
+# most lines written to the daemon at once
+MAXBATCH = 256
+# longest a line waits for others to go with it
+MAXDELAY = 0.001
+# seconds to wait for a connection or an answer
+TIMEOUT = botproto.TIMEOUT
+
+class VWError(Exception):
+    pass
+
+class Result(object):
+    """ the answer to one line, filled in by the reader thread """
+    __slots__ = ('event', 'answer', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.answer = None
+        self.error = None
+
+    def set(self, answer):
+        self.answer = answer
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def get(self, timeout=TIMEOUT):
+        """ wait for the answer line, raises VWError if there isn't one """
+        self.event.wait(timeout)
+        if not self.event.is_set():
+            raise VWError("no answer after %s seconds" % timeout)
+        if self.error != None:
+            raise self.error
+        return self.answer
+
+class Client(object):
+    def __init__(self, addr, maxbatch=MAXBATCH, maxdelay=MAXDELAY, timeout=TIMEOUT):
+        self.addr = addr
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        # Results for lines written to sock that haven't been answered, oldest first
+        self.inflight = None
+        self.pid = os.getpid()
+        self.batcher = botbatcher.Batcher(self.send, maxbatch, maxdelay)
+        self.batcher.start("vw%s" % (addr,))
+
+    def submit(self, line):
+        """ queue a feature line for the daemon, returns its Result """
+        if not line.endswith("\n"):
+            line += "\n"
+        result = Result()
+        self.batcher.put((line, result))
+        return result
+
+    def predict(self, line, timeout=None):
+        """ send a line and wait for the answer """
+        if timeout == None:
+            timeout = self.timeout
+        return self.submit(line).get(timeout)
+
+    def connect(self):
+        """ batcher thread: open a connection and start its reader """
+        s = socket.create_connection(self.addr, self.timeout)
+        s.settimeout(None)
+        inflight = collections.deque()
+        self.lock.acquire()
+        self.sock = s
+        self.inflight = inflight
+        self.lock.release()
+        reader = threading.Thread(name="vwreader%s" % (self.addr,),
+                target=self.read, args=(s, inflight))
+        reader.daemon = True
+        reader.start()
+        return s
+
+    def send(self, batch):
+        """
+        batcher thread: write a batch of lines, the reader matches up the answers
+        only the batcher thread sends so the lock is only needed for inflight,
+        the reader takes it for every answer and vw stops reading if its
+        answers aren't read
+        """
+        s = None
+        try:
+            self.lock.acquire()
+            s = self.sock
+            self.lock.release()
+            if s == None:
+                s = self.connect()
+            self.lock.acquire()
+            try:
+                if self.sock is not s:
+                    raise socket.error("connection to %s closed" % (self.addr,))
+                # queue the results first so the reader can't see an answer it can't match
+                self.inflight.extend([result for line, result in batch])
+            finally:
+                self.lock.release()
+            s.sendall("".join([line for line, result in batch]))
+        except socket.error as e:
+            logging.error("sending %d lines to %s failed: %s" % (len(batch), self.addr, e))
+            for line, result in batch:
+                if not result.done():
+                    result.fail(VWError(str(e)))
+            if s != None:
+                self.lock.acquire()
+                self.drop(s, VWError(str(e)))
+                self.lock.release()
+
+    def read(self, s, inflight):
+        """ reader thread: hand each answer line to the oldest waiting Result """
+        buf = ""
+        while True:
+            try:
+                data = s.recv(botproto.READSIZE)
+            except socket.error:
+                data = ""
+            if not data:
+                break
+            lines, buf = botproto.splitlines(buf+data)
+            for line in lines:
+                self.lock.acquire()
+                result = inflight.popleft() if len(inflight) > 0 else None
+                self.lock.release()
+                if result == None:
+                    logging.error("answer %s from %s that nobody asked for" % (line, self.addr))
+                    continue
+                result.set(line)
+        self.lock.acquire()
+        self.drop(s, VWError("connection to %s closed" % (self.addr,)))
+        self.lock.release()
+        s.close()
+
+    def drop(self, s, error):
+        """ forget a connection and fail whatever was waiting on it, call with the lock held """
+        if self.sock is s:
+            self.sock = None
+            inflight = self.inflight
+            self.inflight = None
+        else:
+            inflight = None
+        try:
+            s.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        while inflight:
+            inflight.popleft().fail(error)
+
+clients = {}
+clientlock = threading.Lock()
+
+def getclient(addr):
+    """
+    the shared Client for the vw daemon at addr (a (host, port) tuple)
+    a forked process can't use its parent's threads so it gets its own
+    """
+    clientlock.acquire()
+    try:
+        client = clients.get(addr)
+        if client == None or client.pid != os.getpid():
+            client = clients[addr] = Client(addr)
+        return client
+    finally:
+        clientlock.release()
@@ -1,57 +1,158 @@
 #!/usr/bin/env python
+"""
+ load the prediction files made by botclassifyall.sh into redis
+
+ each line is "prediction host/ip". the predictions for an ip are added
+ together, if the total is < 0 its human, > 0 its a bot and 0 we don't
+ know. there can be many lines for the same ip in the same file
+
+ this used to do a get and two sets for every line. now the files are
+ read a line at a time and the totals are added up in memory (one entry
+ per ip, not per line) and written with MSET, CHUNK keys at a time, in
+ pipelines so there are only a few round trips for the whole load
+
+ with -i nothing is kept in memory: every line adds its prediction to
+ the ip with INCRBY and copies the new total to the host/ip (a small lua
+ script so the values are the same as without -i), sent in pipelines of
+ CHUNK lines. as this adds to whatever is already in redis use it on an
+ empty database (or after a FLUSHDB)
+
+ with -p the ip totals are saved in botpack's compact layout (packed
+ ips in bucket hashes, one byte values) and no host/ip keys are made.
+ each load is a new generation, the previous one is dropped
+ botpack.DROPDELAY seconds after the switch so this waits for that
+
+ with -s file the ip totals are compiled into a botsnapshot file for the
+ classifier servers instead and redis isn't used at all:
+    fill-redis.py -s predictions.snap {prediction files}
+"""
 import redis
 import sys
+import getopt
 import logging
-import copy
 import time
 
+import botpack
+import botsnapshot
+
 # logging.basicConfig(level=logging.ERROR)
 # logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 
-if len(sys.argv) < 3:
-    print "usage:",sys.argv[0],"{redis server} {prediction files}"
-    sys.exit(1)
+# keys per MSET or lines per pipeline with -i
+CHUNK = 5000
+# MSETs sent per round trip
+PIPELINE = 10
 
-rs = redis.Redis(sys.argv[1])
+def usage():
+    print "usage:",sys.argv[0],"[-i|-p] [-c chunk] {redis server} {prediction files}"
+    print "   or:",sys.argv[0],"-s {snapshot file} {prediction files}"
+    sys.exit(1)
 
-def read_predictions():        
+def read_predictions(fnames):
     """
-    read a series of prediction files
-    these will have weighted predictions
-    for ips
-    idea is to add the predictions together
-    if prediction < 0 then its human
-    > 0 its a bot
-    0 don't know
-    *** multiple predictions for the same ip can exist in the same file ***
+    (prediction, host/ip, ip) for each line of a series of prediction files
+    only one line is in memory at a time
     """
-    global rs
-
-    args = copy.deepcopy(sys.argv)
-    initialized = False
-    seen = {}
-    for i in range(2,len(args)):
-        fname = args[i]
+    for fname in fnames:
         logging.info("reading %s at %d" % (fname,time.time()))
         with open(fname,"r") as pfile:
             for line in pfile:
-                p, hostip = line.split()
-                host, ip = hostip.split('/')
-                pred = int(p)
                 try:
-                    if ip in seen:
-                        prev = int(rs.get(ip))
-                    else:
-                        prev = 0
-                except:
-                    prev = 0
-                newpred = prev+pred
-                logging.debug("saving prediction %d for %s" % (newpred,ip))
-                rs.set(ip,newpred)
-                rs.set(hostip,newpred)
-                seen[ip] = True
-        logging.info("fill redis %d" % time.time())
+                    p, hostip = line.split()
+                    host, ip = hostip.split('/')
+                    pred = int(p)
+                except ValueError:
+                    logging.error("bad line in %s: %s" % (fname, line.strip()))
+                    continue
+                yield pred, hostip, ip
+
+def aggregate(predictions, hosts=True):
+    """
+    add up the predictions for each ip
+    the ip key gets the ip's total and the host/ip key gets the ip's
+    total as of the last line for that host/ip, as the old loader did
+    hosts=False skips the host/ip totals
+    """
+    totals = {}
+    hosttotals = {}
+    for pred, hostip, ip in predictions:
+        totals[ip] = totals.get(ip, 0) + pred
+        if hosts:
+            hosttotals[hostip] = totals[ip]
+    return totals, hosttotals
+
+def mset(rs, values, chunk=CHUNK):
+    """ write a dict of keys and values with one MSET per chunk keys """
+    pipe = rs.pipeline(transaction=False)
+    batch = {}
+    queued = 0
+    for key, value in values.iteritems():
+        batch[key] = value
+        if len(batch) >= chunk:
+            pipe.mset(batch)
+            batch = {}
+            queued += 1
+            if queued >= PIPELINE:
+                pipe.execute()
+                queued = 0
+    if len(batch) > 0:
+        pipe.mset(batch)
+    pipe.execute()
+
+# add to the ip's total and give the host/ip the new total, like aggregate
+INCR = """
+local total = redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], total)
+return total
+"""
+
+def incr(rs, predictions, chunk=CHUNK):
+    """ add each prediction to the ip key and set the host/ip key to the ip's total """
+    script = rs.register_script(INCR)
+    pipe = rs.pipeline(transaction=False)
+    count = 0
+    for pred, hostip, ip in predictions:
+        script(keys=[ip, hostip], args=[pred], client=pipe)
+        count += 1
+        if count % chunk == 0:
+            pipe.execute()
+    pipe.execute()
+    return count
 
 if __name__ == '__main__':
-    read_predictions()
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ipc:s:")
+    except getopt.GetoptError:
+        usage()
+    opts = dict(opts)
+    if '-s' in opts:
+        if len(args) < 1:
+            usage()
+        totals, hosttotals = aggregate(read_predictions(args), False)
+        bad = botsnapshot.write(opts['-s'], totals)
+        if bad > 0:
+            logging.error("%d ips could not be packed" % bad)
+        sys.exit(0)
+    if len(args) < 2:
+        usage()
+    if '-i' in opts and '-p' in opts:
+        usage()
+    chunk = int(opts.get('-c', CHUNK))
+
+    rs = redis.Redis(args[0])
+    if '-i' in opts:
+        count = incr(rs, read_predictions(args[1:]), chunk)
+        logging.info("added %d predictions" % count)
+    elif '-p' in opts:
+        totals, hosttotals = aggregate(read_predictions(args[1:]), False)
+        logging.info("saving %d packed ips" % len(totals))
+        bad = botpack.hset(rs, totals, chunk)
+        if bad > 0:
+            logging.error("%d ips could not be packed" % bad)
+    else:
+        totals, hosttotals = aggregate(read_predictions(args[1:]))
+        logging.info("saving %d ips and %d host/ips" % (len(totals), len(hosttotals)))
+        mset(rs, totals, chunk)
+        mset(rs, hosttotals, chunk)
+    logging.info("fill redis %d" % time.time())
@@ -6,8 +6,7 @@
 
 import psycopg2
 from mldb import dbname, dbuser, dbpw
-import bottiming
-bottiming.autocommit = False
+import botbatch
 import sys
 import re
 
@@ -27,7 +26,7 @@ print "searching for host ",sys.argv[1]
 query = re.sub(r'#host#', sys.argv[1], select)
 print query
 try:
-    rowcount = 0
+    rows = []
     conn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpw)
     cur = conn.cursor()
     ucur = conn.cursor()
@@ -66,11 +65,13 @@ try:
             hprevprev = hprev
             hprev = hdiff
         print (ip, fixed, hfixed)
-        bottiming.updatestats(ip,fixed,hfixed,hours,ucur,conn)
-        rowcount += 1
-        if rowcount > 100:
-            rowcount = 0
-            conn.commit()
+        # botbatch.updatestats commits each batch
+        rows.append({'ip':ip,'diffs':fixed,'hourdiffs':hfixed,'hours':hours})
+        if len(rows) >= botbatch.CHUNK:
+            botbatch.updatestats(rows,ucur,conn)
+            rows = []
+    if len(rows) > 0:
+        botbatch.updatestats(rows,ucur,conn)
 
 except Exception as e:
     conn.rollback()
@@ -1,12 +1,12 @@
 # this does a simple insert of a message into mod_ml's db
-import psycopg2
-from mldb import dbname, dbuser, dbpw
+import botpool
 import sys
 
 def process(messages):
+    conn = None
+    cur = None
     try:
-        print >>sys.stderr, "mod_ml connecting to database"
-        conn=psycopg2.connect(dbname=dbname, user=dbuser, password=dbpw)
+        conn = botpool.getconn()
         cur=conn.cursor()
         for message in messages:
             cur.execute("insert into log (ts, message) values (now(), %(message)s)", 
@@ -16,6 +16,7 @@ def process(messages):
         print >>sys.stderr, str(e)
         print >>sys.stderr, "failed: message ",message.strip()," query ",cur.query
     finally:
-        cur.close()
-        conn.close()
-
+        if cur != None:
+            cur.close()
+        if conn != None:
+            botpool.putconn(conn)
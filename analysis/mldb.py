@@ -2,3 +2,7 @@ import os
 dbname = os.environ.get('ML_DB')
 dbuser = os.environ.get('ML_DB_USER')
 dbpw = os.environ.get('ML_DB_PW')
+# connection pool sizes - see botpool.py
+# botlog raises maxconn if it is too small for its worker threads
+dbminconn = int(os.environ.get('ML_DB_MINCONN', 1))
+dbmaxconn = int(os.environ.get('ML_DB_MAXCONN', 32))
@@ -1,181 +1,71 @@
 #!/usr/bin/env python
+"""
+ answer mod_ml MLClassifier lookups with the predictions in redis
+ see botclassifyserver for how requests are handled
+"""
 import redis
+import os
 import sys
-import re
-import socket
-import json
-import hashlib
 import logging
-import threading
-import time
+
+import botclassifyserver
+import botcache
+import botsnapshot
+import botpack
 
 logging.basicConfig(level=logging.ERROR)
 # logging.basicConfig(level=logging.DEBUG)
 # logging.basicConfig(level=logging.INFO)
 
+# seconds to wait for redis before giving up on a batch of lookups
+TIMEOUT = 1.0
+# cache predictions here, see botcache for the size and ttls
+CACHE = True
+# drop cached predictions when bottiming publishes a new one
+# set KEYSPACE to use redis keyspace notifications instead
+# (needs notify-keyspace-events K$ or similar in the redis config)
+INVALIDATE = True
+KEYSPACE = False
+# set BOTCLASSIFY_PACKED if the predictions were saved with fill-redis.py -p
+PACKED = bool(os.environ.get('BOTCLASSIFY_PACKED'))
+# set BOTCLASSIFY_SNAPSHOT to a file made by fill-redis.py -s to answer
+# from it instead of redis
+SNAPSHOT = os.environ.get('BOTCLASSIFY_SNAPSHOT')
+
 if len(sys.argv) < 4:
     print "usage:",sys.argv[0],"{port} {hostsfile} {redis server}"
     sys.exit(1)
 
 port = int(sys.argv[1])
 hostfile = sys.argv[2]
-rs = redis.Redis(sys.argv[3])
-msgcount = 0
-whitelist = {} 
-
-def read_whitelist():
-    global hostfile
-    global whitelist
-    try:
-        split = re.compile("\s*(\S+)\s*(.*)")
-        comment = re.compile("^\s*#")
-        isnonce = re.compile("(nonce)=(\"[^\"]*\"|'[^']*'|\S*)")
-        wl = open(hostfile)
-        for line in wl:
-            lm = split.match(line)
-            if lm == None: 
-                continue
-            bits = lm.groups()
-            if comment.match(bits[0]): 
-                continue
+# the connection stays open between lookups
+pool = redis.ConnectionPool(host=sys.argv[3], socket_timeout=TIMEOUT)
+rs = redis.Redis(connection_pool=pool)
 
-            yes = True
-            if len(bits) > 1:
-                m = isnonce.match(bits[1])
-                if m != None:
-                    authtype, pw = m.groups()
-                    yes = hashlib.sha1(pw).hexdigest()
-
-            whitelist[bits[0]] = yes
-        wl.close()
-        logging.debug("whitelist %s" % (whitelist))
-
-    except Exception as e:
-        logging.debug("failed reading whitelist %s at line %d: %s" % (hostfile,line, e))
-
-"""
-def respond(stream, client_address):
-"""
-class respond(threading.Thread):
-    def __init__(self, stream, client_address):
-        threading.Thread.__init__(self)
-        self.stream = stream
-        self.client_address = client_address
-
-    def run(self):
-        stream = self.stream
-        client_address = self.client_address
-        global rs
-        message = ""
-        try:
-            data = stream.recv(1024)
-            if data:
-               message = message + data
-        except:
-            pass
-        try: 
-            logging.debug("checking %s against whitelist" % (client_address[0]))
-            if client_address[0] in whitelist:
-                logging.debug("looking for password")
-                if whitelist[client_address[0]] == True:
-                    pass
-                else:
-                    sha1pw = whitelist[client_address[0]]
-                    logging.debug("found encoded pw %s" % (sha1pw))
-                    m = noncepat.search(message)
-                    if m != None:
-                        nonce, salt = m.groups()
-                        testnonce = hashlib.sha1(sha1pw+salt).hexdigest()
-                        if testnonce != nonce:
-                            logging.debug("nonce failed for %s" % client_address)
-                            return
-                        else:
-                            logging.debug("nonce ok for %s" % client_address)
-                    else:
-                        logging.debug("no nonce found in message, rejecting")
-                        return
-            try:
-                parsed = json.loads(message)
-                if 'ip' in parsed:
-                    ipstr = parsed['ip'].strip()
-            except:
-                ipstr = message
-
-                logging.debug("got %s" % (ipstr)) 
-                response = ""
-                i = ippat.search(ipstr)
-                if i == None:
-                    response = "BADIP"
-                else:
-                    ip = i.group(1)
-                    p = rs.get(ip)
-                    if p:
-                        logging.debug("got prediction %d for %s" % (p,ip)) 
-                        if p < 0:
-                            response = "NO"
-                        else:
-                            response = "YES"
-                    else:
-                        response = "MISSING"
-                # response = response + "\n"
-                stream.sendall(response)
-                logging.debug(response)
-        except Exception as e:
-            print e
-            logging.error("failed: message %s" % (message.strip()))
-
-read_whitelist()
-
-noncepat = re.compile("nonce=(\w*):(\w*)")
-ippat = re.compile("^\s*\w[\w\.\-:]+\w[/\s]+(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})")
+def lookup(ips):
+    """ every ip's prediction in one round trip """
+    if PACKED:
+        return botpack.hget(rs, ips)
+    return dict((ip, p) for ip, p in zip(ips, rs.mget(ips)) if p != None)
 
 try:
     if port < 1024: raise Exception("bad port number!")
 
-    logging.debug("mod_ml listening on %d" % (port))
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_address = ('',port)
-    sock.bind(server_address)
-    sock.listen(10)
-
-    while True: # this loop accepts a connection
-        msgcount += 1
-        msgcount = msgcount % 200000000
-        logging.debug("waiting for connection")
-        stream, client_address = sock.accept()
-
-        try:
-            if len(whitelist) == 0:
-                pass
-            elif client_address[0] in whitelist and whitelist[client_address[0]]:
-                pass
-            else:
-                logging.debug("rejected connection from %s" % (client_address[0]))
-                continue
-        except Exception as e:
-            logging.error("error checking whitelist for %s: %s" % (client_address[0],e))
-            continue
-
-        try:
-            """
-            fork just slightly slower than using threading.Thread
-            newpid = os.fork()
-            if newpid == 0:
-                respond(stream, client_address)
-                os._exit(0)
-            else:
-                kidpid, status = os.wait()
-            """
-            responder = respond(stream, client_address)
-            responder.run()
-
-        except Exception as e:
-            logging.error("failed reading socket %s" % (e))
-        finally:
-            stream.close()
+    whitelist = botclassifyserver.read_whitelist(hostfile)
+    cache = None
+    if SNAPSHOT != None:
+        # lookups are cheap enough that there is nothing to cache
+        snapshot = botsnapshot.Snapshot(SNAPSHOT)
+        lookup = snapshot.getmany
+    elif CACHE:
+        cache = botcache.Cache()
+        if INVALIDATE:
+            # the lookup pool's timeout would break a quiet subscription
+            botcache.subscribe(redis.Redis(host=sys.argv[3]), cache, keyspace=KEYSPACE)
+    server = botclassifyserver.ClassifyServer(port, whitelist, lookup, cache)
+    server.serve_forever()
 
 except Exception as e:
     print e
-    logging.error("failed initializing" % (str(e)))
+    logging.error("failed initializing %s" % (str(e)))
     sys.exit(1)
-
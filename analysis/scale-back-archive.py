@@ -2,7 +2,7 @@
 # the archived epochs are millisecond based not second based
 # change the contents of botstats to reflect second based epoch time
 import psycopg2
-import bottiming as bt
+import botbatch
 from mldb import dbname, dbuser, dbpw
 
 conn = psycopg2.connect(dbname=dbname,user=dbuser,password=dbpw)
@@ -27,9 +27,16 @@ cur.execute(
     order by mean desc
     """)
 
+# stats are done botbatch.CHUNK ips at a time
+rows = []
 for row in cur:
     ip, diffs, hourdiffs, hours = row
     scaleddiffs = [x/1000 for x in diffs]
     print ip," ",diffs," now ",scaleddiffs
-    bt.updatestats(ip, scaleddiffs, hourdiffs, hours, ucur, conn)
+    rows.append({'ip':ip,'diffs':scaleddiffs,'hourdiffs':hourdiffs,'hours':hours})
+    if len(rows) >= botbatch.CHUNK:
+        botbatch.updatestats(rows, ucur, conn)
+        rows = []
+if len(rows) > 0:
+    botbatch.updatestats(rows, ucur, conn)
 
@@ -3,10 +3,12 @@
 import psycopg2
 import re
 from mldb import dbname, dbuser, dbpw
+import botbatch
+from botring import Ring
+from array import array
 
 conn = psycopg2.connect(dbname=dbname,user=dbuser,password=dbpw)
 cur = conn.cursor()
-tcur = conn.cursor()
 # for updates - inserts
 uconn = psycopg2.connect(dbname=dbname,user=dbuser,password=dbpw)
 ucur = uconn.cursor()
@@ -17,38 +19,10 @@ ipcounts = {}
 ipdiffs = {}
 iphourdiffs = {}
 iphours = {}
+# ips that need their stats saved and their counts at the time
+pending = {}
 MAXDIFFS = 1000
 
-def genstats(diffs):
-    # this method is going to be slow but my kurtosis calculation formula isn't working
-    if len(diffs) > 1:
-        s = sum(diffs)+0.0
-        n = len(diffs)+0.0
-        m = s/n
-        se = ce = qe = 0.0
-        for d in diffs:
-            se += (d - m)**2.0
-            ce += (d - m)**3.0
-            qe += (d - m)**4.0
-        var = se/(n-1.0)
-        # source for sn, kn1, kn2 sample size corrections 
-        # http://www.ats.ucla.edu/stat/mult_pkg/faq/general/kurtosis.htm
-        # and http://www.itl.nist.gov/div898/handbook/eda/section3/eda35b.htm
-        if var != 0 and n > 1: 
-            sn = ((n*(n-1.0))**(1/2))/(n-1.0)
-            skew = sn*(ce/n)/(var*(var**(1.0/2.0)))
-            if n > 3:
-                kn1 = (n*(n+1.0))/((n-1.0)*(n-2.0)*(n-3.0))
-                kn2 = ((n-1.0)**2.0)/((n-2.0)*(n-3.0))
-                kurt = kn1*(qe/n)/(var**2.0) - 3.0*kn2
-            else:
-                kurt = 0.0
-        else: 
-            kurt = 0.0
-            skew = 0.0
-        return {'diffs':diffs, 'n': n, 'sum': s, 'mean': m, 'var': se, 'kurtosis': kurt, 'skew': skew}
-    return None
-
 def iserr(row):
     status_line = row['status_line']
     if status_line[0] == '4' or status_line[0] == '5':
@@ -111,102 +85,34 @@ for rowlist in cur:
         hourdiff = abs(row['hour'] - prev['hour'])
 
         if ip not in ipdiffs:
-            ipdiffs[ip] = []
-            iphours[ip] = [0 for i in range(24)]
-            iphourdiffs[ip] = []
+            ipdiffs[ip] = Ring(MAXDIFFS)
+            iphours[ip] = array('i', [0]) * 24
+            iphourdiffs[ip] = Ring(MAXDIFFS)
 
         # ignore extreme outliers - in milliseconds 1200000 = 20 min
         # in a production setting this would determine when data gets removed
         if diff >= 0 and diff < OLD:
 
-            if len(ipdiffs[ip]) >= MAXDIFFS:
-                del(ipdiffs[ip][0])
-                del(iphourdiffs[ip][0])
-
-            ipdiffs[ip].append(diff)
-            iphourdiffs[ip].append(hourdiff)
+            ipdiffs[ip].push(diff)
+            iphourdiffs[ip].push(hourdiff)
             iphours[ip][row['hour']] += 1
 
+            # the stats only depend on the windows which don't change
+            # until the next time we get here so work them out at the end
             if ip in ipdiffs and len(ipdiffs[ip]) > 1:
-                s = genstats(ipdiffs[ip])
-                h = genstats(iphourdiffs[ip])
-                ht = genstats(iphours[ip])
-
-                if h == None or s == None or ht is None:
-                    raise Exception("missing data for ip "+ip)
-
-                pages = ipcounts[ip]['pages']
-                reqs = ipcounts[ip]['reqs']
-                errs = ipcounts[ip]['errs']
-
-                data = {'ip':ip,
-                        'n':s['n'],'sum':s['sum'],'mean':s['mean'],
-                        'var':s['var'],'skew':s['skew'],'kurtosis':s['kurtosis'],
-                        'diffs':s['diffs'],'pages':pages,'reqs':reqs,'hourdiffs':h['diffs'],
-                        'hn':h['n'],'hsum':h['sum'],'hmean':h['mean'],
-                        'hvar':h['var'],'hskew':h['skew'],'hkurtosis':h['kurtosis'],
-                        'errs': errs, 
-                        'hours':ht['diffs'], # these aren't actual diffs
-                        'htn':ht['n'],'htsum':ht['sum'],'htmean':ht['mean'],
-                        'htvar':ht['var'],'htskew':ht['skew'],'htkurtosis':ht['kurtosis']
-                        }
-
-                print data
-                try:
-                    ins = ucur.mogrify("""insert into botstats_archive (
-                                        ip,
-                                        n,sum,mean,var,skew,kurtosis,
-                                        diffs,pages,reqs,hourdiffs,
-                                        hn,hsum,hmean,hvar,hskew,hkurtosis,
-                                        errs,
-                                        hours,
-                                        htn,htsum,htmean,htvar,htskew,htkurtosis
-                                        ) 
-                                    values (
-                                        %(ip)s,
-                                        %(n)s,%(sum)s,%(mean)s,%(var)s,%(skew)s,%(kurtosis)s,
-                                        %(diffs)s,%(pages)s,%(reqs)s,%(hourdiffs)s,
-                                        %(hn)s,%(hsum)s,%(hmean)s,%(hvar)s,%(hskew)s,%(hkurtosis)s,
-                                        %(errs)s,
-                                        %(hours)s,
-                                        %(htn)s,%(htsum)s,%(htmean)s,%(htvar)s,%(htskew)s,%(htkurtosis)s
-                                        )
-                                        """, data)
-                    # print ins
-                    ucur.execute(ins)
-                    print "committing data for ip ",ip
-                    uconn.commit()
-                    print ucur.statusmessage
-                except Exception as e:
-                    print "error inserting or may already have data for ip ",ip
-                    print str(e)
-                    uconn.rollback()
-                    try:
-                        ucur.execute("""update botstats_archive set 
-                                        n=%(n)s,sum=%(sum)s,mean=%(mean)s,var=%(var)s,
-                                        skew=%(skew)s,kurtosis=%(kurtosis)s,
-                                        diffs=%(diffs)s,pages=%(pages)s,reqs=%(reqs)s,hourdiffs=%(hourdiffs)s,
-                                        hn=%(hn)s,hsum=%(hsum)s,hmean=%(hmean)s,hvar=%(hvar)s,
-                                        hskew=%(hskew)s,hkurtosis=%(hkurtosis)s,
-                                        errs=%(errs)s,
-                                        hours=%(hours)s,
-                                        htn=%(htn)s,htsum=%(htsum)s,htmean=%(htmean)s,htvar=%(htvar)s,
-                                        htskew=%(htskew)s,htkurtosis=%(htkurtosis)s
-                                        where ip=%(ip)s""", data)
-                        print "committing data for ip ",ip
-                        uconn.commit()
-                        # print ucur.query
-                        print ucur.statusmessage
-                    except Exception as e:
-                        print "update error for ip ",ip
-                        print str(e)
-
-                finally:
-                    print "checking commit for ip ",ip
-                    tcur.execute("select * from botstats_archive where ip=%(ip)s", {'ip':ip})
-                    for trow in tcur:
-                        print trow
-                    print "finished check"
+                pending[ip] = {'ip':ip,
+                        'pages':ipcounts[ip]['pages'],
+                        'reqs':ipcounts[ip]['reqs'],
+                        'errs':ipcounts[ip]['errs']}
 
     ipprev[ip] = row
 
+ips = pending.keys()
+for start in range(0, len(ips), botbatch.CHUNK):
+    botbatch.savestats("botstats_archive",
+        [dict(pending[ip],
+                diffs=ipdiffs[ip].linear(),
+                hourdiffs=iphourdiffs[ip].linear(),
+                hours=iphours[ip])
+            for ip in ips[start:start+botbatch.CHUNK]],
+        ucur, uconn)
@@ -0,0 +1,26 @@
+#!/bin/sh
+# write a readable copy of a vw model for botscorer and point model.txt at it
+# model is the symlink startvw.sh makes to the latest model
+# botscorer notices model.txt has moved and reads the new weights by itself
+# so run this whenever the model changes, e.g. after restartvw.sh or from cron
+model=$1
+if [ "$model" = "" ]
+then
+    model=model
+fi
+
+vw=/usr/local/bin/vw
+if [ ! -f $model ]
+then
+    echo need to create a model first
+    exit 1
+fi
+real=`/usr/bin/readlink -f $model`
+readable=$real.txt
+if [ ! -f $readable -o $real -nt $readable ]
+then
+    $vw -i $model -t -d /dev/null --quiet --readable_model $readable.tmp || exit 1
+    /bin/mv $readable.tmp $readable
+fi
+# swap the link in one go so the scorer never sees it missing
+/bin/ln -sfn $readable model.txt.tmp && /bin/mv -T model.txt.tmp model.txt
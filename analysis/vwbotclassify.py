@@ -1,16 +1,43 @@
 #!/usr/bin/env python
-import psycopg2
+"""
+ answer YES (bot) or NO (human) for an ip using its botstats row and a vw model
+
+ this used to run vwbotclassify.sh (which starts vw and loads the model)
+ for every request from a single threaded accept loop. now the model is
+ loaded once and each connection gets its own thread:
+
+ * if the model file is a readable model (see vw/readablemodel.sh)
+   botscorer does the predictions in process and picks up a new model
+   when the file or link changes
+ * otherwise one vw process is started with the model and kept running,
+   each prediction is a line written to it and a line read back
+
+ the features for an ip are cached for CACHETTL seconds so repeated
+ requests for the same ip don't go to the db each time
+
+ mod_ml ends each message with "\n\n" and then waits for the answer
+ without shutting down its side, so messages are split up with
+ botserver.frame and answered as soon as they are complete. a connection
+ can send more than one and each answer ends with a newline
+"""
 import sys
-import os
 import re
 import socket
 import json
 import hashlib
-from mldb import dbname, dbuser, dbpw
 import logging
 import subprocess
+import threading
+import botpool
+import botscorer
+import botcache
+import botserver
 
-vwclassify = "/srv/cal/src/apache/ml/analysis/vwbotclassify.sh"
+vw = "/usr/local/bin/vw"
+# seconds to keep the features for an ip
+CACHETTL = 60
+# most ips to keep features for
+CACHESIZE = 100000
 
 if len(sys.argv) < 4:
     print "usage:",sys.argv[0],"{port} {hostsfile} {vowpal wabbit model file}"
@@ -20,38 +47,81 @@ port = int(sys.argv[1])
 hostfile = sys.argv[2]
 modelfile = sys.argv[3]
 msgcount = 0
-whitelist = {} 
+whitelist = {}
 query = """
 select
-    class||' '||
-    '|'||' '||
-    'mean:'||mean||' '||
-    'var:'||var||' '||
-    'skew:'||skew||' '||
-    'kurtosis:'||kurtosis||' '||
-    'hmean:'||hmean||' '||
-    'hvar:'||hvar||' '||
-    'hskew:'||hskew||' '||
-    'hkurtosis:'||hkurtosis||' '||
-    'htmean:'||htmean||' '||
-    'htvar:'||htvar||' '||
-    'htskew:'||htskew||' '||
-    'htkurtosis:'||htkurtosis||' '||
-    'poverr:'||(pages/reqs)||' '||
-    'uacount:'||(array_length(uas, 1))||' '||
-    'errprop:'||(errs/reqs)
+    class,
+    mean, var, skew, kurtosis,
+    hmean, hvar, hskew, hkurtosis,
+    htmean, htvar, htskew, htkurtosis,
+    (pages/reqs) as poverr,
+    (array_length(uas, 1)) as uacount,
+    (errs/reqs) as errprop
 from botstats
 where ip=%(ip)s
 """
 
-def reconnect(conn=None):
-    if conn != None and not conn.closed:
-        return conn
-    logging.debug("mod_ml connecting to database")
-    return psycopg2.connect(dbname=dbname, user=dbuser, password=dbpw)
+class VWProcess(object):
+    """ a vw process that makes predictions for lines written to its stdin """
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+                [vw, "-t", "-i", self.model, "-p", "/dev/stdout", "--quiet"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
 
-conn = reconnect()
-cur = conn.cursor()
+    def predict(self, features):
+        line = "| %s\n" % " ".join(["%s:%s" % (name, value) for name, value in features])
+        self.lock.acquire()
+        try:
+            if self.proc == None or self.proc.poll() != None:
+                self.start()
+            self.proc.stdin.write(line)
+            prediction = self.proc.stdout.readline()
+            if prediction == "":
+                self.proc = None
+                raise Exception("vw exited")
+            return float(prediction.split()[0])
+        finally:
+            self.lock.release()
+
+def getscorer(model):
+    """ botscorer for readable models, a resident vw for anything else """
+    f = open(model)
+    head = f.read(7)
+    f.close()
+    if head == "Version":
+        return botscorer.Scorer(model)
+    return VWProcess(model)
+
+# ip => features or None if there is no botstats row
+cache = botcache.Cache(CACHESIZE, CACHETTL, CACHETTL)
+
+def features(ip):
+    """ the feature (name, value) pairs for an ip from botstats or the cache """
+    cached, feats = cache.get(ip)
+    if cached:
+        return feats
+
+    conn = botpool.getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute(query, { 'ip': ip })
+        row = cur.fetchone()
+        cur.close()
+        conn.rollback()
+    finally:
+        botpool.putconn(conn)
+    if row == None:
+        feats = None
+    else:
+        feats = [(name, 0.0 if value == None else value)
+                    for name, value in zip(botscorer.FEATURES, row[1:])]
+    cache.put(ip, feats)
+    return feats
 
 def read_whitelist():
     global hostfile
@@ -63,10 +133,10 @@ def read_whitelist():
         wl = open(hostfile)
         for line in wl:
             lm = split.match(line)
-            if lm == None: 
+            if lm == None:
                 continue
             bits = lm.groups()
-            if comment.match(bits[0]): 
+            if comment.match(bits[0]):
                 continue
 
             yes = True
@@ -82,20 +152,108 @@ def read_whitelist():
 
     except Exception as e:
         logging.debug("failed reading whitelist %s at line %d: %s" % (hostfile,line, e))
-        
+
 read_whitelist()
 
 noncepat = re.compile("nonce=(\w*):(\w*)")
 ippat = re.compile("^\s*(\w[\w\.\-:]+\w/\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})")
 
+def checknonce(message, client_address):
+    """ False if the client has a password and the message doesn't have the right nonce """
+    if client_address[0] in whitelist:
+        logging.debug("looking for password")
+        if whitelist[client_address[0]] == True:
+            return True
+        sha1pw = whitelist[client_address[0]]
+        logging.debug("found encoded pw %s" % (sha1pw))
+        m = noncepat.search(message)
+        if m == None:
+            logging.debug("no nonce found in message, rejecting")
+            return False
+        nonce, salt = m.groups()
+        testnonce = hashlib.sha1(sha1pw+salt).hexdigest()
+        if testnonce != nonce:
+            logging.debug("nonce failed for %s" % (client_address,))
+            return False
+        logging.debug("nonce ok for %s" % (client_address,))
+    return True
+
+def report(*fields):
+    """ print a line in one write so lines from different threads don't get mixed up """
+    sys.stdout.write(" ".join([str(field) for field in fields])+"\n")
+
+def classify(message, msgcount):
+    """ the answer for one request """
+    ipstr = message
+    try:
+        parsed = json.loads(message)
+        if 'ip' in parsed:
+            ipstr = parsed['ip'].strip()
+    except:
+        pass
+
+    i = ippat.search(ipstr)
+    if i == None:
+        logging.debug("bad ip %s" % ipstr)
+        return "BADIP"
+    ip = i.group(1)
+    feats = features(ip)
+    if feats == None:
+        logging.debug("no data for %s" % ip)
+        report(msgcount,ip,"NOTFOUND")
+        return "NOTFOUND"
+    try:
+        p = scorer.predict(feats)
+    except Exception as e:
+        logging.debug("invalid response for %s: %s" % (ip, e))
+        report(msgcount,ip,"invalid response",e)
+        return "BADRESPONSE"
+    logging.debug("got prediction %.4f for %s" % (p,ip))
+    if p < 0:
+        report(msgcount,ip,"NO",p)
+        return "NO"
+    report(msgcount,ip,"YES",p)
+    return "YES"
+
+def serve(stream, client_address, msgcount):
+    """ connection thread: answer each message as soon as it has all arrived """
+    buf = ""
+    message = ""
+    try:
+        while True: # this loop reads messages
+            data = stream.recv(botserver.READSIZE)
+            buf = buf + data
+            messages, buf = botserver.frame(buf)
+            if not data and len(buf.strip()) > 0:
+                # a client that shut down its side without ending the message
+                messages.append(buf)
+                buf = ""
+            for message in messages:
+                logging.debug("checking %s against whitelist" % (client_address[0]))
+                if not checknonce(message, client_address):
+                    return
+                stream.sendall(classify(message, msgcount)+"\n")
+            if not data:
+                break
+            if len(buf) > botserver.MAXMSG:
+                logging.error("message from %s too big" % (client_address[0]))
+                break
+    except Exception as e:
+        logging.error("failed: %s message %s" % (e,message.strip()))
+    finally:
+        stream.close()
+
 try:
     if port < 1024: raise Exception("bad port number!")
 
+    scorer = getscorer(modelfile)
+
     logging.debug("mod_ml listening on %d" % (port))
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_address = ('',int(sys.argv[1]))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_address = ('',port)
     sock.bind(server_address)
-    sock.listen(1)
+    sock.listen(128)
 
     while True: # this loop accepts a connection
         msgcount += 1
@@ -110,98 +268,17 @@ try:
                 pass
             else:
                 logging.debug("rejected connection from %s" % (client_address[0]))
+                stream.close()
                 continue
         except Exception as e:
             logging.error("error checking whitelist for %s: %s" % (client_address[0],e))
+            stream.close()
             continue
 
-        try:
-            message = ""
-            while True: # this loop reads a message
-                try:
-                    data = stream.recv(1024)
-                    logging.debug("got ",data)
-                    if data:
-                       message = message + data
-                    else:
-                        break
-                except:
-                    break
-            # now update the db with the message
-            try: 
-                logging.debug("checking %s against whitelist" % (client_address[0]))
-                if client_address[0] in whitelist:
-                    logging.debug("looking for password")
-                    if whitelist[client_address[0]] == True:
-                        pass
-                    else:
-                        sha1pw = whitelist[client_address[0]]
-                        logging.debug("found encoded pw %s" % (sha1pw))
-                        m = noncepat.search(message)
-                        if m != None:
-                            nonce, salt = m.groups()
-                            testnonce = hashlib.sha1(sha1pw+salt).hexdigest()
-                            if testnonce != nonce:
-                                logging.debug("nonce failed for %s" % client_address)
-                                continue
-                            else:
-                                logging.debug("nonce ok for %s" % client_address)
-                        else:
-                            logging.debug("no nonce found in message, rejecting")
-                            continue
-                try:
-                    parsed = json.loads(message)
-                    if 'ip' in parsed:
-                        ipstr = parsed['ip'].strip()
-                except:
-                    ipstr = message
-
-                    i = ippat.search(ipstr)
-                    if i == None:
-                        logging.debug("bad ip %s" % ipstr) 
-                        stream.sendall("BADIP")
-                    else:
-                        ip = i.group(1)
-                        conn = reconnect(conn)
-                        cur = conn.cursor()
-                        cur.execute(query, { 'ip': ip })
-                        if cur.rowcount > 0:
-                            row = cur.fetchone()
-                            prediction = subprocess.check_output([vwclassify, row[0], modelfile])
-                            try:
-                                p = float(prediction)
-                                logging.debug("got prediction %.4f for %s" % (p,ip)) 
-                                if p < 0:
-                                    print msgcount,ip,"NO",p
-                                    stream.sendall("NO")
-                                else:
-                                    print msgcount,ip,"YES",p
-                                    stream.sendall("YES")
-                            except:
-                                logging.debug("invalid response for %s %s" % ip, prediction) 
-                                print msgcount,ip,"invalid response",prediction
-                                stream.sendall("BADRESPONSE")
-                        else:
-                            logging.debug("no data for %s" % ip) 
-                            print msgcount,ip,"NOTFOUND"
-                            stream.sendall("NOTFOUND")
-                else:
-                    logging.debug("no ip %s" % ipstr) 
-                    stream.sendall("NOIP")
-                
-            except Exception as e:
-                logging.error("failed: %s message %s query %s" % (e,message.strip(),cur.query))
-            finally:
-                cur.close()
-
-        except Exception as e:
-             logging.error("failed reading socket %s" % (e))
-             break
-        finally:
-             stream.close()
+        t = threading.Thread(target=serve, args=(stream, client_address, msgcount))
+        t.daemon = True
+        t.start()
 
 except Exception as e:
-    logging.error("failed initializing" % (str(e)))
+    logging.error("failed initializing: %s" % (str(e)))
     sys.exit(1)
-
-